@@ -1,4 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock
+from time import monotonic, sleep
+from typing import Callable
+from urllib.parse import urlparse
+
+from requests import Request, Response
 from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+from izonemail.metrics import metrics
+from izonemail.transport import AIMDLimiter, Transport, PoolStats, RETRY_STATUSES
+
+
+class _CountingConnectionMixin:
+    """Count the connections an urllib3 connection opens and the requests it sends over them into `stats`
+
+    A connection dropped while idle is closed by its pool and opened again, so it counts as new.
+    """
+    stats: PoolStats
+    opened_for_request = False
+
+    def connect(self):
+        super(_CountingConnectionMixin, self).connect()
+        self.opened_for_request = True
+        self.stats.add('new')
+
+    def request(self, *args, **kwargs):
+        # Closed connections are opened within the request
+        if self.sock is not None and not self.opened_for_request:
+            self.stats.add('reused')
+        try:
+            return super(_CountingConnectionMixin, self).request(*args, **kwargs)
+        finally:
+            self.opened_for_request = False
+
+
+class _CountingPoolMixin:
+    """Count the connections an urllib3 connection pool discards as it is full into `stats`"""
+    stats: PoolStats
+
+    def _put_conn(self, conn):
+        if conn is not None and self.pool is not None and self.pool.full():
+            self.stats.add('discarded')
+        super(_CountingPoolMixin, self)._put_conn(conn)
 
 
 class TimeoutHTTPAdapter(HTTPAdapter):
@@ -14,3 +59,139 @@ class TimeoutHTTPAdapter(HTTPAdapter):
         if timeout is None:
             kwargs['timeout'] = self.timeout
         return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+class TransportHTTPAdapter(TimeoutHTTPAdapter):
+    """``TimeoutHTTPAdapter`` limiting in-flight requests per host and retrying with backoff
+
+    Retries are handled here instead of by urllib3, so `max_retries` is taken from the transport.
+    Connection pool events are counted into `stats`.
+    """
+    def __init__(self, transport: Transport, *args, **kwargs):
+        self.transport = transport
+        self.stats = PoolStats()
+        kwargs['max_retries'] = 0
+        super(TransportHTTPAdapter, self).__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(TransportHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: self._counting_pool(cls) for scheme, cls in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+    def _counting_pool(self, cls):
+        conn_cls = cls.ConnectionCls
+        counting_conn_cls = type(f'Counting{conn_cls.__name__}', (_CountingConnectionMixin, conn_cls),
+                                 {'stats': self.stats})
+        # Pools have no public hook for discarded connections, which are only counted by the urllib3 versions pinned
+        bases = (_CountingPoolMixin, cls) if hasattr(cls, '_put_conn') else (cls,)
+        return type(f'Counting{cls.__name__}', bases, {'stats': self.stats, 'ConnectionCls': counting_conn_cls})
+
+    def warm_up(self, url: str, n: int, verify=True, proxies=None, cert=None) -> int:
+        """Open `n` connections (including TLS handshakes) to the host of `url` ahead of the first request
+
+        `verify`, `proxies` and `cert` select the pool like the ``send`` of requests made with them.
+
+        :return: The number of connections opened successfully
+        """
+        def connect(conn):
+            try:
+                conn.connect()
+                conn.opened_for_request = False
+                return True
+            except Exception:
+                # Failed connections are retried by the first request anyway
+                return False
+
+        if hasattr(self, 'get_connection_with_tls_context'):
+            # Pools are keyed by their TLS settings since requests 2.32
+            pool = self.get_connection_with_tls_context(Request('GET', url).prepare(), verify, proxies, cert)
+        else:
+            pool = self.get_connection(url, proxies)
+        if not hasattr(pool, '_get_conn') or not hasattr(pool, '_put_conn'):
+            # Idle connections can only be added to the pools of the urllib3 versions pinned
+            return 0
+        conns = [pool._get_conn() for _ in range(n)]
+        with ThreadPoolExecutor(max_workers=n) as executor:
+            n_connected = sum(executor.map(connect, conns))
+        for conn in conns:
+            pool._put_conn(conn)
+        return n_connected
+
+    def send(self, request, **kwargs):
+        """Send `request`, holding a slot of its host until the body of the response is read
+
+        Bodies are read here unless `stream`, in which case the slot is released once the response
+        is read to the end or closed.
+        """
+        limiter = self.transport.limiter(request.url)
+        attempt = 0
+        while True:
+            limiter.acquire()
+            start = monotonic()
+            r = None
+            ok = held = False
+            # The slot is released whatever is raised, or the host would run out of them
+            try:
+                r = super(TransportHTTPAdapter, self).send(request, **kwargs)
+                throttled = r.status_code in RETRY_STATUSES
+                ok = not throttled and r.status_code < 500
+                if not throttled or attempt >= self.transport.max_retries:
+                    if kwargs.get('stream'):
+                        _release_with(r, partial(_release, limiter, start, ok))
+                        held = True
+                    else:
+                        # Read by the session otherwise, outside the limit
+                        r.content
+            except (ConnectionError, Timeout) as e:
+                if r is not None:
+                    r.close()
+                if attempt >= self.transport.max_retries:
+                    raise
+                reason = type(e).__name__
+                r = None
+            finally:
+                if not held:
+                    limiter.release(monotonic() - start, ok)
+            if r is None:
+                metrics.add('retries_total', host=urlparse(request.url).netloc, reason=reason)
+                sleep(self.transport.backoff(attempt))
+                attempt += 1
+                continue
+            if not throttled or attempt >= self.transport.max_retries:
+                return r
+            metrics.add('retries_total', host=urlparse(request.url).netloc, reason=r.status_code)
+            retry_after = r.headers.get('Retry-After')
+            delay = self.transport.backoff(attempt, retry_after)
+            if retry_after is not None:
+                limiter.defer(delay)
+            r.close()
+            sleep(delay)
+            attempt += 1
+
+
+def _release(limiter: AIMDLimiter, start: float, ok: bool):
+    limiter.release(monotonic() - start, ok)
+
+
+def _release_with(r: Response, release: Callable[[], None]):
+    """Call `release` once, when the connection of the streamed response `r` is released
+
+    urllib3 releases it once the body is read to the end, and ``Response.close`` does otherwise.
+    """
+    raw = r.raw
+    release_conn = raw.release_conn
+    lock = Lock()
+    released = []
+
+    def release_once():
+        try:
+            release_conn()
+        finally:
+            with lock:
+                if released:
+                    return
+                released.append(True)
+            release()
+
+    raw.release_conn = release_once
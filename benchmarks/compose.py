@@ -0,0 +1,239 @@
+"""CPU micro-benchmark of the mail composer commands
+
+Feeds a corpus of mail detail pages through ``MailComposer``, with each command on its own and
+with the full chain of izms.py, timing the parse, each stage and the serialization per mail.
+Requests are deferred with a ``DeferredFetcher`` and nothing is written, so only CPU time is
+measured. Timings are compared with a baseline file, scaled by the speed of the machine::
+
+    python benchmarks/compose.py                    # Compare with benchmarks/compose_baseline.json
+    python benchmarks/compose.py --update-baseline  # Record a new baseline
+    python benchmarks/compose.py --corpus <dir>     # Use saved detail pages (*.html) instead
+    python benchmarks/compose.py --check            # Compare the output of both composers instead
+
+Without `--corpus`, mails are generated by the mock server, or read from benchmarks/corpus with
+`--check`, whose pages exercise the edge cases of the markup which the streaming composer
+must serialize exactly like the tree.
+"""
+import json
+import sys
+from argparse import ArgumentParser
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+from easydict import EasyDict
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from izms import create_composer  # noqa: E402
+from izonemail import DeferredFetcher, Mail, Member, PolicyFactory, User  # noqa: E402
+
+from mock_server import MockServer, MockSettings  # noqa: E402
+
+_default_baseline = Path(__file__).resolve().with_name('compose_baseline.json')
+_check_corpus = Path(__file__).resolve().with_name('corpus')
+_recipient = User('bench', 'token', 'bench', 'x', 'KR', 0, '2000-01-01', 0)
+
+
+def _calibrate() -> float:
+    """Seconds taken by a fixed pure Python workload, to compare timings across machines"""
+    best = float('inf')
+    # Many short samples, as the best of a few long ones varies a lot on shared machines
+    for _ in range(40):
+        start = perf_counter()
+        d = {}
+        for i in range(50000):
+            d[str(i)] = i * 2
+        ''.join(sorted(d))
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def load_corpus(directory: Optional[Path] = None, n: int = 24) -> Tuple[str, List[Tuple[Mail, str]]]:
+    if directory is None:
+        settings = MockSettings(mails=n)
+        server = MockServer(settings)
+        server.server_close()
+        name = f'mock:{n}x{settings.detail_size}B+{settings.images_per_mail}img'
+        pages = [(server.mail(i), server.detail(i).decode('utf-8')) for i in range(1, n + 1)]
+        mails = [(Mail(Member(m['member']['id'], m['member']['name'], m['member']['image_url']), m['id'],
+                       m['subject'], m['content'], datetime.fromisoformat(m['receive_datetime']), m['detail_url']),
+                  body) for m, body in pages]
+        return name, mails
+    files = sorted(directory.glob('*.html'))
+    if not files:
+        raise FileNotFoundError(f'No *.html in {directory}')
+    member = Member(0, 'Member', 'https://example.com/profile/0.jpg')
+    mails = [(Mail(member, f.stem, f.stem, '', datetime(2021, 1, 1), f'https://example.com/detail/{f.stem}'),
+              f.read_text('utf-8')) for f in files]
+    return f'{directory.name}:{len(files)}', mails
+
+
+def _config(composer: str, mode: str) -> EasyDict:
+    config = EasyDict(destination='bench-out', mail_path='/mail/{member_id}/{mail_id}.html', composer=composer,
+                      profile_image_path='/', css_path='/css', image_path='/img', max_workers=1, fsync='none',
+                      pack=None)
+    if mode == 'embed':
+        config.update(profile_image_path=None, css_path=None, image_path=None)
+    return config
+
+
+def _name(c) -> str:
+    return type(c).__name__[:-len('Command')]
+
+
+def _stage_name(stage) -> str:
+    if isinstance(stage, list):
+        return '+'.join(map(_name, stage))
+    return _name(stage)
+
+
+def _time_mail(composer, mail: Mail, body: str, timings: Dict[str, List[float]], serialize: bool):
+    """Render `mail` like ``MailComposer.render``, adding the time of each phase to `timings`"""
+    start = perf_counter()
+    payload = composer._create_payload(_recipient, mail, body)
+    timings.setdefault('parse', []).append(perf_counter() - start)
+    for stage in composer._stages():
+        start = perf_counter()
+        if isinstance(stage, list):
+            composer._traverse(payload, stage)
+            for c in stage:
+                c.finish(payload)
+        else:
+            stage.execute(payload)
+        timings.setdefault(_stage_name(stage), []).append(perf_counter() - start)
+    if serialize:
+        start = perf_counter()
+        payload.body.encode()
+        timings.setdefault('serialize', []).append(perf_counter() - start)
+
+
+def run(corpus: List[Tuple[Mail, str]], rounds: int, composers: List[str], modes: List[str]) -> Dict[str, float]:
+    """Best over `rounds` of the mean time per mail of every phase, in microseconds"""
+    policy = PolicyFactory.get('com.ca-smart.izonemail')
+    results = {}
+    for composer_name in composers:
+        for mode in modes:
+            chain = create_composer(_config(composer_name, mode), policy, DeferredFetcher())
+            cases = {'chain': list(chain)}
+            cases.update({_name(c): [c] for c in chain if _name(c) != 'DumpMailMarkup'})
+            for case, cmds in cases.items():
+                composer = create_composer(_config(composer_name, mode), policy, DeferredFetcher())
+                composer[:] = cmds
+                rounds_timings = []
+                # The first round warms up caches and is not counted
+                for _ in range(rounds + 1):
+                    timings = {}
+                    for mail, body in corpus:
+                        # The chain serializes with DumpMailMarkupCommand
+                        _time_mail(composer, mail, body, timings, serialize=case != 'chain')
+                    rounds_timings.append({k: sum(v) / len(v) for k, v in timings.items()})
+                for phase in rounds_timings[0]:
+                    key = f'{composer_name}/{mode}/{case}/{phase}'
+                    results[key] = min(t[phase] for t in rounds_timings[1:]) * 1e6
+    return results
+
+
+def check(corpus: List[Tuple[Mail, str]], modes: List[str]) -> int:
+    """Number of mails whose artifacts differ between the tree and the streaming composer, printing them"""
+    policy = PolicyFactory.get('com.ca-smart.izonemail')
+    failures = 0
+    for mode in modes:
+        tree = create_composer(_config('tree', mode), policy, DeferredFetcher())
+        stream = create_composer(_config('stream', mode), policy, DeferredFetcher())
+        for mail, body in corpus:
+            expected = tree.render(_recipient, mail, body)
+            actual = stream.render(_recipient, mail, body)
+            if actual == expected:
+                continue
+            failures += 1
+            print(f'❌ {mode}/{mail.id}', file=sys.stderr)
+            for e, a in zip(expected, actual):
+                if e == a:
+                    continue
+                if type(e) is not type(a) or e.path != a.path or not hasattr(e, 'data'):
+                    print(f'  tree:   {e}\n  stream: {a}', file=sys.stderr)
+                    continue
+                # Only around the first difference, as mails are long
+                i = next((i for i, (x, y) in enumerate(zip(e.data, a.data)) if x != y), min(len(e.data), len(a.data)))
+                print(f'  {e.path} differs at byte {i}:\n'
+                      f'  tree:   {e.data[max(i - 40, 0):i + 40]!r}\n  stream: {a.data[max(i - 40, 0):i + 40]!r}',
+                      file=sys.stderr)
+            if len(expected) != len(actual):
+                print(f'  {len(expected)} artifacts in the tree, {len(actual)} in the stream', file=sys.stderr)
+    return failures
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the CPU cost of the mail composer per mail.')
+    parser.add_argument('--corpus', type=Path, metavar='<dir>', help='Directory of saved mail detail pages.')
+    parser.add_argument('--rounds', type=int, default=7)
+    parser.add_argument('--composers', nargs='+', choices=['tree', 'stream'], default=['tree', 'stream'])
+    parser.add_argument('--modes', nargs='+', choices=['file', 'embed'], default=['file', 'embed'])
+    parser.add_argument('--baseline', type=Path, default=_default_baseline, metavar='<file>')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Fraction by which a case may be slower than the baseline.')
+    parser.add_argument('--update-baseline', action='store_true', help='Write the timings as the new baseline.')
+    parser.add_argument('--check', action='store_true',
+                        help='Check that both composers write the same bytes instead of timing them.')
+    args = parser.parse_args()
+
+    if args.check:
+        corpus_name, corpus = load_corpus(args.corpus or _check_corpus)
+        failures = check(corpus, args.modes)
+        print(f'Corpus: {corpus_name} / {len(corpus) * len(args.modes) - failures} identical, {failures} different')
+        return 1 if failures else 0
+
+    corpus_name, corpus = load_corpus(args.corpus)
+    calibration = _calibrate()
+    results = run(corpus, args.rounds, args.composers, args.modes)
+    calibration = min(calibration, _calibrate())
+
+    if args.update_baseline:
+        baseline = {'corpus': corpus_name, 'calibration': calibration, 'timings': results}
+        args.baseline.write_text(json.dumps(baseline, indent=2, sort_keys=True) + '\n', 'utf-8')
+        print(f'Baseline of {len(results)} phases written to {args.baseline}')
+        return 0
+
+    baseline = {'timings': {}}
+    if args.baseline.is_file():
+        baseline = json.loads(args.baseline.read_text('utf-8'))
+        if baseline['corpus'] != corpus_name:
+            print(f"⚠️ The baseline was recorded with another corpus ({baseline['corpus']})", file=sys.stderr)
+            baseline = {'timings': {}}
+    # Expected timings on this machine
+    scale = calibration / baseline['calibration'] if 'calibration' in baseline else 1.0
+    print(f'Corpus: {corpus_name} / Machine speed relative to baseline: {1 / scale:.2f}x')
+    print(f"{'case / phase':<72} {'us/mail':>10} {'baseline':>10} {'change':>8}")
+    # Cases are checked as a whole, as the shortest phases vary too much from run to run
+    cases = {}
+    for key, value in results.items():
+        case, _, phase = key.rpartition('/')
+        cases.setdefault(case, {})[phase] = value
+    regressions = 0
+    for case, phases in cases.items():
+        expected = {p: baseline['timings'][f'{case}/{p}'] * scale for p in phases if f'{case}/{p}' in baseline['timings']}
+        regressed = False
+        if len(expected) == len(phases):
+            regressed = sum(phases.values()) > sum(expected.values()) * (1 + args.threshold)
+            regressions += regressed
+        print(_row(case, sum(phases.values()), sum(expected.values()) if len(expected) == len(phases) else None,
+                   '  ❌' if regressed else ''))
+        for phase, value in phases.items():
+            print(_row(f'  {phase}', value, expected.get(phase)))
+    if regressions:
+        print(f'{regressions} cases are more than {args.threshold:.0%} slower than the baseline', file=sys.stderr)
+        return 1
+    return 0
+
+
+def _row(name: str, value: float, expected: Optional[float], mark: str = '') -> str:
+    if expected is None:
+        return f'{name:<72} {value:>10.1f}'
+    change = value / expected - 1 if expected else 0.0
+    return f'{name:<72} {value:>10.1f} {expected:>10.1f} {change:>+8.0%}{mark}'
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""End-to-end throughput benchmark of the izms.py pipeline against the mock server
+
+Each combination of `--workers` and `--modes` downloads the whole mock inbox into a fresh
+destination with the real pipeline, and reports mails/sec, per-mail latency from the detail
+request to the saved artifacts, and the peak RSS of the largest process::
+
+    python benchmarks/e2e.py --mails 500 --latency 0.02 --workers 4 8 16 --modes file embed
+"""
+import json
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import monotonic
+from typing import Dict, List, Optional
+
+from mock_server import MockServer, add_arguments, settings_from
+
+_run_izms = Path(__file__).resolve().with_name('run_izms.py')
+_profile = {
+    'user-id': 'bench', 'access-token': 'token', 'os-type': 'iOS', 'terms-version': '1', 'application-version': '1.0.0'
+}
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile"""
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))]
+
+
+def _wait(process: subprocess.Popen) -> Optional[int]:
+    """Wait for `process`, returning the peak RSS in bytes of it or of its largest child where supported"""
+    if not hasattr(os, 'wait4'):
+        process.wait()
+        return None
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # Kilobytes on Linux, bytes on macOS
+    return usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def run(server_url: str, workers: int, mode: str, options: Dict) -> Dict:
+    with TemporaryDirectory(prefix='izms-bench-') as tmp:
+        tmp = Path(tmp)
+        config = {
+            'destination': str(tmp / 'out'),
+            'mail_path': '/mail/{member_id}/{mail_id}.html',
+            'database': str(tmp / 'INDEX.db'),
+            'raw_cache': str(tmp / 'RAW.db'),
+            'max_workers': workers,
+            'profile': _profile,
+            **options,
+        }
+        if mode == 'embed':
+            config.update(profile_image_path=None, css_path=None, image_path=None)
+        (tmp / 'config.json').write_text(json.dumps(config), 'utf-8')
+        timings_path = tmp / 'timings.json'
+        with (tmp / 'log.txt').open('wb') as log:
+            start = monotonic()
+            process = subprocess.Popen(
+                [sys.executable, str(_run_izms), server_url, str(timings_path), '-c', str(tmp / 'config.json')],
+                stdout=log, stderr=subprocess.STDOUT
+            )
+            peak_rss = _wait(process)
+            elapsed = monotonic() - start
+        result = {'workers': workers, 'mode': mode, 'returncode': process.returncode, 'elapsed': elapsed,
+                  'peak_rss': peak_rss}
+        if process.returncode != 0:
+            result['log'] = (tmp / 'log.txt').read_text('utf-8', errors='replace')[-2000:]
+        if not timings_path.is_file():
+            return result
+        timings = json.loads(timings_path.read_text('utf-8')).values()
+    if timings:
+        latencies = [end - start for start, end in timings]
+        span = max(end for _, end in timings) - min(start for start, _ in timings)
+        result.update(mails=len(latencies), mails_per_sec=len(latencies) / span if span else 0.0,
+                      p50=percentile(latencies, 50), p99=percentile(latencies, 99))
+    return result
+
+
+def _format(result: Dict) -> str:
+    rss = '-' if result['peak_rss'] is None else f"{result['peak_rss'] / 2 ** 20:.0f} MiB"
+    if 'mails' not in result:
+        return f"{result['workers']:>7} {result['mode']:>6}  failed (exit {result['returncode']})"
+    status = '' if result['returncode'] == 0 else f"  failed (exit {result['returncode']})"
+    return (f"{result['workers']:>7} {result['mode']:>6} {result['mails']:>6} {result['mails_per_sec']:>9.1f} "
+            f"{result['p50'] * 1000:>8.0f} {result['p99'] * 1000:>8.0f} {rss:>9}{status}")
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the izms.py pipeline against a local mock server.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[4, 8, 16], help='max_workers values to run.')
+    parser.add_argument('--modes', nargs='+', choices=['file', 'embed'], default=['file', 'embed'])
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread')
+    parser.add_argument('--composer', choices=['tree', 'stream'], default='tree')
+    parser.add_argument('--compose-processes', type=int, default=None)
+    parser.add_argument('--json', type=Path, metavar='<file>', help='Also write the results to a JSON file.')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    options = {'engine': args.engine, 'composer': args.composer, 'compose_processes': args.compose_processes}
+    results = []
+    with MockServer(settings_from(args)) as server:
+        print(f'{args.mails} mails, {args.images_per_mail} images of {args.image_size} bytes each, '
+              f'latency {args.latency}s, error rate {args.error_rate}')
+        print(f"{'workers':>7} {'mode':>6} {'mails':>6} {'mails/sec':>9} {'p50 ms':>8} {'p99 ms':>8} {'peak RSS':>9}")
+        for workers in args.workers:
+            for mode in args.modes:
+                result = run(server.url, workers, mode, options)
+                results.append(result)
+                print(_format(result), flush=True)
+                if 'log' in result:
+                    print(result['log'], file=sys.stderr)
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2), 'utf-8')
+    return 0 if all(r['returncode'] == 0 for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
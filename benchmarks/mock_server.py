@@ -0,0 +1,178 @@
+"""Local stand-in for the mail API, web and image hosts
+
+Serves ``/v1/users``, paged ``/v1/inbox``, mail detail pages and images with the fields
+``IZONEMail`` reads, with configurable latency, error rate and payload sizes::
+
+    python benchmarks/mock_server.py --mails 1000 --latency 0.05 --error-rate 0.01
+"""
+import json
+import random
+import time
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+from typing import Optional
+from urllib.parse import urlparse, parse_qs
+
+_genesis = datetime(2021, 1, 1)
+
+
+@dataclass
+class MockSettings:
+    mails: int = 1000
+    per_page: int = 20
+    members: int = 12
+    latency: float = 0.0  # Seconds before each response
+    jitter: float = 0.0  # Up to this many seconds added to `latency` at random
+    error_rate: float = 0.0  # Fraction of responses answered with 503, which clients retry
+    detail_size: int = 4096  # Approximate bytes of text in each mail
+    images_per_mail: int = 2
+    image_size: int = 64 * 1024
+    seed: int = 0
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: 'MockServer'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes = b'', content_type: str = 'text/plain', headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, o):
+        self._send(200, json.dumps(o).encode('utf-8'), 'application/json')
+
+    def do_GET(self):
+        settings = self.server.settings
+        delay = settings.latency + (self.server.random.uniform(0, settings.jitter) if settings.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        if settings.error_rate and self.server.random.random() < settings.error_rate:
+            return self._send(503, headers=[('Retry-After', '0')])
+
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if url.path == '/v1/users':
+            return self._send_json({'user': self.server.user()})
+        if url.path == '/v1/inbox':
+            page = int(parse_qs(url.query).get('page', ['1'])[0])
+            return self._send_json(self.server.inbox(page))
+        if parts[0] == 'detail' and len(parts) == 2 and parts[1].isdigit():
+            return self._send(200, self.server.detail(int(parts[1])), 'text/html; charset=utf-8')
+        if parts[0] in ('img', 'profile'):
+            return self._send(200, self.server.image, 'image/jpeg')
+        self._send(404)
+
+
+class MockServer(ThreadingHTTPServer):
+    """Mail API, web and image hosts in one server, listening on `port` of localhost
+
+    The inbox holds `settings.mails` mails, the newest first. Use as a context manager to serve
+    on a background thread.
+    """
+    daemon_threads = True
+
+    def __init__(self, settings: Optional[MockSettings] = None, port: int = 0):
+        super(MockServer, self).__init__(('127.0.0.1', port), _Handler)
+        self.settings = settings or MockSettings()
+        self.random = random.Random(self.settings.seed)
+        self.image = self.random.randbytes(self.settings.image_size)
+        self._text = ''.join(self.random.choices('あいうえおかきくけこ abcdefg\n', k=self.settings.detail_size // 2))
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    @staticmethod
+    def user():
+        return {'id': 'u1', 'access_token': 'token', 'nickname': 'bench', 'gender': 'x', 'country_code': 'KR',
+                'prefecture_id': 0, 'birthday': '2000-01-01', 'member_id': 0}
+
+    def mail(self, i: int):
+        member = i % self.settings.members
+        return {
+            'id': f'm{i}',
+            'subject': f'Mail {i} <&>',
+            'content': f'Preview of mail {i}',
+            'receive_datetime': (_genesis + timedelta(minutes=i)).isoformat(' '),
+            'detail_url': f'{self.url}/detail/{i}',
+            'member': {'id': member, 'name': f'Member {member}', 'image_url': f'{self.url}/profile/{member}.jpg'},
+        }
+
+    def inbox(self, page: int):
+        per_page = self.settings.per_page
+        newest = self.settings.mails - (page - 1) * per_page
+        return {
+            'page': page,
+            'has_next_page': newest - per_page > 0,
+            'mails': [self.mail(i) for i in range(newest, max(newest - per_page, 0), -1)],
+        }
+
+    def detail(self, i: int) -> bytes:
+        member = i % self.settings.members
+        images = ''.join(f'<img src="/img/{member}/{i}/{n}.jpg" alt="">' for n in range(self.settings.images_per_mail))
+        return f'''<!DOCTYPE html>
+<html lang="ja"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width"><title>Mail</title>
+<link rel="stylesheet" href="/css/app.css"><script src="/js/app.js"></script></head>
+<body><div id="mail-detail"><p>{self._text}</p>{images}<script>var n = {i};</script></div></body></html>
+'''.encode('utf-8')
+
+    def __enter__(self):
+        self._thread = Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+def add_arguments(parser: ArgumentParser):
+    defaults = MockSettings()
+    parser.add_argument('--mails', type=int, default=defaults.mails, help='Number of mails in the inbox.')
+    parser.add_argument('--per-page', type=int, default=defaults.per_page, help='Mails per inbox page.')
+    parser.add_argument('--members', type=int, default=defaults.members, help='Number of members sending mails.')
+    parser.add_argument('--latency', type=float, default=defaults.latency, help='Seconds before each response.')
+    parser.add_argument('--jitter', type=float, default=defaults.jitter,
+                        help='Up to this many seconds added to the latency at random.')
+    parser.add_argument('--error-rate', type=float, default=defaults.error_rate,
+                        help='Fraction of responses answered with 503.')
+    parser.add_argument('--detail-size', type=int, default=defaults.detail_size, help='Bytes of text in each mail.')
+    parser.add_argument('--images-per-mail', type=int, default=defaults.images_per_mail)
+    parser.add_argument('--image-size', type=int, default=defaults.image_size, help='Bytes of each image.')
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+
+
+def settings_from(args) -> MockSettings:
+    return MockSettings(args.mails, args.per_page, args.members, args.latency, args.jitter, args.error_rate,
+                        args.detail_size, args.images_per_mail, args.image_size, args.seed)
+
+
+def main():
+    parser = ArgumentParser(description='Serve a mock mail API on localhost.')
+    parser.add_argument('--port', type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = MockServer(settings_from(args), args.port)
+    print(f'Serving {args.mails} mails on {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Run izms.py against a mock server, recording when the download of each mail starts and ends
+
+    python benchmarks/run_izms.py <server url> <timings file> -c <config file>
+
+The timings file maps mail ids to the ``time.monotonic`` values at which the mail detail was
+requested and at which its artifacts were saved.
+"""
+import atexit
+import json
+import sys
+from functools import wraps
+from pathlib import Path
+from time import monotonic
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import izms  # noqa: E402
+import pipeline  # noqa: E402
+from izonemail import PolicyFactory, IZONEMail, AsyncIZONEMail, MailComposer  # noqa: E402
+
+_started = {}
+_finished = {}
+
+
+def _record_start(f):
+    @wraps(f)
+    def wrapper(self, mail, *args, **kwargs):
+        _started[mail.id] = monotonic()
+        return f(self, mail, *args, **kwargs)
+    return wrapper
+
+
+def _record_start_async(f):
+    @wraps(f)
+    async def wrapper(self, mail, *args, **kwargs):
+        _started[mail.id] = monotonic()
+        return await f(self, mail, *args, **kwargs)
+    return wrapper
+
+
+def _record_end(f):
+    @wraps(f)
+    def wrapper(self, recipient, mail, *args, **kwargs):
+        result = f(self, recipient, mail, *args, **kwargs)
+        _finished[mail.id] = monotonic()
+        return result
+    return wrapper
+
+
+def _record_end_async(f):
+    @wraps(f)
+    async def wrapper(self, recipient, mail, *args, **kwargs):
+        result = await f(self, recipient, mail, *args, **kwargs)
+        _finished[mail.id] = monotonic()
+        return result
+    return wrapper
+
+
+def main():
+    url, timings_path = sys.argv[1:3]
+    for policy in PolicyFactory.policies():
+        policy['api_host'] = policy['app_host'] = url
+
+    IZONEMail.get_mail_detail = _record_start(IZONEMail.get_mail_detail)
+    AsyncIZONEMail.get_mail_detail = _record_start_async(AsyncIZONEMail.get_mail_detail)
+    for cls in (MailComposer, pipeline.ProcessComposer):
+        cls.compose = _record_end(cls.compose)
+        cls.compose_async = _record_end_async(cls.compose_async)
+
+    @atexit.register
+    def dump():
+        timings = {i: (_started[i], end) for i, end in _finished.items()}
+        Path(timings_path).write_text(json.dumps(timings), 'utf-8')
+
+    sys.argv = [izms.__file__] + sys.argv[3:]
+    return izms.main()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,38 +1,70 @@
+import asyncio
 import json
-import pickle
+import multiprocessing
+import signal
 import sys
-from argparse import ArgumentParser
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from datetime import datetime, timedelta
+from functools import partial
+from itertools import islice
 from pathlib import Path
+from threading import Event
+from time import monotonic, time
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
 from colorama import init, Fore, Style
 from easydict import EasyDict
-from tqdm import tqdm
 
-from adapters import TimeoutHTTPAdapter
+from adapters import TransportHTTPAdapter
 from izonemail import (
-    MailComposer,
-    InsertMailHeader,
-    RemoveAllMetaTags,
-    InsertAppMetadata,
-    RemoveAllStyleSheet,
-    DumpStyleSheet,
-    RemoveAllJS,
-    DumpAllImages,
-    DumpMailMarkup,
+    Policy,
+    ImageFetcher,
+    LocalImageFetcher,
+    RemoteArtifact,
+    AssetCache,
+    ArtifactWriter,
+    DeferredWriter,
+    PackWriter,
+    pack_key,
+    FSYNC_POLICIES,
+    metrics,
+    Transport,
+    PoolStats,
 )
-from izonemail import Profile, IZONEMail, SessionFactory, PolicyFactory
+from izonemail import Profile, IZONEMail, AsyncIZONEMail, SessionFactory, AsyncSessionFactory, PolicyFactory
+from izonemail import Inbox, Mail, User
 from options import Options, Option
+from pipeline import (
+    InboxCrawler,
+    AsyncInboxCrawler,
+    BackfillCrawler,
+    AsyncBackfillCrawler,
+    ThreadedDownloader,
+    AsyncDownloader,
+    ProcessComposer,
+    merge,
+    merge_async,
+)
+from profiler import Profiler
+from search import SearchIndex, archive_paths, extract_document, scan_archive
+from startup import checkpoint
+from store import IndexStore, CommitWatermark, ManifestEntry, RawStore
 from utils import (
     execute_handler as _execute_handler,
-    datetime_to_bytes,
-    bytes_to_datetime,
     is_ge_zero,
+    is_ge_zero_or_none,
     is_gt_zero,
     is_abspath,
     is_abspath_or_none,
+    is_one_of,
+    is_hour_range_or_none,
 )
 
+if TYPE_CHECKING:
+    from izonemail import MailComposer
+
 __title__ = 'IZ*ONE Mail Shelter'
 __url__ = 'https://github.com/coloriz/izone-mail-shelter'
 __version__ = '2021.05.29'
@@ -41,42 +73,805 @@ __author_email__ = 'nunu3041@gmail.com'
 __license__ = 'MIT'
 __copyright__ = 'Copyright 2021 coloriz'
 
+# Stages of a mail in the order they happen, as labeled in metrics
+STAGES = ('inbox', 'detail', 'parse', 'image', 'write')
+
+
+def create_composer(config: EasyDict, policy: Policy, fetcher: ImageFetcher, overwrite: bool = False,
+                    executor: Optional[ThreadPoolExecutor] = None, deferred: bool = False) -> 'MailComposer':
+    """Composer of the mails of a job, whose artifacts are saved by another composer if `deferred`"""
+    # The parsing stack is only imported once there are mails to compose
+    from izonemail import (
+        MailComposer,
+        StreamingMailComposer,
+        InsertMailHeader,
+        RemoveAllMetaTags,
+        InsertAppMetadata,
+        RemoveAllStyleSheet,
+        DumpStyleSheet,
+        RemoveAllJS,
+        DumpAllImages,
+        DumpMailMarkup,
+    )
+
+    composer_class = StreamingMailComposer if config.composer == 'stream' else MailComposer
+    if deferred:
+        writer = DeferredWriter(config.destination, fetcher)
+    elif config.pack:
+        writer = PackWriter(Path(config.destination) / config.pack, fetcher, config.max_workers, config.fsync,
+                            overwrite, executor)
+    else:
+        writer = ArtifactWriter(config.destination, fetcher, config.max_workers, config.fsync, overwrite, executor)
+    mail_composer = composer_class(config.destination, config.mail_path, writer)
+    mail_composer += RemoveAllMetaTags()
+    mail_composer += RemoveAllJS()
+    mail_composer += RemoveAllStyleSheet()
+    mail_composer += DumpAllImages(config.image_path)  # Shares a single traversal with the above
+    mail_composer += InsertAppMetadata()
+    mail_composer += DumpStyleSheet(policy.css, config.css_path)
+    mail_composer += InsertMailHeader(policy.mail_header, config.profile_image_path, fetcher)
+    mail_composer += DumpMailMarkup()
+    return mail_composer
+
+
+def create_job_options(name: str) -> Options:
+    """Options of a job, which inherits them from the top level of the configuration"""
+    job = Options(name)
+    job.add(Option('name', type=(str, type(None))))
+    job.add(Option('bundle_id', default='com.ca-smart.izonemail'))
+    job.add(Option('destination', default='incoming'))
+    job.add(Option('mail_path', required=True, validator=is_abspath))
+    job.add(Option('profile_image_path', default='/', type=(str, type(None)), validator=is_abspath_or_none))
+    job.add(Option('css_path', default='/css', type=(str, type(None)), validator=is_abspath_or_none))
+    job.add(Option('image_path', default='/img', type=(str, type(None)), validator=is_abspath_or_none))
+    job.add(Option('pack', type=(str, type(None))))
+    job.add(Option('head', default='HEAD'))
+    job.add(Option('index', default='INDEX'))
+    job.add(Option('database', type=(str, type(None))))
+    job.add(Option('search_index', default=True, type=bool))
+    job.add(Option('raw_cache', default='RAW.db', type=(str, type(None))))
+    profile = Options('profile', required=True)
+    for k in Profile.valid_keys():
+        profile.add(Option(k, required=Profile.is_required_key(k)))
+    job.add(profile)
+    return job
+
+
+def create_options() -> Options:
+    """Options shared by every job"""
+    root = Options('root')
+    root.add(Option('timeout', default=5, type=(int, float), validator=is_ge_zero))
+    root.add(Option('max_retries', default=3, type=int, validator=is_ge_zero))
+    root.add(Option('backoff_factor', default=0.5, type=(int, float), validator=is_ge_zero))
+    root.add(Option('latency_target', default=2, type=(int, float), validator=is_gt_zero))
+    root.add(Option('max_workers', default=8, type=int, validator=is_gt_zero))
+    root.add(Option('prefetch_pages', default=2, type=int, validator=is_gt_zero))
+    root.add(Option('backfill', default=True, type=bool))
+    root.add(Option('warm_up_connections', default=2, type=int, validator=is_ge_zero))
+    root.add(Option('engine', default='thread', validator=is_one_of('thread', 'asyncio')))
+    root.add(Option('composer', default='tree', validator=is_one_of('tree', 'stream')))
+    root.add(Option('compose_processes', type=(int, type(None)), validator=is_ge_zero_or_none))
+    root.add(Option('asset_cache_size', default=32, type=(int, float), validator=is_ge_zero))
+    root.add(Option('asset_cache_path', type=(str, type(None))))
+    root.add(Option('fsync', default='none', validator=is_one_of(*FSYNC_POLICIES)))
+    root.add(Option('checkpoint_every', default=100, type=int, validator=is_gt_zero))
+    root.add(Option('checkpoint_interval', default=10, type=(int, float), validator=is_gt_zero))
+    root.add(Option('metrics_path', type=(str, type(None))))
+    root.add(Option('prometheus_path', type=(str, type(None))))
+    root.add(Option('finish_hook'))
+    root.add(Option('watch_interval', default=60, type=(int, float), validator=is_gt_zero))
+    root.add(Option('watch_max_interval', default=900, type=(int, float), validator=is_gt_zero))
+    root.add(Option('watch_active_hours', type=(list, type(None)), validator=is_hour_range_or_none))
+    root.add(Option('watch_host', default='127.0.0.1'))
+    root.add(Option('watch_port', type=(int, type(None))))
+    root.add(Option('jobs', type=(list, type(None))))
+    return root
+
+
+def parse_config(config: Dict) -> Tuple[EasyDict, List[EasyDict]]:
+    """Validate `config`, returning its shared options and the full configuration of each job
+
+    Options of ``create_job_options`` set at the top level are inherited by every job of `jobs`,
+    or make the only job without it.
+    """
+    job_keys = {o.name for o in create_job_options('root')}
+    shared = {k: v for k, v in config.items() if k not in job_keys}
+    create_options().parse_options(shared)
+    inherited = {k: v for k, v in config.items() if k in job_keys}
+    jobs = []
+    for i, spec in enumerate(shared['jobs'] or [{}]):
+        if not isinstance(spec, dict):
+            raise TypeError(f"'jobs' must be a list of object, not {type(spec).__name__}")
+        # Parsing fills in defaults, which must not leak into the inherited objects
+        job = deepcopy({**inherited, **spec})
+        create_job_options(f'jobs[{i}]' if shared['jobs'] else 'root').parse_options(job)
+        jobs.append(EasyDict({**job, **{k: v for k, v in shared.items() if k != 'jobs'}}))
+    return EasyDict(shared), jobs
+
+
+class Job:
+    """Mails of a profile downloaded into their own destination, index and caches"""
+    def __init__(self, config: EasyDict, cwd: Path):
+        self.config = config
+        self.name = config.name or config.destination
+        self.policy = PolicyFactory.get(config.bundle_id)
+        self.database_path = cwd / (config.database or f'{config.index}.db')
+        self.raw_cache_path = config.raw_cache and cwd / config.raw_cache
+        self.profile = Profile({k: v for k, v in config.profile.items() if v})
+        self.app = IZONEMail(self.policy.api_host, self.profile)
+        self.async_app: Optional[AsyncIZONEMail] = None
+        self.index: Optional[IndexStore] = None
+        self.head: Optional[datetime] = None
+        self.raw_store: Optional[RawStore] = None
+        self.user: Optional[User] = None
+        self.first_page: Optional[Inbox] = None
+        self.cached_mails: List[Mail] = []
+        self.mail_composer: Optional['MailComposer'] = None
+        self.search_index: Optional[SearchIndex] = None
+        self.compose = None
+        self.compose_async = None
+        # Of the current download
+        self.watermark: Optional[CommitWatermark] = None
+        self.new_mails: List[Mail] = []  # As found
+        self.backfill = False  # Whether every page of the inbox is fetched at once
+        # Of every download
+        self.found = 0
+        self.downloaded = 0
+        self.committed = 0
+
+
+def check_distinct(jobs: List[Job]):
+    """Raise ValueError if jobs would write to the same destination, database or raw cache"""
+    owners = {}
+    for job in jobs:
+        for key, path in (('destination', Path(job.config.destination).resolve()),
+                          ('database', job.database_path), ('raw_cache', job.raw_cache_path)):
+            if path is None:
+                continue
+            other = owners.setdefault((key, path), job)
+            if other is not job:
+                raise ValueError(f"Jobs '{other.name}' and '{job.name}' must not share '{key}'")
+
+
+def load_config(path: Path, cwd: Path) -> Tuple[EasyDict, List[Job]]:
+    """Read and validate the configuration at `path`, with its shared options and jobs"""
+    config, job_configs = parse_config(json.loads(path.read_text('utf-8')))
+    jobs = [Job(c, cwd) for c in job_configs]
+    check_distinct(jobs)
+    return config, jobs
+
+
+def execute_finish_hook(config: EasyDict, *args):
+    if config.finish_hook is None:
+        return
+    returncode = _execute_handler(config.finish_hook, __title__, *args)
+    if returncode != 0:
+        print(f'⚠️ The return code of finish hook is non-zero ({hex(returncode)})', file=sys.stderr)
+
+
+class Shelter:
+    """Jobs of a configuration and the resources they share, kept open from one download to the next
+
+    Sessions and connection pools are opened first, while the fetcher, writers, composers and
+    compose processes are created with the first download. Every later download starts warm.
+    """
+    def __init__(self, config: EasyDict, jobs: List[Job], cwd: Path, offline: bool = False):
+        self.config = config
+        self.jobs = jobs
+        self._cwd = cwd
+        self._offline = offline
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._image_fetcher: Optional[ImageFetcher] = None
+        self._writer_executor: Optional[ThreadPoolExecutor] = None
+        self._composer: Optional[ProcessComposer] = None
+        self.adapters: List[TransportHTTPAdapter] = []
+        for job in jobs:
+            # Those of a previous shelter of the same jobs are closed already
+            job.index = job.raw_store = job.mail_composer = job.search_index = None
+        # What is opened before an error, e.g. while connecting, is closed again
+        try:
+            self._open()
+        except BaseException:
+            self.close()
+            raise
+
+    def _open(self):
+        config, jobs, cwd, offline = self.config, self.jobs, self._cwd, self._offline
+        # Index database of downloaded mails
+        for job in jobs:
+            job.index = IndexStore(job.database_path)
+            # Migrate from the legacy pickled INDEX and HEAD files, which are renamed once migrated,
+            # even if the database has been created already, e.g. by a search or a failed migration
+            head_path, index_path = cwd / job.config.head, cwd / job.config.index
+            if index_path.is_file() or head_path.is_file():
+                n = job.index.migrate(index_path, head_path)
+                print(f'📦 {self.label(job)}Migrated {n} mails from {index_path.name}, {head_path.name} '
+                      f'to {job.index.path.name}')
+            job.head = job.index.head or job.policy.genesis
+        self.print_heads()
+
+        # Global session options, shared by every job
+        # Per-host adaptive concurrency limits shared by every session
+        self.transport = Transport(max_limit=config.max_workers, latency_target=config.latency_target,
+                                   max_retries=config.max_retries, backoff_factor=config.backoff_factor)
+        # One connection pool per host. The downloader, image fetcher and writer threads all send requests,
+        # but the limiter of the host lets no more than its maximum be in flight, bodies included, so pools
+        # of that size never discard a connection
+        hosts = list(dict.fromkeys(h for job in jobs for h in (job.policy.api_host, job.policy.app_host)))
+        self.adapters = SessionFactory.mount(
+            lambda: TransportHTTPAdapter(self.transport, timeout=config.timeout, pool_maxsize=self.transport.max_limit),
+            hosts
+        )
+        AsyncSessionFactory.configure(timeout=config.timeout, transport=self.transport,
+                                      limit_per_host=self.transport.max_limit)
+        # Raw mail detail pages, to compose them again offline
+        for job in jobs:
+            job.raw_store = RawStore(job.raw_cache_path) if job.raw_cache_path else None
+            if offline and (job.raw_store is None or job.raw_store.recipient is None):
+                raise LookupError(f'{self.label(job)}No mail has been cached to render (raw_cache)')
+        if config.warm_up_connections and not offline:
+            session = SessionFactory.instance()
+            for host, adapter in zip(hosts, self.adapters[1:]):
+                # The settings requests are sent with, such as the CA bundle of the environment, select their pool
+                settings = session.merge_environment_settings(host, {}, None, None, None)
+                adapter.warm_up(host, config.warm_up_connections, settings['verify'], settings['proxies'],
+                                settings['cert'])
+
+    def label(self, job: Job) -> str:
+        return f'[{job.name}] ' if len(self.jobs) > 1 else ''
+
+    def print_heads(self):
+        for job in self.jobs:
+            print(f'📢 {self.label(job)}{Fore.CYAN}{Style.BRIGHT}HEAD -> {Fore.GREEN}{job.head.isoformat()}')
+
+    def retrieve_users(self):
+        """Check that the profiles are valid, or read back their recipients offline"""
+        if self._offline:
+            for job in self.jobs:
+                job.user = job.raw_store.recipient
+                job.cached_mails = job.raw_store.mails()
+            return
+        print(f'\n{Fore.BLUE}==>{Fore.RESET}{Style.BRIGHT} Retrieving user information')
+        for job in self.jobs:
+            user = job.user = job.app.get_user()
+            print(f'{self.label(job)}{user.id} / {user.nickname} / {user.gender} / {user.country_code} / '
+                  f'{user.birthday}')
+            if job.raw_store is not None:
+                job.raw_store.recipient = user
+
+    def poll(self, verbose: bool = True) -> List[Job]:
+        """Jobs with new mails, as told by the first page of their inbox"""
+        if self._offline:
+            return self.jobs
+        if verbose:
+            print(f'\n{Fore.MAGENTA}==>{Fore.RESET}{Style.BRIGHT} Retrieving new mails from inbox')
+        active = []
+        for job in self.jobs:
+            # The first page is enough to tell whether we are up-to-date
+            job.first_page = job.app.get_inbox(1)
+            if job.first_page and job.first_page[0].id not in job.index:
+                active.append(job)
+            elif verbose:
+                print(f'{self.label(job)}Already up-to-date.')
+        return active
+
+    def _start(self):
+        config = self.config
+        # Profile images are downloaded once and shared by every mail of the member
+        asset_cache = AssetCache(int(config.asset_cache_size * 2 ** 20),
+                                 config.asset_cache_path and self._cwd / config.asset_cache_path)
+        if self._offline:
+            def read_asset(url):
+                for job in self.jobs:
+                    data = job.raw_store.read_asset(url)
+                    if data is not None:
+                        return data
+                return None
+
+            # Images are read back from where they were saved, even if their path has changed since
+            self._image_fetcher = LocalImageFetcher(read_asset, config.max_workers, asset_cache, self.transport)
+        else:
+            self._image_fetcher = ImageFetcher(config.max_workers, asset_cache, self.transport)
+        # Artifacts of every job are written on a single pool
+        self._writer_executor = ThreadPoolExecutor(max_workers=config.max_workers, thread_name_prefix='ArtifactWriter')
+        for job in self.jobs:
+            self._prepare(job)
+        # Parse and rewrite mails on other cores, making requests on the download workers
+        if config.compose_processes != 0:
+            # Workers only render mails, leaving the artifacts to the writers of this process
+            self._composer = ProcessComposer([partial(create_composer, job.config, job.policy, deferred=True)
+                                              for job in self.jobs],
+                                             [job.mail_composer for job in self.jobs], config.compose_processes)
+        for i, job in enumerate(self.jobs):
+            if self._composer is not None:
+                job.compose = partial(self._composer.compose, job=i)
+                job.compose_async = partial(self._composer.compose_async, job=i)
+            else:
+                job.compose = job.mail_composer.compose
+                job.compose_async = job.mail_composer.compose_async
+
+    def _prepare(self, job: Job):
+        # Mails are written again when rendering
+        job.mail_composer = create_composer(job.config, job.policy, self._image_fetcher, self._offline,
+                                            self._writer_executor)
+        writer = job.mail_composer.writer
+        artifact_root = Path(job.config.destination)
+        if job.config.pack:
+            artifact_root /= job.config.pack
+        artifact_root = artifact_root.resolve()
+
+        def on_saved(artifact, size, digest):
+            url = artifact.url if isinstance(artifact, RemoteArtifact) else None
+            # Committed to the manifest along with the mails
+            job.watermark.record(ManifestEntry(artifact.path.as_posix(), size, digest, url))
+            if url is not None and job.raw_store is not None:
+                job.raw_store.add_asset(url, artifact_root, pack_key(artifact.path))
+
+        writer.on_saved = on_saved
+        # Files left truncated are written again
+        writer.expected_size = lambda path: job.index.artifact_size(path.as_posix())
+        job.search_index = SearchIndex(job.database_path) if job.config.search_index else None
+
+    def _watermark(self, job: Job) -> CommitWatermark:
+        def index_text(entries):
+            # Mails are indexed from their saved markup, as they may have been composed in other processes
+            try:
+                job.search_index.add(extract_document(pack_key(Path(p)), job.mail_composer.writer.read(Path(p)))
+                                     for _, p in entries)
+            except Exception as e:
+                # The mails are saved already, and the index can be rebuilt from them
+                print(f"⚠️ {self.label(job)}Failed to index {len(entries)} mails for search ({e}), "
+                      f"run 'izms.py index' to add them", file=sys.stderr)
+
+        return CommitWatermark(job.index, lambda m: job.mail_composer.mail_path(m).as_posix(),
+                               self.config.checkpoint_every, self.config.checkpoint_interval,
+                               index_text if job.search_index is not None else None)
+
+    def download(self, jobs: List[Job], profiler: Optional[Profiler] = None) -> int:
+        """Download the new mails of `jobs` since their last poll, returning the number of downloaded mails"""
+        if self._writer_executor is None:
+            self._start()
+        config = self.config
+        from tqdm import tqdm
+
+        start = monotonic()
+        pbar = tqdm(total=0)
+        crawling = len(jobs)
+        downloaded = 0
+        for job in jobs:
+            job.new_mails = []
+            job.watermark = self._watermark(job)
+            # Without any known mail, as on the first download, the whole inbox is new
+            job.backfill = config.backfill and not len(job.index)
+
+        def on_found(job, mail):
+            pbar.write(f'💌 {self.label(job)}Found new mail {mail.id}: {mail.member.name} / {mail.subject} / '
+                       f'{mail.received}')
+            job.new_mails.append(mail)
+            job.found += 1
+            pbar.total += 1
+            pbar.refresh()
+
+        def on_downloaded(job, mail):
+            nonlocal downloaded
+            pbar.set_description(f'Processing {mail.id}')
+            pbar.update()
+            job.downloaded += 1
+            downloaded += 1
+            job.watermark.complete(mail)
+
+        def on_crawled(job):
+            nonlocal crawling
+            # The oldest new mail is only known once the crawl has caught up,
+            # so nothing can be committed in order before that. A backfill may find some late
+            job.watermark.set_order(sorted(job.new_mails, key=lambda m: (m.received, m.id)))
+            crawling -= 1
+            if profiler and not crawling:
+                profiler.snapshot('crawled')
+
+        def mail_order(item):
+            # Mails of every job are downloaded from the oldest one
+            return item[1].received, item[1].id
+
+        def download_threaded():
+            def discover(job):
+                if job.backfill:
+                    crawler = BackfillCrawler(job.app, job.index.__contains__, config.max_workers, job.first_page)
+                else:
+                    crawler = InboxCrawler(job.app, job.index.__contains__, config.prefetch_pages, job.first_page)
+                for mail in crawler:
+                    on_found(job, mail)
+                    yield job, mail
+                if crawler.completed:
+                    on_crawled(job)
+
+            def process_mail(item):
+                job, mail = item
+                mail_detail = job.app.get_mail_detail(mail)
+                if job.raw_store is not None:
+                    job.raw_store.put(mail, mail_detail)
+                job.compose(job.user, mail, mail_detail)
+                return item
+
+            downloader = ThreadedDownloader(process_mail, config.max_workers, mail_order)
+            for job, mail in downloader.run(merge([discover(job) for job in jobs])):
+                on_downloaded(job, mail)
+
+        def render_offline():
+            for job in jobs:
+                job.new_mails.extend(job.cached_mails)
+                job.found += len(job.cached_mails)
+                pbar.total += len(job.cached_mails)
+                on_crawled(job)
+
+            def process_mail(item):
+                job, mail = item
+                job.compose(job.user, mail, job.raw_store.body(mail.id))
+                return item
+
+            mails = [(job, mail) for job in jobs for mail in job.cached_mails]
+            for job, mail in ThreadedDownloader(process_mail, config.max_workers, mail_order).run(mails):
+                on_downloaded(job, mail)
+
+        async def download_async():
+            async def discover(job):
+                if job.backfill:
+                    crawler = AsyncBackfillCrawler(job.async_app, job.index.__contains__, job.first_page)
+                else:
+                    crawler = AsyncInboxCrawler(job.async_app, job.index.__contains__, config.prefetch_pages,
+                                                job.first_page)
+                async for mail in crawler:
+                    on_found(job, mail)
+                    yield job, mail
+                if crawler.completed:
+                    on_crawled(job)
+
+            async def process_mail(item):
+                job, mail = item
+                mail_detail = await job.async_app.get_mail_detail(mail)
+                if job.raw_store is not None:
+                    job.raw_store.put(mail, mail_detail)
+                await job.compose_async(job.user, mail, mail_detail)
+                return item
+
+            for job in jobs:
+                if job.async_app is None:
+                    job.async_app = AsyncIZONEMail(job.policy.api_host, job.profile)
+            downloader = AsyncDownloader(process_mail, config.max_workers, mail_order)
+            async for job, mail in downloader.run(merge_async([discover(job) for job in jobs])):
+                on_downloaded(job, mail)
+
+        try:
+            if self._offline:
+                render_offline()
+            elif config.engine == 'asyncio':
+                # The loop, hence the connections of the session, outlives the download
+                if self._loop is None:
+                    self._loop = asyncio.new_event_loop()
+                self._loop.run_until_complete(download_async())
+            else:
+                download_threaded()
+        finally:
+            pbar.close()
+            if profiler:
+                profiler.snapshot('downloaded')
+            # Any mail that has been downloaded after error occured is not committed
+            for job in jobs:
+                job.watermark.flush()
+                job.committed += job.watermark.committed
+                job.head = job.index.head or job.head
+            metrics.set('mails', sum(job.found for job in self.jobs), state='found')
+            metrics.set('mails', sum(job.downloaded for job in self.jobs), state='downloaded')
+            metrics.set('mails', sum(job.committed for job in self.jobs), state='committed')
+            metrics.set('run_duration_seconds', monotonic() - start)
+            metrics.set('last_run_timestamp_seconds', time())
+            metrics.dump(config.metrics_path and self._cwd / config.metrics_path,
+                         config.prometheus_path and self._cwd / config.prometheus_path)
+        return downloaded
+
+    def verify(self, repair: bool = True) -> int:
+        """Check the artifacts of every job against their manifest, writing the damaged ones again if `repair`
+
+        Images are downloaded again from where they were, and mails composed again from the raw
+        cache, or else from the inbox. Returns the number of damaged artifacts.
+        """
+        from tqdm import tqdm
+        from verify import verify_archive
+
+        damaged: Dict[Job, List[ManifestEntry]] = {}
+        for job in self.jobs:
+            destination = Path(job.config.destination).resolve()
+            pack = job.config.pack and destination / job.config.pack
+            entries = job.index.manifest()
+            print(f'\n{Fore.BLUE}==>{Fore.RESET}{Style.BRIGHT} {self.label(job)}Verifying {len(entries)} artifacts')
+            checked = verify_archive(destination, entries, pack, self.config.compose_processes or None)
+            with tqdm(total=len(entries)) as pbar:
+                for entry, problem in checked:
+                    pbar.update()
+                    if problem is not None:
+                        pbar.write(f'❌️ {self.label(job)}{problem}: {entry.path}')
+                        damaged.setdefault(job, []).append(entry)
+        n = sum(len(entries) for entries in damaged.values())
+        print(f'Damaged: {n}')
+        if not repair or not n:
+            return n
+
+        print(f'\n{Fore.GREEN}==>{Fore.RESET}{Style.BRIGHT} Repairing damaged artifacts')
+        if self._writer_executor is None:
+            self._start()
+        mails = []
+        for job, entries in damaged.items():
+            job.watermark = self._watermark(job)
+            writer = job.mail_composer.writer
+            for entry in entries:
+                writer.discard(Path(entry.path))
+            writer.write([RemoteArtifact(Path(e.path), e.url) for e in entries if e.url is not None])
+            # Markup, and the style sheet written along with any mail
+            mail_ids = {job.index.mail_at(e.path) or job.index.newest_mail() for e in entries if e.url is None}
+            mail_ids.discard(None)
+            if not mail_ids:
+                continue
+            if job.user is None:
+                job.user = job.raw_store and job.raw_store.recipient or job.app.get_user()
+            cached = {m.id: m for m in job.raw_store.mails()} if job.raw_store is not None else {}
+            mails += [(job, cached[i], job.raw_store.body(i)) for i in mail_ids if i in cached]
+            mail_ids -= cached.keys()
+            if mail_ids:
+                # Not cached, so found again in the inbox
+                for mail in BackfillCrawler(job.app, lambda _: False, self.config.max_workers):
+                    if mail.id in mail_ids:
+                        mails.append((job, mail, None))
+                        mail_ids.discard(mail.id)
+                        if not mail_ids:
+                            break
+            for i in mail_ids:
+                print(f'⚠️ {self.label(job)}Mail {i} is neither cached nor in the inbox anymore', file=sys.stderr)
+
+        def process_mail(item):
+            job, mail, body = item
+            if body is None:
+                body = job.app.get_mail_detail(mail)
+                if job.raw_store is not None:
+                    job.raw_store.put(mail, body)
+            job.compose(job.user, mail, body)
+            return item
+
+        def mail_order(item):
+            return item[1].received, item[1].id
+
+        try:
+            for _ in ThreadedDownloader(process_mail, self.config.max_workers, mail_order).run(mails):
+                pass
+        finally:
+            for job in damaged:
+                job.watermark.flush()
+        print(f'Composed again: {len(mails)} mails')
+        return n
+
+    def close(self):
+        if self._composer is not None:
+            self._composer.shutdown()
+        for job in self.jobs:
+            if job.mail_composer is not None:
+                job.mail_composer.writer.shutdown()
+        if self._writer_executor is not None:
+            self._writer_executor.shutdown(wait=True, cancel_futures=True)
+        if self._image_fetcher is not None:
+            self._image_fetcher.shutdown()
+        if self._loop is not None:
+            self._loop.run_until_complete(AsyncSessionFactory.instance().close())
+            self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+            self._loop.close()
+        for adapter in self.adapters:
+            adapter.close()
+        for job in self.jobs:
+            if job.raw_store is not None:
+                job.raw_store.close()
+            if job.index is not None:
+                job.index.close()
+            if job.search_index is not None:
+                job.search_index.close()
+
+    def summary(self, profiler: Optional[Profiler] = None):
+        print(f'\n{Fore.CYAN}==>{Fore.RESET}{Style.BRIGHT} Summary')
+        print(f'Total: {sum(job.found for job in self.jobs)} / '
+              f'Downloaded: {sum(job.downloaded for job in self.jobs)} / '
+              f'Committed: {sum(job.committed for job in self.jobs)}')
+        if len(self.jobs) > 1:
+            for job in self.jobs:
+                print(f'  {self.label(job)}Total: {job.found} / Downloaded: {job.downloaded} / '
+                      f'Committed: {job.committed}')
+        print('In-flight limits: ' + ', '.join(f'{h} = {n}' for h, n in self.transport.limits().items()))
+        pool_stats = PoolStats()
+        for adapter in self.adapters:
+            pool_stats += adapter.stats
+        if self._loop is not None:
+            # Without the asyncio engine, no session has been opened (nor aiohttp imported)
+            pool_stats += AsyncSessionFactory.instance().stats
+        print(f'Connections: {pool_stats}')
+        for job in self.jobs:
+            if job.mail_composer is None:
+                continue
+            writer = job.mail_composer.writer
+            print(f'{self.label(job)}Written: {writer.stats}')
+            if isinstance(writer, PackWriter):
+                print(f'{self.label(job)}Packed into {writer.pack.path} / deduplicated: {writer.pack.deduplicated}')
+        stage_times = {s: metrics.histogram('stage_seconds', stage=s) for s in STAGES}
+        print('Stages: ' + ', '.join(f'{s} = {h.count} x {h.sum / h.count * 1000:.1f}ms'
+                                     for s, h in stage_times.items() if h))
+        if profiler:
+            print(f'Profile: {profiler.directory}')
+        self.print_heads()
+
+
+def search(database_path: Path, args: Namespace) -> int:
+    search_index = SearchIndex(database_path)
+    start = monotonic()
+    hits = search_index.search(' '.join(args.text), args.member, args.since, args.until, args.limit)
+    elapsed = monotonic() - start
+    search_index.close()
+    for hit in hits:
+        print(f'{Fore.CYAN}{hit.received:%Y-%m-%d %H:%M}{Fore.RESET} {Style.BRIGHT}{hit.member}{Style.RESET_ALL} / '
+              f'{hit.subject}')
+        print(f'  {Fore.GREEN}{hit.path}{Fore.RESET}')
+        print(f'  {hit.snippet}')
+    print(f'{len(hits)} mails found in {elapsed * 1000:.1f}ms')
+    return 0
+
+
+def build_search_index(config: EasyDict, database_path: Path, args: Namespace) -> int:
+    from tqdm import tqdm
+
+    search_index = SearchIndex(database_path)
+    if args.rebuild:
+        search_index.clear()
+    destination = Path(config.destination)
+    pack = config.pack and destination / config.pack
+    indexed = set(search_index.paths())
+    paths = [p for p in archive_paths(destination, pack) if p not in indexed]
+    documents = scan_archive(destination, paths, pack, config.compose_processes or None)
+    n = 0
+    with tqdm(total=len(paths)) as pbar:
+        # Committed in batches, so that an interrupted build is resumed
+        while batch := list(islice(documents, 500)):
+            n += search_index.add(batch)
+            pbar.update(len(batch))
+    search_index.close()
+    print(f'Indexed {n} mails / total: {len(indexed) + n}')
+    return 0
+
+
+def watch(config_path: Path, cwd: Path, config: EasyDict, jobs: List[Job]) -> int:
+    """Poll the inboxes and download new mails as soon as they appear, until interrupted or terminated
+
+    The configuration is read again whenever its file changes, and kept as it was if invalid.
+    """
+    from watch import PollSchedule, serve_health
+
+    stop = Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    shelter: Optional[Shelter] = None
+    schedule = PollSchedule(config.watch_interval, config.watch_max_interval, config.watch_active_hours)
+    mtime = config_path.stat().st_mtime
+    status = {'healthy': True, 'started': datetime.now(), 'polls': 0, 'last_poll': None, 'last_error': None,
+              'next_poll': None, 'downloaded': 0}
+
+    def get_status():
+        heads = {job.name: job.head for job in shelter.jobs} if shelter is not None else {}
+        return {**status, 'heads': heads}
+
+    def open_server():
+        if config.watch_port is None:
+            return None
+        print(f'Serving /health and /metrics on http://{config.watch_host}:{config.watch_port}/')
+        return serve_health(config.watch_host, config.watch_port, get_status)
+
+    server = open_server()
+    print(f'\n{Fore.BLUE}==>{Fore.RESET}{Style.BRIGHT} Watching for new mails')
+    try:
+        while not stop.is_set():
+            try:
+                modified = config_path.stat().st_mtime
+                if modified != mtime:
+                    mtime = modified
+                    reloaded = load_config(config_path, cwd)
+                    print(f'{Fore.YELLOW}==>{Fore.RESET}{Style.BRIGHT} Reloaded configuration')
+                    if shelter is not None:
+                        shelter.close()
+                        shelter = None
+                    address = (config.watch_host, config.watch_port)
+                    config, jobs = reloaded
+                    schedule = PollSchedule(config.watch_interval, config.watch_max_interval,
+                                            config.watch_active_hours)
+                    if (config.watch_host, config.watch_port) != address:
+                        if server is not None:
+                            server.shutdown()
+                            server.server_close()
+                        server = open_server()
+            except (OSError, KeyError, TypeError, ValueError) as e:
+                print(f"❌️ {e}", file=sys.stderr)
+
+            found = False
+            try:
+                if shelter is None:
+                    # Kept only once the users are known, so that a failure is retried on the next poll
+                    opened = Shelter(config, jobs, cwd)
+                    try:
+                        opened.retrieve_users()
+                    except BaseException:
+                        opened.close()
+                        raise
+                    shelter = opened
+                active = shelter.poll(verbose=False)
+                status['polls'] += 1
+                status['last_poll'] = datetime.now()
+                metrics.add('polls_total')
+                if active:
+                    found = True
+                    print(f'\n{Fore.GREEN}==>{Fore.RESET}{Style.BRIGHT} Downloading new mails '
+                          f'({datetime.now():%Y-%m-%d %H:%M:%S})')
+                    n = shelter.download(active)
+                    status['downloaded'] += n
+                    shelter.print_heads()
+                    execute_finish_hook(config, n)
+                status['healthy'] = True
+                status['last_error'] = None
+            except Exception as e:
+                status['healthy'] = False
+                status['last_error'] = f'{type(e).__name__}: {e}'
+                metrics.add('poll_errors_total')
+                print(f'⚠️ {datetime.now():%Y-%m-%d %H:%M:%S} {status["last_error"]}', file=sys.stderr)
+
+            interval = schedule.next(found)
+            status['next_poll'] = datetime.now() + timedelta(seconds=interval)
+            metrics.set('poll_interval_seconds', interval)
+            stop.wait(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        if shelter is not None:
+            shelter.close()
+            shelter.summary()
+    return 0
+
 
 def main():
+    checkpoint('configuration')
     cwd = Path(sys.argv[0]).resolve().parent
     default_config_path = cwd / 'config.json'
     parser = ArgumentParser(description=f'{__title__} v{__version__} by {__author__}')
     parser.add_argument('-c', '--config', default=default_config_path, type=Path, metavar='<file>',
                         help='Specify a JSON-format text file to read user configurations from.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the download of new mails with cProfile and tracemalloc, '
+                             'writing the reports next to the destination directory.')
+    commands = parser.add_subparsers(dest='command', metavar='<command>',
+                                     help='Command to run instead of downloading new mails.')
+    search_parser = commands.add_parser('search', help='Search the downloaded mails.')
+    search_parser.add_argument('text', nargs='*', help='Terms which must all appear in the mails.')
+    search_parser.add_argument('-m', '--member', metavar='<id or name>')
+    search_parser.add_argument('--since', type=datetime.fromisoformat, metavar='<YYYY-MM-DD>')
+    search_parser.add_argument('--until', type=datetime.fromisoformat, metavar='<YYYY-MM-DD>',
+                               help='Exclusive end of the received date range.')
+    search_parser.add_argument('-n', '--limit', type=int, default=20)
+    index_parser = commands.add_parser('index', help='Index the mails already downloaded for search.')
+    index_parser.add_argument('--rebuild', action='store_true', help='Index every mail again.')
+    commands.add_parser('render', help='Compose the cached mails again with the current configuration, '
+                                       'without requesting them.')
+    commands.add_parser('watch', help='Keep running, downloading new mails as soon as they appear.')
+    verify_parser = commands.add_parser('verify', help='Check the downloaded files against the sizes and digests '
+                                                       'they were written with, downloading the damaged ones again.')
+    verify_parser.add_argument('--dry-run', action='store_true', help='Only report the damaged files.')
     args = parser.parse_args()
 
     print(f'{__title__} version {__version__} ({__url__})\n')
     # Parse user config
-    config_path = args.config
     print(f'{Fore.YELLOW}==>{Fore.RESET}{Style.BRIGHT} Parsing configuration')
-    # Validate config
-    root = Options('root')
-    root.add(Option('bundle_id', default='com.ca-smart.izonemail'))
-    root.add(Option('destination', default='incoming'))
-    root.add(Option('mail_path', required=True, validator=is_abspath))
-    root.add(Option('profile_image_path', default='/', type=(str, type(None)), validator=is_abspath_or_none))
-    root.add(Option('css_path', default='/css', type=(str, type(None)), validator=is_abspath_or_none))
-    root.add(Option('image_path', default='/img', type=(str, type(None)), validator=is_abspath_or_none))
-    root.add(Option('timeout', default=5, type=(int, float), validator=is_ge_zero))
-    root.add(Option('max_retries', default=3, type=int, validator=is_ge_zero))
-    root.add(Option('max_workers', default=8, type=int, validator=is_gt_zero))
-    root.add(Option('head', default='HEAD'))
-    root.add(Option('index', default='INDEX'))
-    root.add(Option('finish_hook'))
-    profile = Options('profile', required=True)
-    for k in Profile.valid_keys():
-        profile.add(Option(k, required=Profile.is_required_key(k)))
-    root.add(profile)
-
     try:
-        config = EasyDict(json.loads(config_path.read_text('utf-8')))
-        root.parse_options(config)
-        policy = PolicyFactory.get(config.bundle_id)
+        config, jobs = load_config(args.config, cwd)
     except FileNotFoundError as e:
         print(f"❌️ File '{e.filename}' missing!", file=sys.stderr)
         return -1
@@ -84,115 +879,82 @@ def main():
         print(f"❌️ {e}", file=sys.stderr)
         return -2
 
-    # Print parsed config
-    print(json.dumps(config, indent=4))
-
-    # File containing local last mail timestamp
-    head_path = cwd / config.head
-    head = bytes_to_datetime(head_path.read_bytes()) if head_path.is_file() else policy.genesis
-    print(f'📢 {Fore.CYAN}{Style.BRIGHT}HEAD -> {Fore.GREEN}{head.isoformat()}')
-    # Index file
-    index_path = cwd / config.index
-    index = pickle.loads(index_path.read_bytes()) if index_path.is_file() else set()
-
-    def execute_handler(*args):
-        finish_hook = config.finish_hook
-        if finish_hook is None:
-            return
-        returncode = _execute_handler(finish_hook, __title__, *args)
-        if returncode != 0:
-            print(f'⚠️ The return code of finish hook is non-zero ({hex(returncode)})', file=sys.stderr)
-
-    # Global session options
-    s = SessionFactory.instance()
-    adapter = TimeoutHTTPAdapter(timeout=config.timeout, max_retries=config.max_retries)
-    s.mount('https://', adapter)
-    s.mount('http://', adapter)
-    # IZ*ONE Private Mail client
-    app = IZONEMail(policy.api_host, Profile({k: v for k, v in config.profile.items() if v}))
-
-    # Check if profile is valid
-    print(f'\n{Fore.BLUE}==>{Fore.RESET}{Style.BRIGHT} Retrieving user information')
-    user = app.get_user()
-    print(f'{user.id} / {user.nickname} / {user.gender} / {user.country_code} / {user.birthday}')
-
-    # Retrieve the list of new mails
-    print(f'\n{Fore.MAGENTA}==>{Fore.RESET}{Style.BRIGHT} Retrieving new mails from inbox')
-    new_mails = []
-    caught_up = False
-    page = 1
-
-    while True:
-        inbox = app.get_inbox(page)
-        for mail in inbox:
-            if mail.id in index:
-                caught_up = True
-                break
-            print(f'💌 Found new mail {mail.id}: {mail.member.name} / {mail.subject} / {mail.received}')
-            new_mails.append(mail)
-        # If we caught up or this inbox was the last one, break the loop
-        if caught_up or not inbox.has_next_page:
-            break
-        page += 1
-
-    if not new_mails:
-        print('Already up-to-date.')
-        execute_handler(0)
+    if args.command in ('search', 'index'):
+        for job in jobs:
+            if len(jobs) > 1:
+                print(f'\n{Fore.BLUE}==>{Fore.RESET}{Style.BRIGHT} {job.name}')
+            if args.command == 'search':
+                search(job.database_path, args)
+            else:
+                build_search_index(job.config, job.database_path, args)
         return 0
 
-    # Reverse order (from the oldest)
-    new_mails = new_mails[::-1]
-    n_total = len(new_mails)
-    print(f'{n_total} new mails are available.')
-
-    # Start downloading mails
-    print(f'\n{Fore.GREEN}==>{Fore.RESET}{Style.BRIGHT} Downloading new mails')
-    # Create mail composer
-    mail_composer = MailComposer(config.destination, config.mail_path)
-    mail_composer += RemoveAllMetaTags()
-    mail_composer += RemoveAllJS()
-    mail_composer += RemoveAllStyleSheet()
-    mail_composer += InsertAppMetadata()
-    mail_composer += DumpStyleSheet(policy.css, config.css_path)
-    mail_composer += DumpAllImages(config.image_path)
-    mail_composer += InsertMailHeader(policy.mail_header, config.profile_image_path)
-    mail_composer += DumpMailMarkup()
+    # Print parsed config
+    print(json.dumps(jobs[0].config if len(jobs) == 1 else [job.config for job in jobs], indent=4))
 
-    downloaded_mails = set()
+    if args.command == 'watch':
+        if args.profile:
+            print('⚠️ Watching is not profiled', file=sys.stderr)
+        return watch(args.config, cwd, config, jobs)
 
-    def process_mail(mail):
-        mail_detail = app.get_mail_detail(mail)
-        mail_composer.compose(user, mail, mail_detail)
-        return mail
+    if args.command == 'verify':
+        shelter = Shelter(config, jobs, cwd)
+        try:
+            damaged = shelter.verify(repair=not args.dry_run)
+        finally:
+            shelter.close()
+        return 1 if damaged and args.dry_run else 0
 
-    executor = ThreadPoolExecutor(max_workers=config.max_workers)
-    futures = [executor.submit(process_mail, mail) for mail in new_mails]
-    pbar = tqdm(as_completed(futures), total=n_total)
+    offline = args.command == 'render'
+    checkpoint('sessions')
+    try:
+        shelter = Shelter(config, jobs, cwd, offline)
+    except LookupError as e:
+        print(f'❌️ {e}', file=sys.stderr)
+        return -3
+    checkpoint('user')
+    shelter.retrieve_users()
+    checkpoint('inbox')
+    active = shelter.poll()
+    if not active:
+        checkpoint('close')
+        shelter.close()
+        execute_finish_hook(config, 0)
+        return 0
 
+    # Start downloading mails while the rest of inbox is being crawled
+    profiler = None
+    if args.profile:
+        destination = Path(jobs[0].config.destination).resolve()
+        run_name = datetime.now().strftime('%Y%m%d-%H%M%S')
+        profiler = Profiler(destination.with_name(f'{destination.name}.profile') / run_name)
+        if config.compose_processes != 0:
+            print('⚠️ Mails composed in other processes are not profiled, unless compose_processes is 0',
+                  file=sys.stderr)
+        profiler.start()
+    if offline:
+        print(f'\n{Fore.GREEN}==>{Fore.RESET}{Style.BRIGHT} Rendering '
+              f'{sum(len(job.cached_mails) for job in jobs)} cached mails')
+    else:
+        print(f'\n{Fore.GREEN}==>{Fore.RESET}{Style.BRIGHT} Downloading new mails')
+    downloaded = 0
+    checkpoint('download')
     try:
-        for future in pbar:
-            mail = future.result()
-            pbar.set_description(f'Processing {mail.id}')
-            downloaded_mails.add(mail)
+        downloaded = shelter.download(active, profiler)
     finally:
-        executor.shutdown(wait=True, cancel_futures=True)
-        # Discard any mail that has been downloaded after error occured
-        for mail in new_mails:
-            if mail not in downloaded_mails:
-                break
-            head = mail.received
-            index.add(mail.id)
-        head_path.write_bytes(datetime_to_bytes(head))
-        index_path.write_bytes(pickle.dumps(index))
-        print(f'\n{Fore.CYAN}==>{Fore.RESET}{Style.BRIGHT} Summary')
-        print(f'Total: {n_total} / Downloaded: {len(downloaded_mails)}')
-        print(f'📢 {Fore.CYAN}{Style.BRIGHT}HEAD -> {Fore.GREEN}{head.isoformat()}')
+        checkpoint('close')
+        shelter.close()
+        if profiler:
+            profiler.stop()
+        shelter.summary(profiler)
 
     print(f'\n🎉 {__title__} is up to date.')
-    execute_handler(len(downloaded_mails))
+    if not offline:
+        execute_finish_hook(config, downloaded)
     return 0
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     init(autoreset=True)
     sys.exit(main())
@@ -1,23 +1,55 @@
+from importlib import import_module
+
 from .__version__ import (
     __title__, __description__, __url__, __version__,
     __author__, __author_email__, __license__, __copyright__,
 )
-from .models import Profile, User, Member, Team, Group, Mail, Inbox, ComposerPayload
-from .commands import (
-    ICommand,
-    InsertMailHeaderCommand as InsertMailHeader,
-    RemoveAllMetaTagsCommand as RemoveAllMetaTags,
-    InsertAppMetadataCommand as InsertAppMetadata,
-    RemoveAllStyleSheetCommand as RemoveAllStyleSheet,
-    DumpStyleSheetCommand as DumpStyleSheet,
-    RemoveAllJSCommand as RemoveAllJS,
-    DumpAllImagesCommand as DumpAllImages,
-    DumpMailMarkupCommand as DumpMailMarkup
+from .models import (
+    Policy, Profile, User, Member, Team, Group, Mail, Inbox, ComposerPayload, Artifact, MarkupArtifact, RemoteArtifact,
 )
-from .composer import MailComposer
-from .izonemail import IZONEMail
+from .fetcher import ImageFetcher, LocalImageFetcher, DeferredFetcher
+from .cache import Asset, AssetCache
+from .writer import ArtifactWriter, DeferredWriter, WriterStats, FSYNC_POLICIES
+from .pack import Pack, PackWriter, pack_key
+from .metrics import Metrics, Histogram, metrics
+from .transport import Transport, AIMDLimiter, AsyncAIMDLimiter, PoolStats
+from .izonemail import IZONEMail, AsyncIZONEMail
 from .factory import (
     SessionFactory,
+    AsyncSessionFactory,
     AssetFactory,
     PolicyFactory,
 )
+
+# Exports which import the parsing stack (bs4, lxml), imported when first used
+# so that runs without new mails never pay for it
+_lazy_exports = {
+    'ICommand': ('.commands', 'ICommand'),
+    'IVisitorCommand': ('.commands', 'IVisitorCommand'),
+    'InsertMailHeader': ('.commands', 'InsertMailHeaderCommand'),
+    'RemoveAllMetaTags': ('.commands', 'RemoveAllMetaTagsCommand'),
+    'InsertAppMetadata': ('.commands', 'InsertAppMetadataCommand'),
+    'RemoveAllStyleSheet': ('.commands', 'RemoveAllStyleSheetCommand'),
+    'DumpStyleSheet': ('.commands', 'DumpStyleSheetCommand'),
+    'RemoveAllJS': ('.commands', 'RemoveAllJSCommand'),
+    'DumpAllImages': ('.commands', 'DumpAllImagesCommand'),
+    'DumpMailMarkup': ('.commands', 'DumpMailMarkupCommand'),
+    'MailComposer': ('.composer', 'MailComposer'),
+    'StreamingMailComposer': ('.composer', 'StreamingMailComposer'),
+    'StreamingDocument': ('.rewriter', 'StreamingDocument'),
+    'Fragment': ('.markup', 'Fragment'),
+    'MarkupTemplate': ('.markup', 'MarkupTemplate'),
+}
+
+
+def __getattr__(name):
+    try:
+        module, attr = _lazy_exports[name]
+    except KeyError:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}') from None
+    value = globals()[name] = getattr(import_module(module, __name__), attr)
+    return value
+
+
+def __dir__():
+    return sorted({*globals(), *_lazy_exports})
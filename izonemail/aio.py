@@ -0,0 +1,153 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from time import monotonic
+from functools import partial
+from typing import Any, AsyncIterator, Awaitable, Callable, Mapping, Optional, Tuple
+from urllib.parse import urlparse
+
+import aiohttp
+from requests import HTTPError
+
+from .metrics import metrics
+from .transport import AsyncAIMDLimiter, Transport, PoolStats, RETRY_STATUSES
+
+
+@dataclass(frozen=True)
+class AsyncResponse:
+    """Fully-read response returned by ``AsyncSession``"""
+    url: str
+    status_code: int
+    reason: str
+    headers: Mapping[str, str]
+    content: bytes
+    encoding: Optional[str] = None
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            kind = 'Client' if self.status_code < 500 else 'Server'
+            raise HTTPError(f'{self.status_code} {kind} Error: {self.reason} for url: {self.url}', response=self)
+
+
+async def _release(limiter: AsyncAIMDLimiter, start: float, ok: bool):
+    await limiter.release(monotonic() - start, ok)
+
+
+async def _released():
+    pass
+
+
+class AsyncSession:
+    """``requests.Session``-like wrapper around ``aiohttp.ClientSession``
+
+    Requests are limited per host and retried as configured by `transport`.
+    Each host keeps up to `limit_per_host` connections. Connection events are counted into `stats`.
+    """
+    def __init__(self, timeout: Optional[float] = None, transport: Optional[Transport] = None,
+                 limit_per_host: int = 8):
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._transport = transport or Transport()
+        self._limit_per_host = limit_per_host
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.stats = PoolStats()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # ClientSession must be created inside a running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self._limit_per_host)
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_create_end.append(self._on_event('new'))
+            trace.on_connection_reuseconn.append(self._on_event('reused'))
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout,
+                                                  trace_configs=[trace])
+        return self._session
+
+    def _on_event(self, name):
+        async def on_event(session, context, params):
+            self.stats.add(name)
+        return on_event
+
+    async def _send(self, url, read: bool,
+                    **kwargs) -> Tuple[aiohttp.ClientResponse, Optional[bytes], Callable[[], Awaitable[None]]]:
+        """Send a request, retrying failures and throttled responses
+
+        The slot of the host is released once the body is read, so unless `read`, only by calling
+        the release function returned with the response.
+        """
+        limiter = self._transport.async_limiter(url)
+        attempt = 0
+        while True:
+            await limiter.acquire()
+            start = monotonic()
+            r = None
+            ok = failed = held = False
+            # The slot is released whatever is raised, even on cancellation, or the host would run out of them
+            try:
+                r = await self.session.get(url, **kwargs)
+                content = await r.read() if read else None
+                throttled = r.status in RETRY_STATUSES
+                ok = not throttled and r.status < 500
+                held = not read and (not throttled or attempt >= self._transport.max_retries)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                if r is not None:
+                    r.release()
+                if attempt >= self._transport.max_retries:
+                    raise
+                reason = type(e).__name__
+                failed = True
+            except BaseException:
+                if r is not None:
+                    r.release()
+                raise
+            finally:
+                if not held:
+                    await limiter.release(monotonic() - start, ok)
+            if failed:
+                metrics.add('retries_total', host=urlparse(url).netloc, reason=reason)
+                await asyncio.sleep(self._transport.backoff(attempt))
+                attempt += 1
+                continue
+            if not throttled or attempt >= self._transport.max_retries:
+                return r, content, partial(_release, limiter, start, ok) if held else _released
+            metrics.add('retries_total', host=urlparse(url).netloc, reason=r.status)
+            retry_after = r.headers.get('Retry-After')
+            delay = self._transport.backoff(attempt, retry_after)
+            if retry_after is not None:
+                limiter.defer(delay)
+            r.release()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def get(self, url, **kwargs) -> AsyncResponse:
+        r, content, _ = await self._send(url, True, **kwargs)
+        return AsyncResponse(str(r.url), r.status, r.reason, r.headers, content, r.charset)
+
+    @asynccontextmanager
+    async def stream(self, url, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        """Like ``get``, but leave the body to be read from ``content`` of the response as it arrives
+
+        The request counts against the limit of its host until the body is read. Error statuses raise
+        ``HTTPError`` as ``raise_for_status`` does. Failures while reading the body are left to the
+        caller to retry.
+        """
+        r, _, release = await self._send(url, False, **kwargs)
+        try:
+            AsyncResponse(str(r.url), r.status, r.reason, r.headers, b'').raise_for_status()
+            yield r
+        finally:
+            r.release()
+            await release()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
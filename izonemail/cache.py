@@ -0,0 +1,96 @@
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from os import PathLike
+from pathlib import Path
+from threading import Lock
+from typing import Mapping, Optional, Union
+from uuid import uuid4
+
+
+@dataclass(frozen=True)
+class Asset:
+    """Content of a fetched url, with the headers needed to embed it"""
+    content: bytes
+    headers: Mapping[str, str] = field(default_factory=dict)
+
+    @classmethod
+    def from_response(cls, r) -> 'Asset':
+        content_type = r.headers.get('Content-Type')
+        return cls(r.content, {'Content-Type': content_type} if content_type else {})
+
+
+class AssetCache:
+    """Thread-safe LRU cache of assets bounded by their total size in bytes
+
+    If `directory` is given, assets are also persisted there and survive across runs.
+    The directory is not bounded, so only small and frequently used assets should be put.
+    """
+    def __init__(self, max_bytes: int = 32 * 2 ** 20, directory: Union[str, PathLike, None] = None):
+        self._max_bytes = max_bytes
+        self._directory = None if directory is None else Path(directory)
+        if self._directory is not None:
+            self._directory.mkdir(parents=True, exist_ok=True)
+        self._lock = Lock()
+        self._assets: 'OrderedDict[str, Asset]' = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url: str) -> Optional[Asset]:
+        with self._lock:
+            asset = self._assets.get(url)
+            if asset is not None:
+                self._assets.move_to_end(url)
+                self.hits += 1
+                return asset
+        asset = self._load(url)
+        with self._lock:
+            if asset is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._insert(url, asset)
+        return asset
+
+    def put(self, url: str, asset: Asset):
+        with self._lock:
+            self._insert(url, asset)
+        self._store(url, asset)
+
+    def _insert(self, url: str, asset: Asset):
+        if len(asset.content) > self._max_bytes:
+            return
+        old = self._assets.pop(url, None)
+        if old is not None:
+            self._size -= len(old.content)
+        self._assets[url] = asset
+        self._size += len(asset.content)
+        while self._size > self._max_bytes:
+            _, evicted = self._assets.popitem(last=False)
+            self._size -= len(evicted.content)
+
+    def _path(self, url: str) -> Path:
+        return self._directory / hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def _load(self, url: str) -> Optional[Asset]:
+        if self._directory is None:
+            return None
+        try:
+            data = self._path(url).read_bytes()
+        except FileNotFoundError:
+            return None
+        # The first line is the content type
+        content_type, _, content = data.partition(b'\n')
+        content_type = content_type.decode('utf-8')
+        return Asset(content, {'Content-Type': content_type} if content_type else {})
+
+    def _store(self, url: str, asset: Asset):
+        if self._directory is None:
+            return
+        path = self._path(url)
+        # Unique, as the same asset may be stored by several threads or processes at once
+        tmp = path.with_name(f'.{path.name}.{uuid4().hex}.tmp')
+        content_type = asset.headers.get('Content-Type', '')
+        tmp.write_bytes(content_type.encode('utf-8') + b'\n' + asset.content)
+        tmp.replace(path)
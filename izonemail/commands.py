@@ -1,16 +1,18 @@
 from abc import ABC, abstractmethod
-from functools import lru_cache
 from os import PathLike
 from os.path import relpath
 from pathlib import Path
-from typing import Union
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Union
 from urllib.parse import urlparse, urljoin
 
-from bs4 import BeautifulSoup
+from bs4 import Tag
 
 from .__version__ import __title__, __version__
-from .factory import SessionFactory, AssetFactory
-from .models import Artifact, ComposerPayload
+from .factory import AssetFactory
+from .fetcher import ImageFetcher, defer
+from .markup import MarkupTemplate
+from .models import Artifact, ComposerPayload, MarkupArtifact, RemoteArtifact
 from .utils import naive_join, response_to_base64, as_posix
 
 
@@ -19,49 +21,124 @@ class ICommand(ABC):
     def execute(self, mail: ComposerPayload):
         ...
 
+    async def execute_async(self, mail: ComposerPayload):
+        """Coroutine version of ``execute``. Commands doing network I/O should override this."""
+        self.execute(mail)
+
+
+Visitor = Callable[[Tag, ComposerPayload], None]
+
+
+class IVisitorCommand(ICommand):
+    """Command working on individual tags of the markup
+
+    ``MailComposer`` merges the visitors of consecutive visitor commands into a single
+    traversal of the tree, so they must not depend on each other's changes.
+    `finish` is called once the traversal is over.
+    """
+    @abstractmethod
+    def visitors(self) -> Mapping[str, Visitor]:
+        """Map of tag name to the visitor called with every tag of that name"""
+        ...
+
+    def finish(self, mail: ComposerPayload):
+        pass
+
+    async def finish_async(self, mail: ComposerPayload):
+        self.finish(mail)
+
+    def execute(self, mail: ComposerPayload):
+        traverse(mail, [self])
+        self.finish(mail)
+
+    async def execute_async(self, mail: ComposerPayload):
+        traverse(mail, [self])
+        await self.finish_async(mail)
+
+
+def collect_visitors(cmds: Iterable[IVisitorCommand]) -> Dict[str, List[Visitor]]:
+    visitors = defaultdict(list)
+    for c in cmds:
+        for name, visitor in c.visitors().items():
+            visitors[name].append(visitor)
+    return visitors
+
+
+def visit(e: Tag, mail: ComposerPayload, visitors: Mapping[str, List[Visitor]]):
+    """Call the visitors of a tag in order until one of them removes it"""
+    for visitor in visitors[e.name]:
+        visitor(e, mail)
+        if e.decomposed:
+            break
+
+
+def traverse(mail: ComposerPayload, cmds: Iterable[IVisitorCommand]):
+    """Walk the markup once, calling the visitors of all `cmds` in document order"""
+    visitors = collect_visitors(cmds)
+    for e in mail.body.find_all(list(visitors)):
+        # Skip tags removed along with one of their ancestors
+        if e.decomposed:
+            continue
+        visit(e, mail, visitors)
+
 
 class InsertMailHeaderCommand(ICommand):
     """Insert mail header before mail body"""
-    def __init__(self, asset_key: str, profile_image_root: Union[str, PathLike, None] = '/'):
-        self._s = SessionFactory.instance()
-        self._header_template = AssetFactory.get(asset_key).decode('utf-8')
+    def __init__(self, asset_key: str, profile_image_root: Union[str, PathLike, None] = '/',
+                 fetcher: Optional[ImageFetcher] = None):
+        self._fetcher = fetcher or ImageFetcher()
+        self._header_template = MarkupTemplate(AssetFactory.get(asset_key).decode('utf-8'), 'header')
         self._profile_image_root = profile_image_root
         if self._profile_image_root is not None:
             self._profile_image_root = Path(self._profile_image_root)
 
-    @lru_cache
-    def _get(self, url, **kwargs):
-        r = self._s.get(url, **kwargs)
-        r.raise_for_status()
-        return r
+    def _profile_image_path(self, mail: ComposerPayload) -> Optional[Path]:
+        if not self._profile_image_root:
+            return None
+        path = Path(urlparse(mail.header.member.image_url).path)
+        return naive_join(self._profile_image_root, path)
 
     def execute(self, mail: ComposerPayload):
-        r = self._get(mail.header.member.image_url)
-
-        if self._profile_image_root:
-            path = Path(urlparse(mail.header.member.image_url).path)
-            path = naive_join(self._profile_image_root, path)
-            mail.artifacts.append(Artifact(path, r.content))
-            url = as_posix(relpath(path, mail.path.parent))
+        path = self._profile_image_path(mail)
+        if path:
+            self._insert_header(mail, self._dump_profile_image(mail, path))
         else:
-            url = response_to_base64(r)
+            self._insert_header(mail, response_to_base64(self._fetcher.get(mail.header.member.image_url, cache=True)))
 
-        header = self._header_template.format_map({
+    async def execute_async(self, mail: ComposerPayload):
+        path = self._profile_image_path(mail)
+        if path:
+            self._insert_header(mail, self._dump_profile_image(mail, path))
+        else:
+            r = await self._fetcher.get_async(mail.header.member.image_url, cache=True)
+            self._insert_header(mail, response_to_base64(r))
+
+    @staticmethod
+    def _dump_profile_image(mail: ComposerPayload, path: Path) -> str:
+        # Downloaded into its file like other images, unless it is already in the destination
+        if not mail.artifact_exists(path):
+            mail.artifacts.append(RemoteArtifact(path, mail.header.member.image_url))
+        return as_posix(relpath(path, mail.path.parent))
+
+    def _insert_header(self, mail: ComposerPayload, url: str):
+        header = self._header_template.render({
             'member_image': url,
             'sender': mail.header.member.name,
             'received': mail.header.received.strftime('%Y/%m/%d %H:%M'),
             'recipient': mail.recipient.nickname,
             'subject': mail.header.subject,
         })
-        header = BeautifulSoup(header, 'lxml').header
         mail.body.select_one('#mail-detail').insert_before(header)
 
 
-class RemoveAllMetaTagsCommand(ICommand):
+def _decompose(e: Tag, mail: ComposerPayload):
+    e.decompose()
+
+
+class RemoveAllMetaTagsCommand(IVisitorCommand):
     """Remove all meta tag from markup"""
-    def execute(self, mail: ComposerPayload):
-        for e in mail.body.find_all('meta'):
-            e.decompose()
+    def visitors(self) -> Mapping[str, Visitor]:
+        return {'meta': _decompose}
 
 
 class InsertAppMetadataCommand(ICommand):
@@ -89,12 +166,14 @@ class InsertAppMetadataCommand(ICommand):
             mail.body.head.append(tag)
 
 
-class RemoveAllStyleSheetCommand(ICommand):
+class RemoveAllStyleSheetCommand(IVisitorCommand):
     """Remove all css from markup"""
-    def execute(self, mail: ComposerPayload):
-        for e in mail.body.find_all('link', attrs={'rel': 'stylesheet'}):
-            e.decompose()
-        for e in mail.body.find_all('style'):
+    def visitors(self) -> Mapping[str, Visitor]:
+        return {'link': self._visit_link, 'style': _decompose}
+
+    @staticmethod
+    def _visit_link(e: Tag, mail: ComposerPayload):
+        if 'stylesheet' in e.get('rel', ()):
             e.decompose()
 
 
@@ -123,40 +202,40 @@ class DumpStyleSheetCommand(ICommand):
         mail.body.head.append(tag)
 
 
-class RemoveAllJSCommand(ICommand):
+class RemoveAllJSCommand(IVisitorCommand):
     """Remove all javascript blocks in markup"""
-    def execute(self, mail: ComposerPayload):
-        for e in mail.body.find_all('script'):
-            e.decompose()
+    def visitors(self) -> Mapping[str, Visitor]:
+        return {'script': _decompose}
+
 
+class DumpAllImagesCommand(IVisitorCommand):
+    """Dump all images in markup to local or embed them
 
-class DumpAllImagesCommand(ICommand):
-    """Fetch all images in markup"""
+    Images are downloaded while the artifacts are saved, streamed into their files or into the markup.
+    """
     def __init__(self, img_root: Union[str, PathLike, None] = '/img'):
-        self._s = SessionFactory.instance()
         self._img_root = img_root
         if self._img_root is not None:
             self._img_root = Path(self._img_root)
 
-    def execute(self, mail: ComposerPayload):
-        for e in mail.body.find_all('img'):
-            if e['src'].startswith('data:'):
-                continue
-            url = e['src'] if urlparse(e['src']).netloc else urljoin(mail.header.detail_url, e['src'])
-            r = self._s.get(url)
-            r.raise_for_status()
-
-            if self._img_root:
-                parts = urlparse(url).path.split('/')
-                path = naive_join(self._img_root, Path(*parts[-3:]))
-                mail.artifacts.append(Artifact(path, r.content))
-                url = as_posix(relpath(path, mail.path.parent))
-            else:
-                url = response_to_base64(r)
-
-            e['src'] = url
+    def visitors(self) -> Mapping[str, Visitor]:
+        return {'img': self._visit_image}
+
+    def _visit_image(self, e: Tag, mail: ComposerPayload):
+        if e['src'].startswith('data:'):
+            return
+        url = e['src'] if urlparse(e['src']).netloc else urljoin(mail.header.detail_url, e['src'])
+        if self._img_root:
+            parts = urlparse(url).path.split('/')
+            path = naive_join(self._img_root, Path(*parts[-3:]))
+            # No need to download images which are already in the destination
+            if not mail.artifact_exists(path):
+                mail.artifacts.append(RemoteArtifact(path, url))
+            e['src'] = as_posix(relpath(path, mail.path.parent))
+        else:
+            e['src'] = response_to_base64(defer(url))
 
 
 class DumpMailMarkupCommand(ICommand):
     def execute(self, mail: ComposerPayload):
-        mail.artifacts.append(Artifact(mail.path, mail.body.encode()))
+        mail.artifacts.append(MarkupArtifact(mail.path, mail.body.encode()))
@@ -1,19 +1,29 @@
 from os import PathLike
 from pathlib import Path
-from typing import MutableSequence, Union
+from typing import Iterable, Iterator, List, MutableSequence, Optional, Union
 
 from bs4 import BeautifulSoup
 
-from .commands import ICommand
+from .commands import ICommand, IVisitorCommand, collect_visitors, traverse, visit
+from .metrics import metrics
 from .models import ComposerPayload, User, Mail
-from .utils import naive_join, slugify
+from .rewriter import StreamingDocument
+from .utils import slugify
+from .writer import AnyArtifact, ArtifactWriter
+
+
+def _stage_name(stage: Union[ICommand, List[IVisitorCommand]]) -> str:
+    """Class name of a command, or those of visitor commands sharing a traversal joined with '+'"""
+    if isinstance(stage, list):
+        return '+'.join(type(c).__name__ for c in stage)
+    return type(stage).__name__
 
 
 class MailComposer(MutableSequence):
-    def __init__(self, root: Union[str, PathLike], mail_path_fmt: str):
+    def __init__(self, root: Union[str, PathLike], mail_path_fmt: str, writer: Optional[ArtifactWriter] = None):
         self._cmds: MutableSequence[ICommand] = []
-        self._root = Path(root)
         self._mail_path_fmt = mail_path_fmt
+        self._writer = writer or ArtifactWriter(root)
 
     def insert(self, index: int, value: ICommand) -> None:
         self._cmds.insert(index, value)
@@ -38,31 +48,97 @@ class MailComposer(MutableSequence):
         self._cmds.remove(other)
         return self
 
-    def compose(self, recipient: User, mail: Mail, body: str) -> str:
-        soup = BeautifulSoup(body, 'lxml')
-        path = Path(self._mail_path_fmt.format_map({
+    def mail_path(self, mail: Mail) -> Path:
+        return Path(self._mail_path_fmt.format_map({
             'member_id': mail.member.id,
             'member_name': mail.member.name,
             'mail_id': mail.id,
             'received': mail.received,
             'subject': slugify(mail.subject)
         }))
-        payload = ComposerPayload(recipient, mail, soup, path)
 
-        for c in self._cmds:
-            c.execute(payload)
+    def _create_payload(self, recipient: User, mail: Mail, body: str) -> ComposerPayload:
+        soup = BeautifulSoup(body, 'lxml')
+        path = self.mail_path(mail)
+        return ComposerPayload(recipient, mail, soup, path, artifact_exists=self.artifact_exists)
 
-        # Save composing artifacts if any
-        for item in payload.artifacts:
-            artifact_path = naive_join(self._root, item.path)
-            # Double-check presence of files due to the absence of exclusive access
-            if artifact_path.is_file():
+    @property
+    def writer(self) -> ArtifactWriter:
+        return self._writer
+
+    def artifact_exists(self, path: Path) -> bool:
+        return self._writer.exists(path)
+
+    def _stages(self) -> Iterator[Union[ICommand, List[IVisitorCommand]]]:
+        """Commands to execute in order, consecutive visitor commands being grouped into one traversal"""
+        group = []
+        for c in self._cmds:
+            if isinstance(c, IVisitorCommand):
+                group.append(c)
                 continue
-            artifact_path.parent.mkdir(parents=True, exist_ok=True)
-            try:
-                with artifact_path.open('xb') as f:
-                    f.write(item.data)
-            except FileExistsError:
-                pass
-
-        return payload.body.decode()
+            if group:
+                yield group
+                group = []
+            yield c
+        if group:
+            yield group
+
+    def _traverse(self, payload: ComposerPayload, cmds: List[IVisitorCommand]):
+        traverse(payload, cmds)
+
+    def render(self, recipient: User, mail: Mail, body: str) -> List[AnyArtifact]:
+        """Execute the commands on a mail, returning the artifacts to save"""
+        with metrics.timer('stage_seconds', stage='parse'):
+            payload = self._create_payload(recipient, mail, body)
+        for stage in self._stages():
+            with metrics.timer('command_seconds', command=_stage_name(stage)):
+                if isinstance(stage, list):
+                    self._traverse(payload, stage)
+                    for c in stage:
+                        c.finish(payload)
+                else:
+                    stage.execute(payload)
+        return list(payload.artifacts)
+
+    async def render_async(self, recipient: User, mail: Mail, body: str) -> List[AnyArtifact]:
+        with metrics.timer('stage_seconds', stage='parse'):
+            payload = self._create_payload(recipient, mail, body)
+        for stage in self._stages():
+            with metrics.timer('command_seconds', command=_stage_name(stage)):
+                if isinstance(stage, list):
+                    self._traverse(payload, stage)
+                    for c in stage:
+                        await c.finish_async(payload)
+                else:
+                    await stage.execute_async(payload)
+        return list(payload.artifacts)
+
+    def compose(self, recipient: User, mail: Mail, body: str) -> None:
+        self.save_artifacts(self.render(recipient, mail, body))
+
+    async def compose_async(self, recipient: User, mail: Mail, body: str) -> None:
+        await self.save_artifacts_async(await self.render_async(recipient, mail, body))
+
+    def save_artifacts(self, artifacts: Iterable[AnyArtifact]):
+        self._writer.write(artifacts)
+
+    async def save_artifacts_async(self, artifacts: Iterable[AnyArtifact]):
+        await self._writer.write_async(artifacts)
+
+
+class StreamingMailComposer(MailComposer):
+    """``MailComposer`` rewriting the markup while it is tokenized instead of building a tree
+
+    The visitors of all visitor commands are called during tokenization, before any other command,
+    so they only see the original markup. Other commands insert tags into the ``StreamingDocument``.
+    """
+    def _create_payload(self, recipient: User, mail: Mail, body: str) -> ComposerPayload:
+        document = StreamingDocument()
+        payload = ComposerPayload(recipient, mail, document, self.mail_path(mail), artifact_exists=self.artifact_exists)
+        visitors = collect_visitors(c for c in self._cmds if isinstance(c, IVisitorCommand))
+        document.feed(body, set(visitors), lambda e: visit(e, payload, visitors))
+        return payload
+
+    def _traverse(self, payload: ComposerPayload, cmds: List[IVisitorCommand]):
+        # Already visited while tokenizing
+        pass
@@ -1,11 +1,16 @@
 import json
 from datetime import datetime
 from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional
 
 from requests import Session
+from requests.adapters import HTTPAdapter
 
 from .models import Policy
 
+if TYPE_CHECKING:
+    from .aio import AsyncSession
+
 
 class SessionFactory:
     __instance = None  # Singleton session instance
@@ -16,10 +21,48 @@ class SessionFactory:
             cls.__instance = Session()
         return cls.__instance
 
+    @classmethod
+    def mount(cls, adapter_factory: Callable[[], HTTPAdapter], hosts: Iterable[str] = ()) -> List[HTTPAdapter]:
+        """Mount a dedicated adapter, hence connection pool, for each of `hosts` and a shared one for the others
+
+        :return: The mounted adapters, the shared one first
+        """
+        s = cls.instance()
+        adapters = [adapter_factory()]
+        s.mount('https://', adapters[0])
+        s.mount('http://', adapters[0])
+        for host in hosts:
+            adapters.append(adapter_factory())
+            s.mount(host.rstrip('/') + '/', adapters[-1])
+        return adapters
+
+
+class AsyncSessionFactory:
+    __instance = None  # Singleton async session instance
+    _options = {}
+
+    @classmethod
+    def configure(cls, **kwargs):
+        """Set keyword arguments of ``AsyncSession`` used when the instance is created
+
+        A previous instance, which must have been closed, is replaced by the next one.
+        """
+        cls._options = kwargs
+        cls.__instance = None
+
+    @classmethod
+    def instance(cls) -> 'AsyncSession':
+        if cls.__instance is None:
+            # aiohttp is only imported by the asyncio engine
+            from .aio import AsyncSession
+            cls.__instance = AsyncSession(**cls._options)
+        return cls.__instance
+
 
 class AssetFactory:
     _asset_path = Path(__file__).parent / 'assets'
     _custom_assets = {}
+    _loaded: Dict[str, bytes] = {}  # Bundled assets read so far
 
     @classmethod
     def register(cls, key: str, value: bytes):
@@ -27,9 +70,11 @@ class AssetFactory:
 
     @classmethod
     def get(cls, key: str) -> bytes:
+        if key in cls._loaded:
+            return cls._loaded[key]
         path = cls._asset_path / key
         if path.is_file():
-            asset = path.read_bytes()
+            asset = cls._loaded[key] = path.read_bytes()
         elif key in cls._custom_assets:
             asset = cls._custom_assets[key]
         else:
@@ -38,16 +83,22 @@ class AssetFactory:
 
 
 class PolicyFactory:
-    _policies = json.loads(AssetFactory.get('policy.json').decode('utf-8'))
+    _policies: Optional[List[dict]] = None  # Parsed on the first lookup
+
+    @classmethod
+    def policies(cls) -> List[dict]:
+        if cls._policies is None:
+            cls._policies = json.loads(AssetFactory.get('policy.json').decode('utf-8'))
+        return cls._policies
 
     @classmethod
     def get(cls, bundle_id: str) -> Policy:
-        for p in cls._policies:
+        for p in cls.policies():
             if p['bundle_id'] == bundle_id:
                 break
         else:
             raise ValueError(f'Unknown bundle id: {repr(bundle_id)}. '
-                             f'possible values: {[p["bundle_id"] for p in cls._policies]}')
+                             f'possible values: {[p["bundle_id"] for p in cls.policies()]}')
 
         genesis = datetime.fromisoformat(p['genesis'])
         return Policy(p['bundle_id'], p['api_host'], p['app_host'], p['mail_header'], p['css'], genesis)
@@ -0,0 +1,379 @@
+import asyncio
+import base64
+import mimetypes
+import re
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from threading import Lock, RLock
+from time import sleep
+from typing import Awaitable, BinaryIO, Callable, Dict, Iterator, Mapping, NamedTuple, Optional, TypeVar, Union
+from urllib.parse import urlparse
+
+from requests import Response
+from requests.exceptions import ChunkedEncodingError, ConnectionError
+
+from .cache import Asset, AssetCache
+from .factory import SessionFactory, AsyncSessionFactory
+from .metrics import metrics
+from .transport import Transport
+from .utils import response_to_base64
+
+CHUNK_SIZE = 64 * 1024
+# Downloads larger than this are spooled on disk until they are complete
+SPOOL_SIZE = 2 ** 20
+DEFERRED_CONTENT_TYPE = 'application/x-izms-deferred'
+_deferred_prefix = b'\0izms-deferred\0'
+_deferred_mark = DEFERRED_CONTENT_TYPE.encode()
+_deferred_uri_re = re.compile(rb'data:' + _deferred_mark + rb';base64,([A-Za-z0-9+/=]*)')
+# Raised by requests when the body of a response fails to be read, e.g. the connection is reset
+_BODY_ERRORS = (ChunkedEncodingError, ConnectionError)
+
+_T = TypeVar('_T')
+
+
+class ImageFetcher:
+    """Fetch images on a shared pool, sharing a single in-flight request between callers of the same url
+
+    Assets requested with `cache` are kept in `cache` and not requested again. Other images are
+    downloaded in chunks into spools, kept on disk once large, so they are never held in memory
+    as a whole. Downloads failing while their body is read are retried as `transport` retries requests.
+    """
+    def __init__(self, max_workers: int = 8, cache: Optional[AssetCache] = None, transport: Optional[Transport] = None):
+        self._s = SessionFactory.instance()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ImageFetcher')
+        self._cache = cache if cache is not None else AssetCache()
+        self._transport = transport or Transport()
+        self._lock = RLock()
+        self._in_flight: Dict[str, Future] = {}
+        self._in_flight_async: Dict[str, asyncio.Future] = {}
+
+    def _submit(self, key: str, fn: Callable, *args) -> Future:
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is None:
+                future = self._executor.submit(fn, *args)
+                self._in_flight[key] = future
+                future.add_done_callback(lambda _: self._forget(key))
+        return future
+
+    def _forget(self, key: str):
+        with self._lock:
+            self._in_flight.pop(key, None)
+
+    def _get(self, url, cache) -> Asset:
+        def read(r) -> Asset:
+            metrics.add('bytes_total', len(r.content), stage='image')
+            return Asset.from_response(r)
+
+        asset = self._download(url, read)
+        if cache:
+            self._cache.put(url, asset)
+        return asset
+
+    def submit(self, url: str, cache: bool = False) -> 'Future[Asset]':
+        asset = self._cache.get(url) if cache else None
+        if asset is not None:
+            future = Future()
+            future.set_result(asset)
+            return future
+        return self._submit(url, self._get, url, cache)
+
+    def get(self, url: str, cache: bool = False) -> Asset:
+        return self.submit(url, cache).result()
+
+    def download(self, url: str, f: BinaryIO):
+        """Download `url` into `f` in chunks"""
+        self._spool(url).copy_to(f)
+
+    def _retry(self, url: str, attempt: int, e: Exception) -> float:
+        """Seconds to wait before downloading `url` again after `e`, raising it if out of retries"""
+        if attempt >= self._transport.max_retries:
+            raise e
+        metrics.add('retries_total', host=urlparse(url).netloc, reason=type(e).__name__)
+        return self._transport.backoff(attempt)
+
+    def _download(self, url: str, read: Callable[[Response], _T]) -> _T:
+        """`read` the response to `url`, requesting it again if its body fails to be read"""
+        attempt = 0
+        while True:
+            reading = False
+            try:
+                with metrics.timer('stage_seconds', stage='image'), self._s.get(url, stream=True) as r:
+                    r.raise_for_status()
+                    reading = True
+                    return read(r)
+            except _BODY_ERRORS as e:
+                # Failures to connect are retried by the session already
+                if not reading:
+                    raise
+                sleep(self._retry(url, attempt, e))
+                attempt += 1
+
+    def _spool(self, url: str) -> '_Spool':
+        def read(r) -> _Spool:
+            spool = SpooledTemporaryFile(SPOOL_SIZE)
+            try:
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    spool.write(chunk)
+            except BaseException:
+                spool.close()
+                raise
+            metrics.add('bytes_total', spool.tell(), stage='image')
+            return _Spool(spool, r.headers)
+
+        return self._download(url, read)
+
+    def write(self, data: bytes, f: BinaryIO):
+        """Write `data` into `f`, replacing the placeholders of a ``DeferredFetcher`` with the content they defer
+
+        Every deferred content is requested at once, then written in order. Content which is not
+        cached is spooled until it is written, base64-encoded on the fly if it is embedded.
+        """
+        parts = []
+        for part in _split(data):
+            if isinstance(part, bytes):
+                parts.append(part)
+            elif part.cache:
+                parts += [part, self.submit(part.url, cache=True)]
+            else:
+                parts += [part, self._submit(f'spool:{part.url}', self._spool, part.url)]
+        parts = iter(parts)
+        for part in parts:
+            if isinstance(part, bytes):
+                f.write(part)
+            elif part.cache:
+                f.write(_encode(next(parts).result(), part.data_uri))
+            else:
+                next(parts).result().copy_to(f, part.data_uri)
+
+    async def _in_flight_task(self, key: str, fn: Callable[..., Awaitable], *args):
+        task = self._in_flight_async.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args))
+            self._in_flight_async[key] = task
+            task.add_done_callback(lambda _: self._in_flight_async.pop(key, None))
+        # A cancelled waiter must not cancel the request others are waiting for
+        return await asyncio.shield(task)
+
+    async def _get_async(self, url, cache) -> Asset:
+        with metrics.timer('stage_seconds', stage='image'):
+            r = await AsyncSessionFactory.instance().get(url)
+        r.raise_for_status()
+        metrics.add('bytes_total', len(r.content), stage='image')
+        asset = Asset.from_response(r)
+        if cache:
+            await self._put_async(url, asset)
+        return asset
+
+    async def _put_async(self, url: str, asset: Asset):
+        # Persisting the asset writes a file, which must not block the loop
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._cache.put, url, asset)
+
+    async def get_async(self, url: str, cache: bool = False) -> Asset:
+        asset = self._cache.get(url) if cache else None
+        if asset is not None:
+            return asset
+        return await self._in_flight_task(url, self._get_async, url, cache)
+
+    async def download_async(self, url: str, f: BinaryIO):
+        (await self._spool_async(url)).copy_to(f)
+
+    async def _spool_async(self, url: str) -> '_Spool':
+        import aiohttp
+
+        attempt = 0
+        while True:
+            spool = SpooledTemporaryFile(SPOOL_SIZE)
+            reading = False
+            try:
+                with metrics.timer('stage_seconds', stage='image'):
+                    async with AsyncSessionFactory.instance().stream(url) as r:
+                        reading = True
+                        async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                            spool.write(chunk)
+            except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                spool.close()
+                # Failures to connect are retried by the session already
+                if not reading:
+                    raise
+                await asyncio.sleep(self._retry(url, attempt, e))
+                attempt += 1
+                continue
+            except BaseException:
+                spool.close()
+                raise
+            metrics.add('bytes_total', spool.tell(), stage='image')
+            return _Spool(spool, r.headers)
+
+    async def write_async(self, data: bytes, f: BinaryIO):
+        parts = []
+        for part in _split(data):
+            if isinstance(part, bytes):
+                parts.append(part)
+            elif part.cache:
+                parts += [part, asyncio.ensure_future(self.get_async(part.url, cache=True))]
+            else:
+                parts += [part, asyncio.ensure_future(
+                    self._in_flight_task(f'spool:{part.url}', self._spool_async, part.url))]
+        tasks = [part for part in parts if isinstance(part, asyncio.Future)]
+        try:
+            parts = iter(parts)
+            for part in parts:
+                if isinstance(part, bytes):
+                    f.write(part)
+                elif part.cache:
+                    f.write(_encode(await next(parts), part.data_uri))
+                else:
+                    (await next(parts)).copy_to(f, part.data_uri)
+        finally:
+            # Requests shared with other mails go on, only waiting for them is cancelled
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+class LocalImageFetcher(ImageFetcher):
+    """``ImageFetcher`` reading the images already saved with `read`, only requesting those it returns None for"""
+    def __init__(self, read: Callable[[str], Optional[bytes]], max_workers: int = 8,
+                 cache: Optional[AssetCache] = None, transport: Optional[Transport] = None):
+        super(LocalImageFetcher, self).__init__(max_workers, cache, transport)
+        self._read = read
+
+    def _local(self, url: str) -> Optional[Asset]:
+        content = self._read(url)
+        if content is None:
+            return None
+        content_type = mimetypes.guess_type(urlparse(url).path)[0]
+        return Asset(content, {'Content-Type': content_type} if content_type else {})
+
+    def _get(self, url, cache) -> Asset:
+        asset = self._local(url)
+        if asset is None:
+            return super(LocalImageFetcher, self)._get(url, cache)
+        if cache:
+            self._cache.put(url, asset)
+        return asset
+
+    async def _get_async(self, url, cache) -> Asset:
+        asset = self._local(url)
+        if asset is None:
+            return await super(LocalImageFetcher, self)._get_async(url, cache)
+        if cache:
+            await self._put_async(url, asset)
+        return asset
+
+    def _spool(self, url: str) -> '_Spool':
+        asset = self._local(url)
+        if asset is None:
+            return super(LocalImageFetcher, self)._spool(url)
+        return _Spool(BytesIO(asset.content), asset.headers)
+
+    async def _spool_async(self, url: str) -> '_Spool':
+        asset = self._local(url)
+        if asset is None:
+            return await super(LocalImageFetcher, self)._spool_async(url)
+        return _Spool(BytesIO(asset.content), asset.headers)
+
+
+class DeferredFetcher(ImageFetcher):
+    """``ImageFetcher`` deferring every request, for composers running in worker processes
+
+    The returned assets are placeholders made by ``defer``, which ``ImageFetcher.write`` of the
+    parent process recognizes in the artifacts and replaces with the fetched content. Connection
+    pools, limits, single-flight and caching of requests thus stay in one place.
+    """
+    def __init__(self):
+        pass
+
+    def submit(self, url: str, cache: bool = False) -> 'Future[Asset]':
+        future = Future()
+        future.set_result(defer(url, cache))
+        return future
+
+    async def get_async(self, url: str, cache: bool = False) -> Asset:
+        return defer(url, cache)
+
+    def shutdown(self):
+        pass
+
+
+def defer(url: str, cache: bool = False) -> Asset:
+    """Placeholder asset of `url`, to be replaced by ``ImageFetcher.write`` as is or as the data URI
+    ``response_to_base64`` makes of it"""
+    token = _deferred_prefix + (b'1' if cache else b'0') + url.encode('utf-8')
+    return Asset(token, {'Content-Type': DEFERRED_CONTENT_TYPE})
+
+
+class _Placeholder(NamedTuple):
+    url: str
+    cache: bool
+    data_uri: bool
+
+
+def _parse_token(token: bytes, data_uri: bool) -> _Placeholder:
+    token = token[len(_deferred_prefix):]
+    return _Placeholder(token[1:].decode('utf-8'), token[:1] == b'1', data_uri)
+
+
+def _split(data: bytes) -> Iterator[Union[bytes, _Placeholder]]:
+    """Split `data` into literal parts and deferred placeholders"""
+    if data.startswith(_deferred_prefix):
+        yield _parse_token(data, False)
+    elif _deferred_mark in data:
+        i = 0
+        for m in _deferred_uri_re.finditer(data):
+            yield data[i:m.start()]
+            yield _parse_token(base64.b64decode(m[1]), True)
+            i = m.end()
+        yield data[i:]
+    else:
+        yield data
+
+
+def _encode(asset: Asset, data_uri: bool) -> bytes:
+    return response_to_base64(asset).encode('utf-8') if data_uri else asset.content
+
+
+def _sink(f: BinaryIO, headers: Mapping[str, str], data_uri: bool):
+    """Where to write the chunks of a deferred content into `f`"""
+    if not data_uri:
+        return f
+    f.write(_encode(Asset(b'', headers), True))
+    return _Base64Writer(f)
+
+
+class _Spool:
+    """Content downloaded ahead of being written, possibly into several files"""
+    def __init__(self, f: BinaryIO, headers: Mapping[str, str]):
+        self._f = f
+        self._lock = Lock()
+        self.headers = headers
+
+    def copy_to(self, f: BinaryIO, data_uri: bool = False):
+        with self._lock:
+            self._f.seek(0)
+            sink = _sink(f, self.headers, data_uri)
+            for chunk in iter(lambda: self._f.read(CHUNK_SIZE), b''):
+                sink.write(chunk)
+            sink.flush()
+
+
+class _Base64Writer:
+    """Base64-encode what is written into `f`, keeping back the bytes of an incomplete group"""
+    def __init__(self, f: BinaryIO):
+        self._f = f
+        self._rest = b''
+
+    def write(self, b: bytes):
+        b = self._rest + b
+        n = len(b) - len(b) % 3
+        self._f.write(base64.b64encode(b[:n]))
+        self._rest = b[n:]
+
+    def flush(self):
+        self._f.write(base64.b64encode(self._rest))
+        self._rest = b''
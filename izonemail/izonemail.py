@@ -1,13 +1,17 @@
 from datetime import datetime
-from typing import Dict, List
+from typing import TYPE_CHECKING, Dict, List, Union
 from urllib.parse import urljoin
 
 from easydict import EasyDict
 from requests import Response
 
-from .factory import SessionFactory
+from .factory import SessionFactory, AsyncSessionFactory
+from .metrics import metrics
 from .models import Profile, User, Member, Team, Group, Mail, Inbox
 
+if TYPE_CHECKING:
+    from .aio import AsyncResponse
+
 
 def create_member(m):
     return Member(m.id, m.name, m.image_url)
@@ -22,56 +26,110 @@ def create_mail(m):
     return Mail(create_member(m.member), m.id, m.subject, m.content, received, m.detail_url)
 
 
-class IZONEMail:
+def create_groups(r) -> List[Group]:
+    return [Group(g.group.id, g.group.name, [create_team(t) for t in g.team_members]) for g in r.all_members]
+
+
+def create_user(r) -> User:
+    u = r.user
+    return User(u.id, u.access_token, u.nickname, u.gender, u.country_code, u.prefecture_id, u.birthday, u.member_id)
+
+
+def create_inbox(r) -> Inbox:
+    return Inbox(r.page, r.has_next_page, [create_mail(m) for m in r.mails])
+
+
+class _IZONEMailBase:
+    """Requests of the API and parsing of their responses, leaving sending them to subclasses"""
     def __init__(self, api_host: str, profile: Profile):
-        self._s = SessionFactory.instance()
         self._api_host = api_host
         self._profile = profile
 
+    def _url(self, path: str) -> str:
+        return urljoin(self._api_host, path)
+
+    @staticmethod
+    def _inbox_params(page: int) -> Dict:
+        return {
+            'is_star': 0,
+            'is_unread': 0,
+            'page': page
+        }
+
+    @staticmethod
+    def _mail_detail(r: Union[Response, 'AsyncResponse']) -> str:
+        metrics.add('bytes_total', len(r.content), stage='detail')
+        return r.text
+
+
+class IZONEMail(_IZONEMailBase):
+    def __init__(self, api_host: str, profile: Profile):
+        super(IZONEMail, self).__init__(api_host, profile)
+        self._s = SessionFactory.instance()
+
     def _get(self, url, **kwargs) -> Response:
         r = self._s.get(url, headers=self._profile, **kwargs)
         r.raise_for_status()
         return r
 
     def _get_json(self, url, **kwargs) -> Dict:
-        url = urljoin(self._api_host, url)
-        r = self._get(url, **kwargs)
-        return EasyDict(r.json())
+        return EasyDict(self._get(self._url(url), **kwargs).json())
 
     def get_members(self) -> List[Group]:
-        r = self._get_json('/v1/members')
-
-        groups = []
-        for g in r.all_members:
-            group = Group(g.group.id, g.group.name, [create_team(t) for t in g.team_members])
-            groups.append(group)
-
-        return groups
+        return create_groups(self._get_json('/v1/members'))
 
     def get_user(self) -> User:
-        r = self._get_json('/v1/users')
-        u = r.user
-        user = User(u.id, u.access_token, u.nickname, u.gender,
-                    u.country_code, u.prefecture_id, u.birthday, u.member_id)
-        return user
+        return create_user(self._get_json('/v1/users'))
 
     def get_application_settings(self) -> Dict:
-        r = self._get_json('/v1/application_settings')
-        return r.application_settings
+        return self._get_json('/v1/application_settings').application_settings
 
     def get_informations(self) -> List[Dict]:
-        r = self._get_json('/v1/informations')
-        return r.informations
+        return self._get_json('/v1/informations').informations
 
     def get_inbox(self, page: int = 1) -> Inbox:
-        r = self._get_json('/v1/inbox', params={
-            'is_star': 0,
-            'is_unread': 0,
-            'page': page
-        })
-
-        return Inbox(r.page, r.has_next_page, [create_mail(m) for m in r.mails])
+        with metrics.timer('stage_seconds', stage='inbox'):
+            r = self._get_json('/v1/inbox', params=self._inbox_params(page))
+        return create_inbox(r)
 
     def get_mail_detail(self, mail: Mail) -> str:
-        r = self._get(mail.detail_url)
-        return r.text
+        with metrics.timer('stage_seconds', stage='detail'):
+            r = self._get(mail.detail_url)
+        return self._mail_detail(r)
+
+
+class AsyncIZONEMail(_IZONEMailBase):
+    """``IZONEMail`` sending its requests with aiohttp"""
+    def __init__(self, api_host: str, profile: Profile):
+        super(AsyncIZONEMail, self).__init__(api_host, profile)
+        self._s = AsyncSessionFactory.instance()
+
+    async def _get(self, url, **kwargs) -> 'AsyncResponse':
+        r = await self._s.get(url, headers=dict(self._profile), **kwargs)
+        r.raise_for_status()
+        return r
+
+    async def _get_json(self, url, **kwargs) -> Dict:
+        return EasyDict((await self._get(self._url(url), **kwargs)).json())
+
+    async def get_members(self) -> List[Group]:
+        return create_groups(await self._get_json('/v1/members'))
+
+    async def get_user(self) -> User:
+        return create_user(await self._get_json('/v1/users'))
+
+    async def get_application_settings(self) -> Dict:
+        return (await self._get_json('/v1/application_settings')).application_settings
+
+    async def get_informations(self) -> List[Dict]:
+        return (await self._get_json('/v1/informations')).informations
+
+    async def get_inbox(self, page: int = 1) -> Inbox:
+        with metrics.timer('stage_seconds', stage='inbox'):
+            r = await self._get_json('/v1/inbox', params=self._inbox_params(page))
+        return create_inbox(r)
+
+    async def get_mail_detail(self, mail: Mail) -> str:
+        with metrics.timer('stage_seconds', stage='detail'):
+            r = await self._get(mail.detail_url)
+        return self._mail_detail(r)
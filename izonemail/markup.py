@@ -0,0 +1,41 @@
+from string import Formatter
+from typing import Any, Mapping
+
+from bs4 import BeautifulSoup, NavigableString
+from bs4.formatter import HTMLFormatter
+
+_formatter = HTMLFormatter.REGISTRY['minimal']
+
+
+class Fragment(NavigableString):
+    """Serialized markup inserted as is into a tree or a ``StreamingDocument``"""
+    def output_ready(self, formatter='minimal'):
+        return str(self)
+
+
+class MarkupTemplate:
+    """Markup of the first `name` element of a ``str.format`` template, parsed and serialized once
+
+    Fields are substituted as text, escaped for the position they are in, so rendering costs
+    a ``format_map`` instead of a parse of the whole markup.
+    """
+    def __init__(self, template: str, name: str):
+        element = BeautifulSoup(template, 'lxml').find(name)
+        self._markup = element.decode()
+        # Fields used in attribute values need their quotes escaped as well
+        self._attribute_fields = {
+            field
+            for e in [element, *element.find_all(True)]
+            for value in e.attrs.values()
+            for _, field, _, _ in Formatter().parse(' '.join(value) if isinstance(value, list) else value)
+            if field
+        }
+
+    def render(self, values: Mapping[str, Any]) -> Fragment:
+        escaped = {}
+        for key, value in values.items():
+            value = _formatter.substitute(str(value))
+            if key in self._attribute_fields:
+                value = value.replace('"', '&quot;')
+            escaped[key] = value
+        return Fragment(self._markup.format_map(escaped))
@@ -0,0 +1,181 @@
+import json
+from bisect import bisect_left
+from contextlib import contextmanager
+from os import PathLike
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+# Upper bounds in seconds, the last bucket being +Inf
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+_Key = Tuple[str, Labels]
+
+
+class Histogram:
+    """Counts of observed values per bucket, with their sum"""
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def merge(self, other: 'Histogram'):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the `q` quantile"""
+        rank = q * self.count
+        n = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            n += count
+            if n >= rank and n:
+                return bound
+        return 0.0
+
+
+class Metrics:
+    """Thread-safe registry of counters, gauges and latency histograms, identified by a name and labels
+
+    Metrics recorded in other processes are sent back with ``drain`` and added with ``merge``.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._counters: Dict[_Key, float] = {}
+        self._gauges: Dict[_Key, float] = {}
+        self._histograms: Dict[_Key, Histogram] = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> _Key:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def add(self, name: str, n: float = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        """Observe the time taken by the block, whether it succeeds or not"""
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - start, **labels)
+
+    def histogram(self, name: str, **labels) -> Optional[Histogram]:
+        return self._histograms.get(self._key(name, labels))
+
+    def drain(self) -> 'Metrics':
+        """Metrics recorded so far, which are removed from this registry"""
+        drained = Metrics()
+        with self._lock:
+            drained._counters, self._counters = self._counters, {}
+            drained._gauges, self._gauges = self._gauges, {}
+            drained._histograms, self._histograms = self._histograms, {}
+        return drained
+
+    def merge(self, other: 'Metrics'):
+        with self._lock:
+            for key, n in other._counters.items():
+                self._counters[key] = self._counters.get(key, 0) + n
+            self._gauges.update(other._gauges)
+            for key, histogram in other._histograms.items():
+                if key in self._histograms:
+                    self._histograms[key].merge(histogram)
+                else:
+                    self._histograms[key] = histogram
+
+    def __getstate__(self):
+        with self._lock:
+            return self._counters, self._gauges, self._histograms
+
+    def __setstate__(self, state):
+        self._lock = Lock()
+        self._counters, self._gauges, self._histograms = state
+
+    def to_json(self) -> Dict[str, List[Dict[str, Any]]]:
+        with self._lock:
+            return {
+                'counters': [{'name': n, 'labels': dict(l), 'value': v} for (n, l), v in sorted(self._counters.items())],
+                'gauges': [{'name': n, 'labels': dict(l), 'value': v} for (n, l), v in sorted(self._gauges.items())],
+                'histograms': [{
+                    'name': n, 'labels': dict(l), 'count': h.count, 'sum': h.sum,
+                    'buckets': dict(zip([*map(str, h.buckets), '+Inf'], h.counts)),
+                } for (n, l), h in sorted(self._histograms.items(), key=lambda item: item[0])],
+            }
+
+    def to_prometheus(self, prefix: str = 'izms_') -> str:
+        """Metrics in the Prometheus text format, as read by the textfile collector of node_exporter"""
+        lines = []
+        with self._lock:
+            for kind, metrics in (('counter', self._counters), ('gauge', self._gauges)):
+                for name in sorted({n for n, _ in metrics}):
+                    lines.append(f'# TYPE {prefix}{name} {kind}')
+                    for (n, labels), value in sorted(metrics.items()):
+                        if n == name:
+                            lines.append(f'{prefix}{name}{_format_labels(labels)} {_format_value(value)}')
+            for name in sorted({n for n, _ in self._histograms}):
+                lines.append(f'# TYPE {prefix}{name} histogram')
+                for (n, labels), h in sorted(self._histograms.items(), key=lambda item: item[0]):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip([*map(repr, h.buckets), '+Inf'], h.counts):
+                        cumulative += count
+                        lines.append(f'{prefix}{name}_bucket{_format_labels(labels + (("le", bound),))} {cumulative}')
+                    lines.append(f'{prefix}{name}_sum{_format_labels(labels)} {_format_value(h.sum)}')
+                    lines.append(f'{prefix}{name}_count{_format_labels(labels)} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, json_path: Union[str, PathLike, None] = None, prometheus_path: Union[str, PathLike, None] = None):
+        """Write the metrics to the given files, replacing them at once so readers never see partial files"""
+        if json_path is not None:
+            _replace(Path(json_path), json.dumps(self.to_json(), indent=2, ensure_ascii=False))
+        if prometheus_path is not None:
+            _replace(Path(prometheus_path), self.to_prometheus())
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+    # Timestamps lose their seconds with the few significant digits of '%g'
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _replace(path: Path, text: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f'.{path.name}.tmp')
+    tmp.write_text(text, 'utf-8')
+    tmp.replace(path)
+
+
+# Registry of the metrics of the current process
+metrics = Metrics()
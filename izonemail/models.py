@@ -1,9 +1,14 @@
 from dataclasses import dataclass, field
 from datetime import datetime
 from pathlib import Path
-from typing import Sequence, MutableMapping, Mapping, Optional, Iterator, MutableSequence
+from typing import (
+    TYPE_CHECKING, Sequence, MutableMapping, Mapping, Optional, Iterator, MutableSequence, Callable, Any, Dict, Union
+)
 
-from bs4 import BeautifulSoup
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup
+
+    from .rewriter import StreamingDocument
 
 
 @dataclass
@@ -145,10 +150,24 @@ class Artifact:
     data: bytes
 
 
+@dataclass(frozen=True)
+class MarkupArtifact(Artifact):
+    """Markup of a mail, the only artifact written again by writers which overwrite"""
+
+
+@dataclass(frozen=True)
+class RemoteArtifact:
+    """Artifact downloaded from `url` straight into its path when saved"""
+    path: Path
+    url: str
+
+
 @dataclass(frozen=True)
 class ComposerPayload:
     recipient: User
     header: Mail
-    body: BeautifulSoup
+    body: Union['BeautifulSoup', 'StreamingDocument']
     path: Path
-    artifacts: MutableSequence[Artifact] = field(default_factory=list)
+    artifacts: MutableSequence[Union[Artifact, RemoteArtifact]] = field(default_factory=list)
+    artifact_exists: Callable[[Path], bool] = field(default=lambda path: False, compare=False)
+    context: Dict[Any, Any] = field(default_factory=dict, compare=False)  # Per-mail state of commands
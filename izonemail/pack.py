@@ -0,0 +1,207 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from os import PathLike
+from pathlib import Path
+from tempfile import SpooledTemporaryFile
+from threading import RLock
+from typing import BinaryIO, Iterator, Optional, Tuple, Union
+
+from .fetcher import CHUNK_SIZE, SPOOL_SIZE, ImageFetcher
+from .utils import naive_join
+from .writer import ArtifactWriter
+
+
+class Pack:
+    """Append-only container of files, with an SQLite index of where their content lies
+
+    Identical contents are stored once, identified by their SHA-256 digest. The index
+    (`path` + '.db') maps every path to the offset and size of its content in `path`.
+    Contents are appended before they are indexed, so an interrupted write only leaves
+    unindexed bytes at the end, which are truncated on the next write.
+    """
+    _schema = '''
+        CREATE TABLE IF NOT EXISTS blobs (
+            digest TEXT PRIMARY KEY,
+            offset INTEGER,
+            size INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            digest TEXT,
+            offset INTEGER,
+            size INTEGER
+        );
+    '''
+
+    def __init__(self, path: Union[str, PathLike], fsync: str = 'none'):
+        self._path = Path(path)
+        self._fsync = fsync
+        self._lock = RLock()
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self._path.with_name(self._path.name + '.db'),
+                                     check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(f"PRAGMA synchronous={'FULL' if fsync == 'full' else 'NORMAL'}")
+        self._conn.executescript(self._schema)
+        # Opened on the first write, so that readers in other processes never truncate it
+        self._file: Optional[BinaryIO] = None
+        self._end = 0
+        self.deduplicated = 0
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    def __contains__(self, path: str) -> bool:
+        return self.locate(path) is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def __iter__(self) -> Iterator[str]:
+        with self._lock:
+            paths = [p for p, in self._conn.execute('SELECT path FROM files ORDER BY path')]
+        return iter(paths)
+
+    def locate(self, path: str) -> Optional[Tuple[int, int]]:
+        """Offset and size of the content stored at `path`"""
+        with self._lock:
+            return self._conn.execute('SELECT offset, size FROM files WHERE path = ?', (path,)).fetchone()
+
+    def read(self, path: str) -> bytes:
+        location = self.locate(path)
+        if location is None:
+            raise KeyError(path)
+        offset, size = location
+        with self._path.open('rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def _open(self) -> BinaryIO:
+        if self._file is None:
+            # Discarded contents may still be referenced by other paths
+            self._end = self._conn.execute('SELECT COALESCE(MAX(end), 0) FROM (SELECT MAX(offset + size) AS end '
+                                           'FROM blobs UNION ALL SELECT MAX(offset + size) FROM files)').fetchone()[0]
+            self._file = self._path.open('ab')
+            self._file.truncate(self._end)
+        return self._file
+
+    def add(self, path: str, f: BinaryIO):
+        """Store the content of `f` at `path`, appending it unless an identical content is already stored"""
+        digest = hashlib.sha256()
+        f.seek(0)
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+        digest = digest.hexdigest()
+        size = f.tell()
+        with self._lock:
+            row = self._conn.execute('SELECT offset FROM blobs WHERE digest = ?', (digest,)).fetchone()
+            if row is None:
+                pack = self._open()
+                f.seek(0)
+                shutil.copyfileobj(f, pack, CHUNK_SIZE)
+                pack.flush()
+                if self._fsync != 'none':
+                    os.fsync(pack.fileno())
+                offset, self._end = self._end, self._end + size
+            else:
+                offset, = row
+                self.deduplicated += 1
+            self._conn.execute('BEGIN')
+            try:
+                self._conn.execute('INSERT OR IGNORE INTO blobs VALUES (?, ?, ?)', (digest, offset, size))
+                self._conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (path, digest, offset, size))
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def discard(self, path: str):
+        """Remove `path` from the index, along with its content from deduplication so that it is appended again"""
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                self._conn.execute('DELETE FROM blobs WHERE digest IN (SELECT digest FROM files WHERE path = ?)',
+                                   (path,))
+                self._conn.execute('DELETE FROM files WHERE path = ?', (path,))
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def extract(self, root: Union[str, PathLike], overwrite: bool = False) -> int:
+        """Write every file of the pack under `root`, returning the number of written files"""
+        root = Path(root)
+        n = 0
+        with self._path.open('rb') as pack:
+            for path in self:
+                target = naive_join(root, Path(path))
+                if target.is_file() and not overwrite:
+                    continue
+                offset, size = self.locate(path)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                pack.seek(offset)
+                with target.open('wb') as f:
+                    while size:
+                        chunk = pack.read(min(size, CHUNK_SIZE))
+                        f.write(chunk)
+                        size -= len(chunk)
+                n += 1
+        return n
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._conn.close()
+
+
+def pack_key(path: Path) -> str:
+    """Path of an artifact in a pack, which is relative so that extracted files keep their links"""
+    return naive_join(Path(), path).as_posix()
+
+
+class PackWriter(ArtifactWriter):
+    """Stage writing artifacts into a ``Pack`` at `path` instead of a file each
+
+    Artifacts are spooled in memory, or on disk when large, until they are complete.
+    """
+    def __init__(self, path: Union[str, PathLike], fetcher: Optional[ImageFetcher] = None, max_workers: int = 8,
+                 fsync: str = 'none', overwrite: bool = False, executor: Optional[ThreadPoolExecutor] = None):
+        super(PackWriter, self).__init__(Path(path).parent, fetcher, max_workers, fsync, overwrite, executor)
+        self._pack = Pack(path, fsync)
+
+    @property
+    def pack(self) -> Pack:
+        return self._pack
+
+    def _stored(self, path: Path) -> bool:
+        return pack_key(path) in self._pack
+
+    def read(self, path: Path) -> bytes:
+        return self._pack.read(pack_key(path))
+
+    def discard(self, path: Path):
+        self._pack.discard(pack_key(path))
+        self._existing.discard(path)
+
+    def _create(self, path: Path) -> BinaryIO:
+        return SpooledTemporaryFile(SPOOL_SIZE)
+
+    def _save(self, path: Path, f: BinaryIO) -> int:
+        size = f.tell()
+        self._pack.add(pack_key(path), f)
+        f.close()
+        return size
+
+    def _discard(self, f: BinaryIO):
+        f.close()
+
+    def shutdown(self):
+        super(PackWriter, self).shutdown()
+        self._pack.close()
@@ -0,0 +1,243 @@
+import re
+from typing import Any, Callable, Collection, Dict, List, Mapping, Optional
+
+from bs4 import Tag
+from bs4.builder._lxml import LXMLTreeBuilder
+from bs4.element import AttributeValueWithCharsetSubstitution
+from bs4.formatter import HTMLFormatter
+from lxml import etree
+
+_builder = LXMLTreeBuilder()
+_formatter = HTMLFormatter.REGISTRY['minimal']
+_nonwhitespace_re = re.compile(r'\S+')
+_id_selector_re = re.compile(r'#[\w-]+')
+_ascii_spaces = '\x20\x0a\x09\x0c\x0d'
+_encoding = 'utf-8'
+
+
+def _start_tag(name: str, attrs: Mapping[str, Any], empty: bool) -> str:
+    """Serialize a start tag exactly like ``Tag.decode`` with the minimal formatter"""
+    s = '<' + name
+    for key, val in sorted(attrs.items()):
+        if val is None:
+            s += ' ' + key
+            continue
+        if isinstance(val, list):
+            val = ' '.join(val)
+        elif isinstance(val, AttributeValueWithCharsetSubstitution):
+            val = val.substitute_encoding(_encoding)
+        s += ' ' + key + '=' + _formatter.quoted_attribute_value(_formatter.attribute_value(val))
+    return s + ('/>' if empty else '>')
+
+
+class _StartTag:
+    """Start tag of an element given to visitors, serialized once the document is complete"""
+    __slots__ = ('tag', 'empty')
+
+    def __init__(self, tag: Tag, empty: bool):
+        self.tag = tag
+        self.empty = empty
+
+    def __str__(self):
+        if self.tag.decomposed:
+            return ''
+        return _start_tag(self.tag.name, self.tag.attrs, self.empty)
+
+
+class _Slot(list):
+    """Tags inserted at a position of the document after it has been rewritten"""
+    def __str__(self):
+        return ''.join(t.decode(eventual_encoding=_encoding) if isinstance(t, Tag) else str(t) for t in self)
+
+
+class _Anchor:
+    """Element of a ``StreamingDocument`` before or at the end of which tags can be inserted"""
+    def __init__(self, name: str, before: _Slot, end: Optional[_Slot]):
+        self._name = name
+        self._before = before
+        self._end = end
+
+    def insert_before(self, *args: Tag):
+        self._before.extend(args)
+
+    def append(self, tag: Tag):
+        if self._end is None:
+            raise ValueError(f'<{self._name}> is a void element, which cannot contain {tag.name!r}')
+        self._end.append(tag)
+
+
+class StreamingDocument:
+    """Markup rewritten in a single pass of the lxml tokenizer, without building a tree
+
+    The tokenizer events are the ones ``BeautifulSoup(markup, 'lxml')`` builds its tree from and
+    they are serialized the same way, so ``encode`` returns the same bytes as the soup would.
+    Tags whose name is in `names` are given to `visit` as they are found, which can modify or
+    ``decompose`` them; everything else is written out right away. The document implements the
+    subset of the ``BeautifulSoup`` API used by commands to insert tags afterwards:
+    ``new_tag``, ``head`` and ``select_one('#id')``, whose elements support ``insert_before``
+    and ``append``.
+    """
+    def __init__(self):
+        self._chunks: List[Any] = []
+        self._data: List[str] = []
+        self._stack: List[Optional[_Slot]] = []  # End slot of each open element
+        self._names: List[str] = []
+        self._preserve = 0  # Number of open elements preserving whitespace
+        self._skip = 0  # Depth inside a decomposed element
+        self._void = None  # Void element with no content yet, serialized as self-closing
+        self._head: Optional[_Anchor] = None
+        self._ids: Dict[str, _Anchor] = {}
+        self._match: Collection[str] = ()
+        self._visit: Optional[Callable[[Tag], None]] = None
+
+    def feed(self, markup: str, names: Collection[str] = (), visit: Optional[Callable[[Tag], None]] = None):
+        self._match = names
+        self._visit = visit
+        if markup[:1] == '\N{BYTE ORDER MARK}':
+            markup = markup[1:]
+        parser = etree.HTMLParser(target=self, recover=True, encoding=None)
+        parser.feed(markup)
+        parser.close()
+        self._end_data()
+
+    # lxml parser target interface
+    def start(self, name: str, attrib, nsmap=None):
+        self._end_data()
+        self._names.append(name)
+        if name in _builder.preserve_whitespace_tags:
+            self._preserve += 1
+        if self._skip:
+            self._skip += 1
+            self._stack.append(None)
+            return
+        empty = name in _builder.empty_element_tags
+        if name in self._match or name == 'meta':
+            # Real tags, so visitors and charset substitution work just like in the soup
+            tag = Tag(None, _builder, name, attrs=dict(attrib))
+            if name in self._match:
+                self._visit(tag)
+                if tag.decomposed:
+                    self._skip = 1
+                    self._stack.append(None)
+                    return
+            attrs = tag.attrs
+            chunk = _StartTag(tag, empty)
+        else:
+            attrs = self._attrs(name, attrib)
+            chunk = _start_tag(name, attrs, empty)
+        end = None
+        if name == 'head' and self._head is None:
+            end = _Slot()
+            self._head = _Anchor(name, self._before(), end)
+        elif 'id' in attrs and attrs['id'] not in self._ids:
+            # Void elements end right away, and an end slot would give them content
+            end = None if empty else _Slot()
+            self._ids[attrs['id']] = _Anchor(name, self._before(), end)
+        self._emit(chunk)
+        if empty:
+            self._void = chunk
+        self._stack.append(end)
+
+    def end(self, name: str):
+        self._end_data()
+        self._names.pop()
+        end = self._stack.pop()
+        if name in _builder.preserve_whitespace_tags:
+            self._preserve -= 1
+        if self._skip:
+            self._skip -= 1
+            return
+        if end is not None:
+            self._emit(end)
+        if self._void is not None:
+            # Nothing has been written inside
+            self._void = None
+        else:
+            self._emit(f'</{name}>')
+
+    def data(self, data: str):
+        self._data.append(data)
+
+    def comment(self, text: str):
+        self._end_data()
+        self._data.append(text)
+        self._end_data('<!--', '-->')
+
+    def doctype(self, name: str, pubid: str, system: str):
+        self._end_data()
+        value = name or ''
+        if pubid is not None:
+            value += f' PUBLIC "{pubid}"'
+            if system is not None:
+                value += f' "{system}"'
+        elif system is not None:
+            value += f' SYSTEM "{system}"'
+        self._data.append(value)
+        self._end_data('<!DOCTYPE ', '>\n')
+
+    def pi(self, target: str, data: str):
+        self._end_data()
+        self._data.append(target + ' ' + data)
+        self._end_data('<?', '>')
+
+    def close(self):
+        pass
+
+    def _end_data(self, prefix: Optional[str] = None, suffix: str = ''):
+        """Write the text collected since the last event, collapsing whitespace like ``BeautifulSoup.endData``"""
+        if not self._data:
+            return
+        text = ''.join(self._data)
+        self._data = []
+        if not self._preserve and not text.strip(_ascii_spaces):
+            text = '\n' if '\n' in text else ' '
+        if self._skip:
+            return
+        if prefix is not None:
+            text = prefix + text + suffix
+        elif not self._names or self._names[-1] not in _formatter.cdata_containing_tags:
+            text = _formatter.substitute(text)
+        self._emit(text)
+
+    def _emit(self, chunk):
+        if self._void is not None:
+            # The void element has content after all
+            if isinstance(self._void, _StartTag):
+                self._void.empty = False
+            else:
+                self._chunks[-1] = self._void[:-2] + '>'
+            self._void = None
+        self._chunks.append(chunk)
+
+    def _before(self) -> _Slot:
+        slot = _Slot()
+        self._emit(slot)
+        return slot
+
+    @staticmethod
+    def _attrs(name: str, attrib) -> Dict[str, Any]:
+        attrs = dict(attrib)
+        cdata_list = _builder.cdata_list_attributes
+        for key in cdata_list['*'].union(cdata_list.get(name, ())).intersection(attrs):
+            attrs[key] = _nonwhitespace_re.findall(attrs[key])
+        return attrs
+
+    # Subset of the BeautifulSoup API
+    @property
+    def head(self) -> Optional[_Anchor]:
+        return self._head
+
+    def select_one(self, selector: str) -> Optional[_Anchor]:
+        if not _id_selector_re.fullmatch(selector):
+            raise ValueError(f'StreamingDocument only supports id selectors like #mail-detail, not {selector!r}')
+        return self._ids.get(selector[1:])
+
+    @staticmethod
+    def new_tag(name: str, attrs: Optional[Mapping[str, str]] = None) -> Tag:
+        return Tag(None, _builder, name, attrs=attrs)
+
+    def decode(self) -> str:
+        return ''.join(map(str, self._chunks))
+
+    def encode(self) -> bytes:
+        return self.decode().encode(_encoding, 'xmlcharrefreplace')
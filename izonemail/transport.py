@@ -0,0 +1,195 @@
+import asyncio
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from threading import Condition, Lock
+from time import monotonic
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+RETRY_STATUSES = frozenset({429, 503})
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse the value of a ``Retry-After`` header into seconds"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        dt = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return max(0.0, (dt - datetime.now(timezone.utc)).total_seconds())
+
+
+class PoolStats:
+    """Thread-safe counters of connection pool events"""
+    _fields = ('new', 'reused', 'discarded')
+
+    def __init__(self):
+        self._lock = Lock()
+        self.new = 0
+        self.reused = 0
+        self.discarded = 0
+
+    def add(self, name: str, n: int = 1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def __iadd__(self, other: 'PoolStats'):
+        for name in self._fields:
+            self.add(name, getattr(other, name))
+        return self
+
+    def __str__(self):
+        return ' / '.join(f'{name}: {getattr(self, name)}' for name in self._fields)
+
+
+class _AIMD:
+    """Additive-increase/multiplicative-decrease controller of the number of in-flight requests
+
+    The limit grows by about one every `limit` healthy responses and is halved on errors,
+    throttling or responses slower than `latency_target`, at most once per `latency_target`.
+    """
+    def __init__(self, initial: int, maximum: int, latency_target: float):
+        self._limit = float(min(initial, maximum))
+        self._maximum = maximum
+        self._latency_target = latency_target
+        self._in_flight = 0
+        self._resume_at = 0.0
+        self._last_decrease = 0.0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def _wait_time(self) -> Optional[float]:
+        """0 if a request can start now, seconds to sleep if deferred, None if the limit is reached"""
+        delay = self._resume_at - monotonic()
+        if delay > 0:
+            return delay
+        return 0 if self._in_flight < self.limit else None
+
+    def _update(self, latency: float, ok: bool):
+        self._in_flight -= 1
+        if ok and latency <= self._latency_target:
+            self._limit = min(self._maximum, self._limit + 1 / self._limit)
+        elif monotonic() - self._last_decrease >= self._latency_target:
+            self._limit = max(1.0, self._limit / 2)
+            self._last_decrease = monotonic()
+
+    def _defer(self, seconds: float):
+        self._resume_at = max(self._resume_at, monotonic() + seconds)
+
+
+class AIMDLimiter(_AIMD):
+    """Thread-safe ``_AIMD`` limiter"""
+    def __init__(self, initial: int = 8, maximum: int = 64, latency_target: float = 2.0):
+        super(AIMDLimiter, self).__init__(initial, maximum, latency_target)
+        self._cond = Condition()
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                delay = self._wait_time()
+                if delay == 0:
+                    break
+                self._cond.wait(delay)
+            self._in_flight += 1
+
+    def release(self, latency: float, ok: bool):
+        with self._cond:
+            self._update(latency, ok)
+            self._cond.notify_all()
+
+    def defer(self, seconds: float):
+        """Hold back every new request to this host for `seconds` (e.g. ``Retry-After``)"""
+        with self._cond:
+            self._defer(seconds)
+
+
+class AsyncAIMDLimiter(_AIMD):
+    """Coroutine version of ``AIMDLimiter``. Must be created in the event loop using it."""
+    def __init__(self, initial: int = 8, maximum: int = 64, latency_target: float = 2.0):
+        super(AsyncAIMDLimiter, self).__init__(initial, maximum, latency_target)
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            while True:
+                delay = self._wait_time()
+                if delay == 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._cond.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            self._in_flight += 1
+
+    async def release(self, latency: float, ok: bool):
+        async with self._cond:
+            self._update(latency, ok)
+            self._cond.notify_all()
+
+    def defer(self, seconds: float):
+        self._defer(seconds)
+
+
+class Transport:
+    """Per-host concurrency limits and retry policy shared by the sync and async sessions
+
+    Every host (API, web and image hosts) gets its own AIMD limiter starting at `initial_limit`
+    in-flight requests and growing up to `max_limit`. Connection errors, timeouts and
+    429/503 responses are retried up to `max_retries` times with exponential backoff and
+    full jitter, honoring ``Retry-After`` when the server sends one.
+    """
+    def __init__(self, initial_limit: int = 8, max_limit: int = 64, latency_target: float = 2.0,
+                 max_retries: int = 3, backoff_factor: float = 0.5, max_backoff: float = 30):
+        self.initial_limit = initial_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self._lock = Lock()
+        self._limiters: Dict[str, AIMDLimiter] = {}
+        self._async_limiters: Dict[str, AsyncAIMDLimiter] = {}
+        self._loop = None
+
+    def limiter(self, url: str) -> AIMDLimiter:
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._limiters:
+                self._limiters[host] = AIMDLimiter(self.initial_limit, self.max_limit, self.latency_target)
+            return self._limiters[host]
+
+    def async_limiter(self, url: str) -> AsyncAIMDLimiter:
+        # Async limiters are bound to the event loop they were created in
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._async_limiters.clear()
+            self._loop = loop
+        host = urlparse(url).netloc
+        if host not in self._async_limiters:
+            self._async_limiters[host] = AsyncAIMDLimiter(self.initial_limit, self.max_limit, self.latency_target)
+        return self._async_limiters[host]
+
+    def backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        delay = parse_retry_after(retry_after)
+        if delay is not None:
+            return min(delay, self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** attempt))
+
+    def limits(self) -> Dict[str, int]:
+        """Current in-flight limit of each host"""
+        limiters = {**self._limiters, **self._async_limiters}
+        return {host: limiter.limit for host, limiter in limiters.items()}
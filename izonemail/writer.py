@@ -0,0 +1,312 @@
+import asyncio
+import hashlib
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from os import PathLike
+from pathlib import Path
+from stat import S_ISREG
+from threading import Lock, RLock
+from time import monotonic
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+from uuid import uuid4
+
+from .fetcher import ImageFetcher
+from .metrics import metrics
+from .models import Artifact, MarkupArtifact, RemoteArtifact
+from .utils import naive_join
+
+AnyArtifact = Union[Artifact, RemoteArtifact]
+FSYNC_POLICIES = ('none', 'file', 'full')
+
+
+class WriterStats:
+    """Thread-safe counters of written artifacts"""
+    def __init__(self):
+        self._lock = Lock()
+        self.files = 0
+        self.bytes = 0
+        self.skipped = 0
+        self._first = None
+        self._last = None
+
+    def add(self, size: int, start: float):
+        end = monotonic()
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+            self._first = start if self._first is None else min(self._first, start)
+            self._last = end if self._last is None else max(self._last, end)
+
+    def skip(self, n: int = 1):
+        with self._lock:
+            self.skipped += n
+
+    @property
+    def elapsed(self) -> float:
+        """Seconds from the start of the first write to the end of the last one"""
+        return 0.0 if self._first is None else self._last - self._first
+
+    @property
+    def throughput(self) -> float:
+        """Bytes written per second"""
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        mib = 2 ** 20
+        return (f'files: {self.files} / skipped: {self.skipped} / '
+                f'{self.bytes / mib:.1f} MiB in {self.elapsed:.1f}s ({self.throughput / mib:.1f} MiB/s)')
+
+
+class _DigestingFile:
+    """File counting and hashing with SHA-256 what is written into it"""
+    def __init__(self, f: BinaryIO):
+        self._f = f
+        self._digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, b: bytes) -> int:
+        self._digest.update(b)
+        self.size += len(b)
+        return self._f.write(b)
+
+    def hexdigest(self) -> str:
+        return self._digest.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+class ArtifactWriter:
+    """Stage writing artifacts into `root` on its own pool of threads
+
+    Files are written under temporary names and renamed once complete, so they are either whole or
+    absent. Created directories and existing files are remembered, so artifacts shared by many mails
+    cost no syscall after the first one. Files must not be removed from `root` while writing.
+
+    `fsync` is one of ``'none'``, ``'file'`` to flush files to disk before they are renamed,
+    or ``'full'`` to flush the renames as well.
+
+    With `overwrite`, the markup of mails found in `root` is written again, once per writer. Other
+    artifacts, such as stylesheets and images, are still only written if missing.
+
+    `executor` is a pool of threads shared with other writers instead of one of `max_workers`,
+    which is left to be shut down by its owner.
+    """
+    def __init__(self, root: Union[str, PathLike], fetcher: Optional[ImageFetcher] = None, max_workers: int = 8,
+                 fsync: str = 'none', overwrite: bool = False, executor: Optional[ThreadPoolExecutor] = None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f'fsync must be one of {list(FSYNC_POLICIES)}')
+        self._root = Path(root)
+        self._fetcher = fetcher or ImageFetcher()
+        self._shared_executor = executor is not None
+        self._executor = executor or ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ArtifactWriter')
+        self._fsync = fsync
+        self._overwrite = overwrite
+        # Only ever added to, so a race merely repeats a syscall
+        self._dirs: Set[Path] = set()
+        self._existing: Set[Path] = set()
+        self._lock = RLock()
+        self._in_flight: Dict[Path, Future] = {}
+        self._in_flight_async: Dict[Path, asyncio.Future] = {}
+        self.stats = WriterStats()
+        # Called with every artifact written, its size and SHA-256 digest, from the thread which wrote it
+        self.on_saved: Optional[Callable[[AnyArtifact, int, str], None]] = None
+        # Size an artifact is known to have, if any. Files of another size, e.g. truncated by a crash
+        # or a full disk, are not taken as written
+        self.expected_size: Optional[Callable[[Path], Optional[int]]] = None
+
+    def _stored(self, path: Path) -> bool:
+        try:
+            st = naive_join(self._root, path).stat()
+        except OSError:
+            return False
+        if not S_ISREG(st.st_mode):
+            return False
+        expected = self.expected_size and self.expected_size(path)
+        # Without a known size, only an empty file is taken as truncated
+        return st.st_size > 0 if expected is None else st.st_size == expected
+
+    def exists(self, path: Path) -> bool:
+        if path in self._existing:
+            return True
+        if self._stored(path):
+            self._existing.add(path)
+            return True
+        return False
+
+    def _written(self, item: AnyArtifact) -> bool:
+        if self._overwrite and isinstance(item, MarkupArtifact):
+            return item.path in self._existing
+        return self.exists(item.path)
+
+    def read(self, path: Path) -> bytes:
+        """Content of an artifact already written"""
+        return naive_join(self._root, path).read_bytes()
+
+    def discard(self, path: Path):
+        """Remove an artifact already written, e.g. found corrupt, so that it is written again"""
+        naive_join(self._root, path).unlink(missing_ok=True)
+        self._existing.discard(path)
+
+    def _create(self, path: Path) -> BinaryIO:
+        """Open a temporary file to write the artifact at `path` into"""
+        target = naive_join(self._root, path)
+        if target.parent not in self._dirs:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            self._dirs.add(target.parent)
+        return target.with_name(f'.{target.name}.{uuid4().hex}.tmp').open('xb')
+
+    def _save(self, path: Path, f: BinaryIO) -> int:
+        """Store the content written into `f` at `path`, returning its size"""
+        if self._fsync != 'none':
+            f.flush()
+            os.fsync(f.fileno())
+        size = f.tell()
+        f.close()
+        target = naive_join(self._root, path)
+        Path(f.name).replace(target)
+        if self._fsync == 'full':
+            _fsync_directory(target.parent)
+        return size
+
+    def _discard(self, f: BinaryIO):
+        f.close()
+        Path(f.name).unlink(missing_ok=True)
+
+    def _commit(self, path: Path, f: BinaryIO, start: float):
+        commit_start = monotonic()
+        try:
+            size = self._save(path, f)
+        except BaseException:
+            self._discard(f)
+            raise
+        self._existing.add(path)
+        self.stats.add(size, start)
+        # Downloads into the file are measured as images, so only flushing and renaming is left
+        metrics.observe('stage_seconds', monotonic() - commit_start, stage='write')
+        metrics.add('bytes_total', size, stage='write')
+
+    @contextmanager
+    def _open(self, path: Path) -> Iterator[_DigestingFile]:
+        start = monotonic()
+        f = _DigestingFile(self._create(path))
+        try:
+            yield f
+        except BaseException:
+            self._discard(f)
+            raise
+        self._commit(path, f, start)
+
+    def _saved(self, item: AnyArtifact, f: _DigestingFile):
+        if self.on_saved is not None:
+            self.on_saved(item, f.size, f.hexdigest())
+
+    def _write(self, item: AnyArtifact):
+        # Double-check presence of files due to the absence of exclusive access
+        if self._written(item):
+            self.stats.skip()
+            return
+        with self._open(item.path) as f:
+            if isinstance(item, RemoteArtifact):
+                self._fetcher.download(item.url, f)
+            else:
+                self._fetcher.write(item.data, f)
+        self._saved(item, f)
+
+    def submit(self, item: AnyArtifact) -> Future:
+        """Queue the write of an artifact, sharing the one in progress to the same path"""
+        with self._lock:
+            future = self._in_flight.get(item.path)
+            if future is None:
+                future = self._executor.submit(self._write, item)
+                self._in_flight[item.path] = future
+                future.add_done_callback(lambda _: self._forget(item.path))
+        return future
+
+    def _forget(self, path: Path):
+        with self._lock:
+            self._in_flight.pop(path, None)
+
+    def _pending(self, artifacts: Iterable[AnyArtifact]) -> Tuple[List[RemoteArtifact], List[Artifact]]:
+        pending = []
+        for a in artifacts:
+            if self._written(a):
+                self.stats.skip()
+            else:
+                pending.append(a)
+        return [a for a in pending if isinstance(a, RemoteArtifact)], [a for a in pending if isinstance(a, Artifact)]
+
+    def write(self, artifacts: Iterable[AnyArtifact]):
+        """Write the artifacts missing from `root`, downloading the content they refer to
+
+        Remote artifacts are downloaded concurrently and first, then the others are written in order,
+        so the markup is only written once everything it links to is.
+        """
+        downloads, artifacts = self._pending(artifacts)
+        for future in [self.submit(a) for a in downloads]:
+            future.result()
+        for a in artifacts:
+            self.submit(a).result()
+
+    async def _write_async(self, item: AnyArtifact):
+        if self._written(item):
+            self.stats.skip()
+            return
+        start = monotonic()
+        f = _DigestingFile(self._create(item.path))
+        try:
+            if isinstance(item, RemoteArtifact):
+                await self._fetcher.download_async(item.url, f)
+            else:
+                await self._fetcher.write_async(item.data, f)
+        except BaseException:
+            self._discard(f)
+            raise
+        # Flushing and renaming may block for long on some filesystems
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._commit, item.path, f, start)
+        self._saved(item, f)
+
+    async def submit_async(self, item: AnyArtifact):
+        task = self._in_flight_async.get(item.path)
+        if task is None:
+            task = asyncio.ensure_future(self._write_async(item))
+            self._in_flight_async[item.path] = task
+            task.add_done_callback(lambda _: self._in_flight_async.pop(item.path, None))
+        # A cancelled waiter must not cancel the write other mails are waiting for
+        await asyncio.shield(task)
+
+    async def write_async(self, artifacts: Iterable[AnyArtifact]):
+        downloads, artifacts = self._pending(artifacts)
+        await asyncio.gather(*(self.submit_async(a) for a in downloads))
+        for a in artifacts:
+            await self.submit_async(a)
+
+    def shutdown(self):
+        if not self._shared_executor:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+class DeferredWriter(ArtifactWriter):
+    """Writer of a composer which only renders mails, e.g. in a compose process, leaving their artifacts
+    to be saved by the writer of another composer
+
+    No artifact is taken as written, as neither the pack nor the sizes they were written with are known
+    here. The writer saving them skips those it has, but for the markup of mails when it overwrites.
+    """
+    def __init__(self, root: Union[str, PathLike], fetcher: Optional[ImageFetcher] = None):
+        super(DeferredWriter, self).__init__(root, fetcher, max_workers=1)
+
+    def _stored(self, path: Path) -> bool:
+        return False
+
+
+def _fsync_directory(path: Path):
+    # Directories cannot be opened on Windows, where renames are journaled anyway
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
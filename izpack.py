@@ -0,0 +1,76 @@
+import mimetypes
+import sys
+from argparse import ArgumentParser
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import quote, unquote, urlsplit
+
+from izonemail import Pack
+
+
+class PackRequestHandler(BaseHTTPRequestHandler):
+    """Serve the files of a pack at their path, so that relative links between them resolve"""
+    pack: Pack
+
+    def do_GET(self):
+        path = unquote(urlsplit(self.path).path).lstrip('/')
+        if not path:
+            return self._send(200, 'text/html; charset=utf-8', self._listing())
+        try:
+            data = self.pack.read(path)
+        except KeyError:
+            return self.send_error(404)
+        self._send(200, mimetypes.guess_type(path)[0] or 'application/octet-stream', data)
+
+    def _listing(self) -> bytes:
+        links = (f'<li><a href="/{quote(p)}">{escape(p)}</a></li>' for p in self.pack if p.endswith('.html'))
+        return f'<!DOCTYPE html><meta charset="utf-8"><ul>{"".join(links)}</ul>'.encode()
+
+    def _send(self, status: int, content_type: str, data: bytes):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def main():
+    parser = ArgumentParser(description='Read the pack of mails written by izms.py with the `pack` option.')
+    parser.add_argument('pack', type=Path, metavar='<pack>', help='Pack file, e.g. incoming/mails.pack')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('ls', help='List the files of the pack.')
+    extract = commands.add_parser('extract', help='Write the files of the pack into a directory.')
+    extract.add_argument('destination', type=Path, metavar='<dir>')
+    extract.add_argument('--overwrite', action='store_true', help='Overwrite existing files.')
+    serve = commands.add_parser('serve', help='Serve the files of the pack over HTTP.')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    if not args.pack.is_file():
+        print(f"❌️ File '{args.pack}' missing!", file=sys.stderr)
+        return -1
+    pack = Pack(args.pack)
+    try:
+        if args.command == 'ls':
+            for path in pack:
+                print(path)
+        elif args.command == 'extract':
+            n = pack.extract(args.destination, args.overwrite)
+            print(f'Extracted {n} files into {args.destination}')
+        else:
+            PackRequestHandler.pack = pack
+            with ThreadingHTTPServer((args.host, args.port), PackRequestHandler) as server:
+                print(f'Serving {args.pack} on http://{args.host}:{args.port}/')
+                try:
+                    server.serve_forever()
+                except KeyboardInterrupt:
+                    pass
+    finally:
+        pack.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,523 @@
+import asyncio
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from queue import PriorityQueue, Queue
+from threading import Event, Thread
+from typing import (
+    TYPE_CHECKING, AsyncIterable, AsyncIterator, Awaitable, Callable, Hashable, Iterable, Iterator, List, Optional,
+    Sequence, Tuple, TypeVar,
+)
+
+from izonemail import IZONEMail, AsyncIZONEMail, Inbox, Mail, User, ImageFetcher, DeferredFetcher
+from izonemail.metrics import Metrics, metrics
+from izonemail.writer import AnyArtifact
+
+if TYPE_CHECKING:
+    from izonemail import MailComposer
+
+T = TypeVar('T')
+
+
+def _mail_order(mail: Mail) -> Tuple[Hashable, ...]:
+    return mail.received, mail.id
+
+
+class InboxCrawler:
+    """Iterate new mails of the inbox from the newest one, prefetching the following pages
+
+    Iteration stops at the first mail for which `is_known` returns True, or at the last page.
+    `first_page` can be given to reuse an already fetched first page.
+    """
+    def __init__(self, app: IZONEMail, is_known: Callable[[str], bool], prefetch: int = 2,
+                 first_page: Optional[Inbox] = None):
+        self._app = app
+        self._is_known = is_known
+        self._prefetch = prefetch
+        self._first_page = first_page
+        self.completed = False
+
+    def __iter__(self) -> Iterator[Mail]:
+        executor = ThreadPoolExecutor(max_workers=self._prefetch)
+        pending = deque()
+        next_page = 1 if self._first_page is None else 2
+        inbox = self._first_page
+        try:
+            while True:
+                if inbox is None:
+                    # Pages beyond the last one are fetched speculatively and discarded
+                    while len(pending) < self._prefetch:
+                        pending.append(executor.submit(self._app.get_inbox, next_page))
+                        next_page += 1
+                    inbox = pending.popleft().result()
+                for mail in inbox:
+                    if self._is_known(mail.id):
+                        self.completed = True
+                        return
+                    yield mail
+                if not inbox.has_next_page:
+                    self.completed = True
+                    return
+                inbox = None
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+class AsyncInboxCrawler:
+    """Coroutine version of ``InboxCrawler``"""
+    def __init__(self, app: AsyncIZONEMail, is_known: Callable[[str], bool], prefetch: int = 2,
+                 first_page: Optional[Inbox] = None):
+        self._app = app
+        self._is_known = is_known
+        self._prefetch = prefetch
+        self._first_page = first_page
+        self.completed = False
+
+    async def __aiter__(self) -> AsyncIterator[Mail]:
+        pending = deque()
+        next_page = 1 if self._first_page is None else 2
+        inbox = self._first_page
+        try:
+            while True:
+                if inbox is None:
+                    while len(pending) < self._prefetch:
+                        pending.append(asyncio.ensure_future(self._app.get_inbox(next_page)))
+                        next_page += 1
+                    inbox = await pending.popleft()
+                for mail in inbox:
+                    if self._is_known(mail.id):
+                        self.completed = True
+                        return
+                    yield mail
+                if not inbox.has_next_page:
+                    self.completed = True
+                    return
+                inbox = None
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+class PageProbe:
+    """Find the last page of the inbox by doubling the page number, then bisecting
+
+    Pages past the last one are empty. Probed pages are kept in `pages`, so that they are not
+    requested again. If the inbox changes while it is probed, `last` may be off by a few pages.
+    """
+    def __init__(self, first_page: Inbox):
+        self.pages = {1: first_page}
+        self.last: Optional[int] = None if first_page.has_next_page else 1
+        self._lo = 1  # Greatest page known to have a next page
+        self._hi: Optional[int] = None  # Least page known to be past the last one
+
+    @property
+    def known(self) -> int:
+        """Greatest page known to exist"""
+        return self.last or self._lo
+
+    def next_page(self) -> Optional[int]:
+        """Page to probe next, or None once `last` is known"""
+        if self.last is not None:
+            return None
+        return self._lo * 2 if self._hi is None else (self._lo + self._hi) // 2
+
+    def observe(self, page: int, inbox: Inbox):
+        self.pages[page] = inbox
+        if inbox.has_next_page:
+            self._lo = page
+        elif inbox.mails:
+            self.last = page
+        else:
+            self._hi = page
+        if self.last is None and self._hi is not None and self._hi - self._lo <= 1:
+            self.last = self._lo
+
+
+class _Backfill:
+    """Mails of the pages walked by a backfill crawler, each yielded once over all walks"""
+    def __init__(self, is_known: Callable[[str], bool]):
+        self._is_known = is_known
+        self._seen = set()
+        self.caught_up = False
+
+    def mails(self, inbox: Inbox) -> Iterator[Mail]:
+        """New mails of `inbox`, setting `caught_up` at the first known one or at the last page"""
+        for mail in inbox:
+            if mail.id in self._seen:
+                continue
+            self._seen.add(mail.id)
+            if self._is_known(mail.id):
+                self.caught_up = True
+                return
+            yield mail
+        if not inbox.has_next_page:
+            self.caught_up = True
+
+
+def _newest(inbox: Inbox) -> Optional[str]:
+    return inbox[0].id if inbox else None
+
+
+class BackfillCrawler:
+    """Iterate new mails of the inbox from the newest one, fetching every page concurrently
+
+    Meant for inboxes with no known mail yet: the last page is probed first with ``PageProbe``,
+    then all pages are requested at once on `max_workers` threads, bounded by the limits of the
+    transport, and their mails are yielded in order. Iteration stops like ``InboxCrawler``.
+
+    Mails arriving during a walk shift the others to later pages, so that a page requested
+    before the previous one may miss some. The inbox is walked again, skipping yielded mails,
+    until its newest mail is the same before and after a walk.
+    """
+    def __init__(self, app: IZONEMail, is_known: Callable[[str], bool], max_workers: int = 8,
+                 first_page: Optional[Inbox] = None):
+        self._app = app
+        self._is_known = is_known
+        self._max_workers = max_workers
+        self._first_page = first_page
+        self.completed = False
+
+    def __iter__(self) -> Iterator[Mail]:
+        executor = ThreadPoolExecutor(max_workers=self._max_workers)
+        backfill = _Backfill(self._is_known)
+        first_page = self._first_page if self._first_page is not None else self._app.get_inbox(1)
+        try:
+            while True:
+                yield from self._walk(executor, first_page, backfill)
+                page = self._app.get_inbox(1)
+                if _newest(page) == _newest(first_page):
+                    break
+                first_page = page
+            self.completed = True
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _walk(self, executor: ThreadPoolExecutor, first_page: Inbox, backfill: _Backfill) -> Iterator[Mail]:
+        probe = PageProbe(first_page)
+        pending = {1: first_page}
+
+        def submit(up_to):
+            for page in range(len(pending) + 1, up_to + 1):
+                if page in probe.pages:
+                    pending[page] = probe.pages[page]
+                else:
+                    pending[page] = executor.submit(self._app.get_inbox, page)
+
+        backfill.caught_up = False
+        try:
+            # Pages known to exist are requested while the last one is being probed
+            while (page := probe.next_page()) is not None:
+                probe.observe(page, self._app.get_inbox(page))
+                submit(probe.known)
+            submit(probe.last)
+            page = 1
+            while not backfill.caught_up:
+                inbox = pending.get(page)
+                if inbox is None:
+                    # The inbox has grown past the probed last page
+                    inbox = self._app.get_inbox(page)
+                elif not isinstance(inbox, Inbox):
+                    inbox = inbox.result()
+                yield from backfill.mails(inbox)
+                page += 1
+        finally:
+            for future in pending.values():
+                if not isinstance(future, Inbox):
+                    future.cancel()
+
+
+class AsyncBackfillCrawler:
+    """Coroutine version of ``BackfillCrawler``, bounded by the limits of the transport only"""
+    def __init__(self, app: AsyncIZONEMail, is_known: Callable[[str], bool], first_page: Optional[Inbox] = None):
+        self._app = app
+        self._is_known = is_known
+        self._first_page = first_page
+        self.completed = False
+
+    async def __aiter__(self) -> AsyncIterator[Mail]:
+        backfill = _Backfill(self._is_known)
+        first_page = self._first_page if self._first_page is not None else await self._app.get_inbox(1)
+        while True:
+            walk = self._walk(first_page, backfill)
+            try:
+                async for mail in walk:
+                    yield mail
+            finally:
+                # Cancels the pending requests when iteration stops early
+                await walk.aclose()
+            page = await self._app.get_inbox(1)
+            if _newest(page) == _newest(first_page):
+                break
+            first_page = page
+        self.completed = True
+
+    async def _walk(self, first_page: Inbox, backfill: _Backfill) -> AsyncIterator[Mail]:
+        probe = PageProbe(first_page)
+        pending = {1: first_page}
+
+        def submit(up_to):
+            for page in range(len(pending) + 1, up_to + 1):
+                if page in probe.pages:
+                    pending[page] = probe.pages[page]
+                else:
+                    pending[page] = asyncio.ensure_future(self._app.get_inbox(page))
+
+        backfill.caught_up = False
+        try:
+            while (page := probe.next_page()) is not None:
+                probe.observe(page, await self._app.get_inbox(page))
+                submit(probe.known)
+            submit(probe.last)
+            page = 1
+            while not backfill.caught_up:
+                inbox = pending.get(page)
+                if inbox is None:
+                    inbox = await self._app.get_inbox(page)
+                elif not isinstance(inbox, Inbox):
+                    inbox = await inbox
+                for mail in backfill.mails(inbox):
+                    yield mail
+                page += 1
+        finally:
+            tasks = [t for t in pending.values() if not isinstance(t, Inbox)]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class ThreadedDownloader:
+    """Run `process` on a pool of worker threads for each mail produced by an iterable
+
+    The iterable is consumed on a background thread, so downloading starts as soon as
+    the first mail is produced. Workers always pick the oldest pending mail, which lets
+    the commit watermark advance while the rest is still being downloaded.
+    Mails are yielded in order of completion. Other items can be downloaded with a `key`
+    ordering them like mails, oldest first.
+    """
+    _sentinel = ((datetime.max,), 0, None)
+
+    def __init__(self, process: Callable[[T], T], max_workers: int, key: Callable[[T], Tuple] = _mail_order):
+        self._process = process
+        self._max_workers = max_workers
+        self._key = key
+
+    def run(self, mails: Iterable[T]) -> Iterator[T]:
+        pending = PriorityQueue()
+        done = Queue()
+        stop = Event()
+
+        def produce():
+            n = 0
+            try:
+                for mail in mails:
+                    if stop.is_set():
+                        break
+                    n += 1
+                    pending.put((self._key(mail), n, mail))
+            except BaseException as e:
+                done.put(('error', e))
+            else:
+                done.put(('total', n))
+            finally:
+                for _ in range(self._max_workers):
+                    pending.put(self._sentinel)
+
+        def work():
+            while not stop.is_set():
+                _, _, mail = pending.get()
+                if mail is None:
+                    break
+                try:
+                    done.put(('done', self._process(mail)))
+                except BaseException as e:
+                    done.put(('error', e))
+
+        producer = Thread(target=produce, daemon=True)
+        workers = [Thread(target=work, daemon=True) for _ in range(self._max_workers)]
+        producer.start()
+        for worker in workers:
+            worker.start()
+        total, n_done = None, 0
+        try:
+            while total is None or n_done < total:
+                kind, item = done.get()
+                if kind == 'error':
+                    raise item
+                if kind == 'total':
+                    total = item
+                    continue
+                n_done += 1
+                yield item
+        finally:
+            stop.set()
+            producer.join()
+            for worker in workers:
+                worker.join()
+
+
+class AsyncDownloader:
+    """Coroutine version of ``ThreadedDownloader`` running `max_workers` worker tasks"""
+    _sentinel = ((datetime.max,), 0, None)
+
+    def __init__(self, process: Callable[[T], Awaitable[T]], max_workers: int,
+                 key: Callable[[T], Tuple] = _mail_order):
+        self._process = process
+        self._max_workers = max_workers
+        self._key = key
+
+    async def run(self, mails: AsyncIterable[T]) -> AsyncIterator[T]:
+        pending = asyncio.PriorityQueue()
+        done = asyncio.Queue()
+
+        async def produce():
+            n = 0
+            try:
+                async for mail in mails:
+                    n += 1
+                    pending.put_nowait((self._key(mail), n, mail))
+            except Exception as e:
+                done.put_nowait(('error', e))
+            else:
+                done.put_nowait(('total', n))
+            finally:
+                for _ in range(self._max_workers):
+                    pending.put_nowait(self._sentinel)
+
+        async def work():
+            while True:
+                _, _, mail = await pending.get()
+                if mail is None:
+                    break
+                try:
+                    done.put_nowait(('done', await self._process(mail)))
+                except Exception as e:
+                    done.put_nowait(('error', e))
+
+        tasks = [asyncio.ensure_future(produce())]
+        tasks += [asyncio.ensure_future(work()) for _ in range(self._max_workers)]
+        total, n_done = None, 0
+        try:
+            while total is None or n_done < total:
+                kind, item = await done.get()
+                if kind == 'error':
+                    raise item
+                if kind == 'total':
+                    total = item
+                    continue
+                n_done += 1
+                yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def merge(iterables: Iterable[Iterable[T]]) -> Iterator[T]:
+    """Iterate `iterables` concurrently, each on its own thread, yielding their items as they come"""
+    items = Queue()
+    stop = Event()
+
+    def produce(iterable: Iterable[T]):
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    break
+                items.put(('item', item))
+        except BaseException as e:
+            items.put(('error', e))
+        finally:
+            items.put(('done', None))
+
+    producers = [Thread(target=produce, args=(it,), daemon=True) for it in iterables]
+    for producer in producers:
+        producer.start()
+    remaining = len(producers)
+    try:
+        while remaining:
+            kind, item = items.get()
+            if kind == 'error':
+                raise item
+            if kind == 'done':
+                remaining -= 1
+                continue
+            yield item
+    finally:
+        # Producers blocked on a request are left to finish it on their own
+        stop.set()
+
+
+async def merge_async(iterables: Iterable[AsyncIterable[T]]) -> AsyncIterator[T]:
+    """Coroutine version of ``merge`` running a task for each of `iterables`"""
+    items = asyncio.Queue()
+
+    async def produce(iterable: AsyncIterable[T]):
+        try:
+            async for item in iterable:
+                items.put_nowait(('item', item))
+        except Exception as e:
+            items.put_nowait(('error', e))
+        finally:
+            items.put_nowait(('done', None))
+
+    tasks = [asyncio.ensure_future(produce(it)) for it in iterables]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            kind, item = await items.get()
+            if kind == 'error':
+                raise item
+            if kind == 'done':
+                remaining -= 1
+                continue
+            yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+_worker_composers: List['MailComposer'] = []
+
+
+def _init_worker(composer_factories: Sequence[Callable[[ImageFetcher], 'MailComposer']]):
+    global _worker_composers
+    fetcher = DeferredFetcher()
+    _worker_composers = [factory(fetcher) for factory in composer_factories]
+
+
+def _render(job: int, recipient: User, mail: Mail, body: str) -> Tuple[List[AnyArtifact], Metrics]:
+    # Metrics of the worker are sent back along with the artifacts
+    return _worker_composers[job].render(recipient, mail, body), metrics.drain()
+
+
+class ProcessComposer:
+    """Compose mails on a pool of worker processes, keeping network I/O on the calling threads
+
+    `composer_factories` are called with a ``DeferredFetcher`` in each worker process, so they must be
+    picklable. Requests made by the commands are deferred to the fetcher of the composer of `composers`
+    made by the same factory, which makes them while saving the artifacts. Mails are composed by the
+    composers at index `job`, so that several jobs share the pool.
+    """
+    def __init__(self, composer_factories: Sequence[Callable[[ImageFetcher], 'MailComposer']],
+                 composers: Sequence['MailComposer'], max_workers: Optional[int] = None):
+        # Started while the crawler, download and writer threads run, whose locks a forked worker could
+        # inherit held, so workers are spawned afresh
+        self._executor = ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=_init_worker, initargs=(composer_factories,))
+        self._composers = composers
+
+    def compose(self, recipient: User, mail: Mail, body: str, job: int = 0) -> None:
+        artifacts, worker_metrics = self._executor.submit(_render, job, recipient, mail, body).result()
+        metrics.merge(worker_metrics)
+        self._composers[job].save_artifacts(artifacts)
+
+    async def compose_async(self, recipient: User, mail: Mail, body: str, job: int = 0) -> None:
+        loop = asyncio.get_running_loop()
+        artifacts, worker_metrics = await loop.run_in_executor(self._executor, _render, job, recipient, mail, body)
+        metrics.merge(worker_metrics)
+        await self._composers[job].save_artifacts_async(artifacts)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,119 @@
+import cProfile
+import io
+import pstats
+import re
+import threading
+import tracemalloc
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+# Traces of the profiler and of the import machinery are noise in allocation reports
+_filters = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+]
+
+
+class Profiler:
+    """Profile CPU time of every thread with cProfile and memory allocations with tracemalloc
+
+    Threads are profiled from the first call after ``start``, so pools must be created after it.
+    Calls made in other processes are not profiled. ``snapshot`` records the allocations at a stage
+    boundary, with their growth since the previous one. Reports are written into `directory` by ``stop``:
+
+    - ``cpu.pstats``: Aggregated profile of all threads, readable with `pstats` or snakeviz
+    - ``cpu-<thread>.pstats``: Profile of the threads of each pool
+    - ``cpu.txt``: Top functions by cumulative and by own time
+    - ``memory.txt``: Top allocations at each snapshot
+    """
+    def __init__(self, directory: Path, top: int = 25, frames: int = 1):
+        self._directory = directory
+        self._top = top
+        self._frames = frames
+        self._lock = Lock()
+        self._profiles: List[Tuple[str, cProfile.Profile]] = []
+        self._main: Optional[cProfile.Profile] = None
+        self._snapshots: List[Tuple[str, tracemalloc.Snapshot, int, int]] = []
+
+    @property
+    def directory(self) -> Path:
+        return self._directory
+
+    def _profile_thread(self, *_):
+        profile = cProfile.Profile()
+        try:
+            # Replaces this hook for the rest of the thread
+            profile.enable()
+        except ValueError:
+            # Since Python 3.12, a single profiler sees every thread
+            threading.setprofile(None)
+            return
+        with self._lock:
+            self._profiles.append((threading.current_thread().name, profile))
+
+    def start(self):
+        tracemalloc.start(self._frames)
+        self.snapshot('start')
+        threading.setprofile(self._profile_thread)
+        self._main = cProfile.Profile()
+        self._main.enable()
+        self._profiles.append((threading.current_thread().name, self._main))
+
+    def snapshot(self, label: str):
+        """Record the allocations of now, to be compared with the previous snapshot"""
+        # Snapshots are only analyzed by `stop`, as it takes seconds of pure Python
+        snapshot = tracemalloc.take_snapshot()
+        with self._lock:
+            self._snapshots.append((label, snapshot, *tracemalloc.get_traced_memory()))
+
+    def stop(self):
+        """Stop profiling and write the reports, once the profiled threads are done"""
+        threading.setprofile(None)
+        self._main.disable()
+        self.snapshot('stop')
+        tracemalloc.stop()
+        self._directory.mkdir(parents=True, exist_ok=True)
+
+        groups: Dict[str, List[cProfile.Profile]] = {}
+        for name, profile in self._profiles:
+            profile.create_stats()
+            groups.setdefault(_group_name(name), []).append(profile)
+        for name, profiles in groups.items():
+            pstats.Stats(*profiles).dump_stats(self._directory / f'cpu-{_safe_name(name)}.pstats')
+        stats = pstats.Stats(*(p for _, p in self._profiles))
+        stats.dump_stats(self._directory / 'cpu.pstats')
+
+        text = io.StringIO()
+        stats.stream = text
+        stats.sort_stats('cumulative').print_stats(self._top)
+        stats.sort_stats('tottime').print_stats(self._top)
+        (self._directory / 'cpu.txt').write_text(text.getvalue(), 'utf-8')
+        (self._directory / 'memory.txt').write_text(self._memory_report(), 'utf-8')
+
+    def _memory_report(self) -> str:
+        mib = 2 ** 20
+        lines = []
+        last = None
+        for label, snapshot, current, peak in self._snapshots:
+            snapshot = snapshot.filter_traces(_filters)
+            lines.append(f'== {label}: {current / mib:.1f} MiB traced, {peak / mib:.1f} MiB peak')
+            lines.append(f'-- Top {self._top} by size')
+            lines += map(str, snapshot.statistics('lineno')[:self._top])
+            if last is not None:
+                lines.append(f'-- Top {self._top} by growth')
+                lines += map(str, snapshot.compare_to(last, 'lineno')[:self._top])
+            lines.append('')
+            last = snapshot
+        return '\n'.join(lines)
+
+
+def _group_name(name: str) -> str:
+    # Threads of a pool are named <prefix>_<n>, and others Thread-<n> (<target>)
+    return re.sub(r'^Thread-\d+ \((.+)\)$', r'\1', re.sub(r'_\d+$', '', name))
+
+
+def _safe_name(name: str) -> str:
+    return re.sub(r'[^\w.-]+', '-', name)
@@ -0,0 +1,172 @@
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from os import PathLike
+from pathlib import Path
+from threading import RLock
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Union
+
+from izonemail import Pack
+
+
+class Document(NamedTuple):
+    """Searchable fields of an archived mail"""
+    id: str
+    path: str
+    member_id: int
+    member: str
+    received: str
+    subject: str
+    content: str
+    body: str
+
+
+class Hit(NamedTuple):
+    id: str
+    path: str
+    member: str
+    received: datetime
+    subject: str
+    snippet: str
+
+
+def extract_document(path: str, html: bytes) -> Optional[Document]:
+    """Read the fields of a mail from its composed markup, or None if it is not a mail
+
+    The fields are those stamped by ``InsertAppMetadataCommand``, and the text of the mail
+    without its header.
+    """
+    # Not imported with the module, which every run opens the index with
+    import lxml.html
+
+    tree = lxml.html.document_fromstring(html)
+    meta = tree.find('.//meta[@name="application-name"]')
+    if meta is None or meta.get('data-id') is None:
+        return None
+    header = tree.get_element_by_id('mail-header', None)
+    member = header.xpath('string(.//*[contains(@class, "fw-bold")])').strip() if header is not None else ''
+    for e in tree.xpath('//head | //script | //style | //header'):
+        e.drop_tree()
+    return Document(meta.get('data-id'), path, int(meta.get('data-member-id', -1)), member,
+                    meta.get('data-received', ''), meta.get('data-subject', ''), meta.get('data-content', ''),
+                    ' '.join(tree.text_content().split()))
+
+
+class SearchIndex:
+    """Full-text index of archived mails in an SQLite FTS5 table
+
+    Text is split into trigrams where SQLite supports it, so that words are found inside
+    Korean and Japanese text, which is not separated by spaces. Queries are matched as a
+    sequence of terms which must all appear, and terms shorter than a trigram are scanned for.
+    """
+    _columns = 'id UNINDEXED, path UNINDEXED, member_id UNINDEXED, member, received UNINDEXED, subject, content, body'
+
+    def __init__(self, path: Union[str, PathLike]):
+        self._lock = RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        try:
+            self._conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS mail_text USING fts5({self._columns}, "
+                               f"tokenize='trigram')")
+        except sqlite3.OperationalError:
+            # Before SQLite 3.34
+            self._conn.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS mail_text USING fts5({self._columns})')
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM mail_text').fetchone()[0]
+
+    def paths(self) -> List[str]:
+        with self._lock:
+            return [p for p, in self._conn.execute('SELECT path FROM mail_text')]
+
+    def add(self, documents: Iterable[Optional[Document]]) -> int:
+        """Index documents in a single transaction, replacing those of the same mails"""
+        n = 0
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                for d in documents:
+                    if d is None:
+                        continue
+                    self._conn.execute('DELETE FROM mail_text WHERE id = ?', (d.id,))
+                    self._conn.execute('INSERT INTO mail_text VALUES (?, ?, ?, ?, ?, ?, ?, ?)', d)
+                    n += 1
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+        return n
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM mail_text')
+
+    def search(self, text: str = '', member: Optional[str] = None, since: Optional[datetime] = None,
+               until: Optional[datetime] = None, limit: int = 20) -> List[Hit]:
+        """Mails containing every term of `text`, the most relevant first or the newest without `text`
+
+        `member` is either the id or the name of a member.
+        """
+        where, params = [], []
+        terms = text.split()
+        phrases = ['"' + t.replace('"', '""') + '"' for t in terms if len(t) >= 3]
+        if phrases:
+            where.append('mail_text MATCH ?')
+            params.append(' AND '.join(phrases))
+        for t in terms:
+            if len(t) < 3:
+                where.append('(member LIKE ? OR subject LIKE ? OR content LIKE ? OR body LIKE ?)')
+                params += [f'%{t}%'] * 4
+        if member is not None:
+            where.append('(member_id = ? OR member = ?)')
+            params += [int(member) if member.isdigit() else None, member]
+        if since is not None:
+            where.append('received >= ?')
+            params.append(since.isoformat(' '))
+        if until is not None:
+            where.append('received < ?')
+            params.append(until.isoformat(' '))
+        snippet = "snippet(mail_text, -1, '\x1b[1m', '\x1b[22m', '…', 64)" if phrases else "substr(body, 1, 80)"
+        query = (f"SELECT id, path, member, received, subject, {snippet} FROM mail_text "
+                 f"{'WHERE ' + ' AND '.join(where) if where else ''} "
+                 f"ORDER BY {'rank' if phrases else 'received DESC'} LIMIT ?")
+        with self._lock:
+            rows = self._conn.execute(query, (*params, limit)).fetchall()
+        return [Hit(i, p, m, datetime.fromisoformat(r), s, sn) for i, p, m, r, s, sn in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_read: Callable[[str], bytes]
+
+
+def _init_worker(root: Path, pack: Optional[Path]):
+    global _read
+    _read = Pack(pack).read if pack else lambda path: (root / path).read_bytes()
+
+
+def _extract(path: str) -> Optional[Document]:
+    return extract_document(path, _read(path))
+
+
+def archive_paths(root: Path, pack: Optional[Path] = None) -> List[str]:
+    """Paths of the markup saved under `root` or in `pack`, relative to `root`"""
+    if pack:
+        reader = Pack(pack)
+        paths = [p for p in reader if p.endswith('.html')]
+        reader.close()
+        return paths
+    return [p.relative_to(root).as_posix() for p in root.rglob('*.html')]
+
+
+def scan_archive(root: Path, paths: List[str], pack: Optional[Path] = None,
+                 max_workers: Optional[int] = None) -> Iterator[Optional[Document]]:
+    """Extract the documents of markup saved under `root` or in `pack`, in order and on all cores
+
+    Markup which is not a mail is yielded as None.
+    """
+    with ProcessPoolExecutor(max_workers, initializer=_init_worker, initargs=(root, pack)) as executor:
+        yield from executor.map(_extract, paths, chunksize=32)
@@ -0,0 +1,137 @@
+import runpy
+import sys
+import threading
+from argparse import ArgumentParser, REMAINDER
+from contextlib import contextmanager
+from importlib.abc import MetaPathFinder
+from pathlib import Path
+from time import perf_counter
+from typing import Iterator, List, NamedTuple, Optional, TextIO, Tuple
+
+
+class Import(NamedTuple):
+    name: str
+    depth: int  # Number of imports it is nested in
+    own: float  # Seconds, without the nested imports
+    cumulative: float
+    phase: str
+
+
+class _TimedLoader:
+    """Loader executing modules of `loader` under the watch of `timer`"""
+    def __init__(self, loader, timer: 'ImportTimer'):
+        self._loader = loader
+        self._timer = timer
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        # Modules see their own loader, e.g. to read their resources
+        module.__loader__ = module.__spec__.loader = self._loader
+        with self._timer.timing(module.__name__):
+            self._loader.exec_module(module)
+
+
+class ImportTimer(MetaPathFinder):
+    """Time every module imported while installed, like ``python -X importtime``
+
+    Imports are attributed to the phase of the run they happen in, as told by `checkpoint`.
+    """
+    def __init__(self):
+        self.imports: List[Import] = []
+        self.phases: List[Tuple[str, float]] = [('imports', perf_counter())]
+        self._local = threading.local()  # Stack of the time spent in nested imports, per thread
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        sys.meta_path.remove(self)
+
+    def checkpoint(self, phase: str):
+        self.phases.append((phase, perf_counter()))
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path[sys.meta_path.index(self) + 1:]:
+            find_spec = getattr(finder, 'find_spec', None)
+            spec = find_spec and find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if hasattr(spec.loader, 'exec_module'):
+            spec.loader = _TimedLoader(spec.loader, self)
+        return spec
+
+    @contextmanager
+    def timing(self, name: str) -> Iterator[None]:
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(0.0)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self.imports.append(Import(name, len(stack), elapsed - nested, elapsed, self.phases[-1][0]))
+
+    def report(self, end: float, threshold: float = 0.001, file: Optional[TextIO] = None):
+        """Print the imports which took at least `threshold` seconds, then the time of every phase"""
+        print('import time: self [us] | cumulative | imported package', file=file)
+        # Imports are recorded once complete, after those they contain, in the order importtime prints them
+        for i in self.imports:
+            if i.cumulative >= threshold:
+                print(f'import time: {i.own * 1e6:>9.0f} | {i.cumulative * 1e6:>10.0f} | '
+                      f'{"  " * i.depth}{i.name}  [{i.phase}]', file=file)
+        print(f'\n{"phase":<24} {"time [ms]":>10} {"imports [ms]":>13} {"modules":>8}', file=file)
+        for (phase, start), (_, stop) in zip(self.phases, self.phases[1:] + [('', end)]):
+            imports = [i for i in self.imports if i.phase == phase]
+            print(f'{phase:<24} {(stop - start) * 1000:>10.1f} '
+                  f'{sum(i.cumulative for i in imports if i.depth == 0) * 1000:>13.1f} {len(imports):>8}', file=file)
+
+
+_timer: Optional[ImportTimer] = None
+
+
+def checkpoint(phase: str):
+    """Start timing `phase` of the script run under the startup report, if any"""
+    if _timer is not None:
+        _timer.checkpoint(phase)
+
+
+def main():
+    global _timer
+    parser = ArgumentParser(description='Run a script, then report where its startup spent time, '
+                                        'in the manner of `python -X importtime`.')
+    parser.add_argument('--threshold', type=float, default=1.0, metavar='<ms>',
+                        help='Only list imports which took at least this many milliseconds.')
+    parser.add_argument('script', type=Path, metavar='<script>', help='Script to run, e.g. izms.py')
+    parser.add_argument('args', nargs=REMAINDER, metavar='...', help='Arguments of the script.')
+    args = parser.parse_args()
+
+    # The script reaches `checkpoint` of this very module, not of a second copy imported by name
+    sys.modules.setdefault('startup', sys.modules[__name__])
+    sys.argv = [str(args.script), *args.args]
+    sys.path[0] = str(args.script.resolve().parent)
+    _timer = ImportTimer()
+    _timer.install()
+    code = 0
+    try:
+        runpy.run_path(str(args.script), run_name='__main__')
+    except SystemExit as e:
+        code = e.code
+    finally:
+        end = perf_counter()
+        _timer.uninstall()
+        _timer.report(end, args.threshold / 1000, sys.stderr)
+    return code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
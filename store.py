@@ -0,0 +1,339 @@
+import json
+import pickle
+import sqlite3
+import zlib
+from dataclasses import asdict, replace
+from datetime import datetime
+from os import PathLike
+from pathlib import Path
+from threading import RLock
+from time import monotonic
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from izonemail import Mail, Member, Pack, User
+from utils import bytes_to_datetime
+
+
+class ManifestEntry(NamedTuple):
+    """Artifact as it was written, at its path relative to the destination (or in the pack)"""
+    path: str
+    size: Optional[int]  # None, like digest, for the markup of mails written before the manifest
+    digest: Optional[str]  # SHA-256
+    url: Optional[str]  # Where its content was downloaded from, if it was
+
+
+class IndexStore:
+    """SQLite-backed index of committed mails, and manifest of the artifacts written for them
+
+    Every commit is an incremental, atomic write in WAL mode, so a crash can never
+    corrupt the mails committed before it. Lookups hit the primary key only.
+    """
+    _schema = '''
+        CREATE TABLE IF NOT EXISTS mails (
+            id TEXT PRIMARY KEY,
+            received TEXT,
+            member_id INTEGER,
+            path TEXT
+        );
+        CREATE INDEX IF NOT EXISTS mails_received ON mails (received);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS artifacts (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            digest TEXT,
+            url TEXT
+        );
+    '''
+
+    def __init__(self, path: Union[str, PathLike]):
+        self._path = Path(path)
+        self._lock = RLock()
+        self._conn = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(self._schema)
+
+    def __contains__(self, mail_id: str) -> bool:
+        with self._lock:
+            row = self._conn.execute('SELECT 1 FROM mails WHERE id = ?', (mail_id,)).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM mails').fetchone()[0]
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    @property
+    def head(self) -> Optional[datetime]:
+        """Received datetime of the newest committed mail"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'head'").fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def add(self, entries: Iterable[Tuple[Mail, Optional[str]]], artifacts: Iterable[ManifestEntry] = ()):
+        """Commit (mail, output path) pairs and written artifacts in a single transaction
+
+        `entries` must be ordered from the oldest.
+        """
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                head = None
+                for mail, path in entries:
+                    self._conn.execute('INSERT OR REPLACE INTO mails VALUES (?, ?, ?, ?)',
+                                       (mail.id, mail.received.isoformat(), mail.member.id, path))
+                    head = mail.received
+                if head is not None:
+                    self._set_meta('head', head.isoformat())
+                self._conn.executemany('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?)', artifacts)
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def manifest(self) -> List[ManifestEntry]:
+        """Every written artifact, and the markup of every committed mail missing from them"""
+        with self._lock:
+            rows = self._conn.execute('''
+                SELECT path, size, digest, url FROM artifacts
+                UNION ALL
+                SELECT path, NULL, NULL, NULL FROM mails
+                WHERE path IS NOT NULL AND path NOT IN (SELECT path FROM artifacts)
+                ORDER BY path
+            ''').fetchall()
+        return [ManifestEntry(*row) for row in rows]
+
+    def artifact_size(self, path: str) -> Optional[int]:
+        with self._lock:
+            row = self._conn.execute('SELECT size FROM artifacts WHERE path = ?', (path,)).fetchone()
+        return row and row[0]
+
+    def mail_at(self, path: str) -> Optional[str]:
+        """Id of the mail whose markup is at `path`"""
+        with self._lock:
+            row = self._conn.execute('SELECT id FROM mails WHERE path = ?', (path,)).fetchone()
+        return row and row[0]
+
+    def newest_mail(self) -> Optional[str]:
+        """Id of the newest mail with markup"""
+        with self._lock:
+            row = self._conn.execute('SELECT id FROM mails WHERE path IS NOT NULL '
+                                     'ORDER BY received DESC LIMIT 1').fetchone()
+        return row and row[0]
+
+    def _set_meta(self, key, value):
+        self._conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def migrate(self, index_path: Path, head_path: Path) -> int:
+        """Import a legacy pickled INDEX set and HEAD file, then rename them to *.bak
+
+        Mails already in the store are kept, as is its head if it is newer, so that an interrupted
+        migration is simply run again.
+
+        :return: The number of imported mail ids
+        """
+        ids = pickle.loads(index_path.read_bytes()) if index_path.is_file() else set()
+        head = bytes_to_datetime(head_path.read_bytes()) if head_path.is_file() else None
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                self._conn.executemany('INSERT OR IGNORE INTO mails (id) VALUES (?)', ((i,) for i in ids))
+                if head is not None and (self.head is None or head > self.head):
+                    self._set_meta('head', head.isoformat())
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+        for p in (index_path, head_path):
+            if p.is_file():
+                p.replace(p.with_name(p.name + '.bak'))
+        return len(ids)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CommitWatermark:
+    """Commit the oldest contiguous prefix of completed mails to an ``IndexStore``
+
+    Completed mails are buffered and flushed every `every` mails or `interval` seconds,
+    whichever comes first. The order is unknown until the inbox crawl has caught up
+    (the oldest new mail is found last), so nothing is committed before `set_order`.
+    `on_commit` is called with the (mail, output path) pairs of every commit.
+    Written artifacts are added to the manifest of the store with the next commit.
+    """
+    def __init__(self, store: IndexStore, path_of: Callable[[Mail], str], every: int = 100, interval: float = 10,
+                 on_commit: Optional[Callable[[List[Tuple[Mail, str]]], None]] = None):
+        self._store = store
+        self._path_of = path_of
+        self._on_commit = on_commit
+        self._every = every
+        self._interval = interval
+        self._lock = RLock()
+        self._order: Optional[Sequence[Mail]] = None
+        self._position = 0
+        self._completed = set()
+        self._buffer = []
+        self._artifacts: List[ManifestEntry] = []
+        self._last_flush = monotonic()
+        self.committed = 0
+
+    def set_order(self, mails: Iterable[Mail]):
+        """Set the commit order of mails (from the oldest)"""
+        with self._lock:
+            self._order = list(mails)
+            self._advance()
+
+    def record(self, artifact: ManifestEntry):
+        with self._lock:
+            self._artifacts.append(artifact)
+
+    def complete(self, mail: Mail):
+        with self._lock:
+            self._completed.add(mail)
+            self._advance()
+
+    def _advance(self):
+        if self._order is None:
+            return
+        while self._position < len(self._order) and self._order[self._position] in self._completed:
+            mail = self._order[self._position]
+            self._completed.discard(mail)
+            self._buffer.append((mail, self._path_of(mail)))
+            self._position += 1
+        if len(self._buffer) >= self._every or monotonic() - self._last_flush >= self._interval:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._buffer or self._artifacts:
+                buffer = self._buffer
+                self._store.add(buffer, self._artifacts)
+                self.committed += len(buffer)
+                # Cleared first, so that mails are not committed again if `on_commit` fails
+                self._buffer = []
+                self._artifacts = []
+                self._last_flush = monotonic()
+                if self._on_commit is not None and buffer:
+                    self._on_commit(buffer)
+            else:
+                self._last_flush = monotonic()
+
+
+class RawStore:
+    """SQLite-backed cache of the raw mail detail pages, compressed, with their inbox metadata
+
+    Mails can then be composed again offline, with another configuration. Where images were saved
+    is recorded too, so that they are read back instead of being requested again.
+    """
+    _schema = '''
+        CREATE TABLE IF NOT EXISTS mails (
+            id TEXT PRIMARY KEY,
+            member_id INTEGER,
+            member_name TEXT,
+            member_image_url TEXT,
+            subject TEXT,
+            content TEXT,
+            received TEXT,
+            detail_url TEXT,
+            body BLOB
+        );
+        CREATE TABLE IF NOT EXISTS assets (
+            url TEXT PRIMARY KEY,
+            root TEXT,
+            path TEXT
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    '''
+
+    def __init__(self, path: Union[str, PathLike]):
+        self._path = Path(path)
+        self._lock = RLock()
+        self._conn = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(self._schema)
+        self._packs: Dict[str, Pack] = {}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM mails').fetchone()[0]
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    @property
+    def recipient(self) -> Optional[User]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'recipient'").fetchone()
+        return User(**json.loads(row[0])) if row else None
+
+    @recipient.setter
+    def recipient(self, user: User):
+        # The access token is not needed to compose mails
+        value = json.dumps(asdict(replace(user, access_token='')), ensure_ascii=False)
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('recipient', ?)", (value,))
+
+    def put(self, mail: Mail, body: str):
+        data = zlib.compress(body.encode('utf-8'))
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO mails VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (mail.id, mail.member.id, mail.member.name, mail.member.image_url, mail.subject,
+                                mail.content, mail.received.isoformat(), mail.detail_url, data))
+
+    def mails(self) -> List[Mail]:
+        """Every cached mail, from the newest"""
+        with self._lock:
+            rows = self._conn.execute('SELECT id, member_id, member_name, member_image_url, subject, content, '
+                                      'received, detail_url FROM mails ORDER BY received DESC').fetchall()
+        return [Mail(Member(member_id, name, image_url), i, subject, content, datetime.fromisoformat(received), url)
+                for i, member_id, name, image_url, subject, content, received, url in rows]
+
+    def body(self, mail_id: str) -> str:
+        with self._lock:
+            row = self._conn.execute('SELECT body FROM mails WHERE id = ?', (mail_id,)).fetchone()
+        if row is None:
+            raise KeyError(mail_id)
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    def add_asset(self, url: str, root: Union[str, PathLike], path: str):
+        """Record that the content of `url` was saved at `path` of `root`, a directory or a pack"""
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO assets VALUES (?, ?, ?)', (url, str(root), path))
+
+    def read_asset(self, url: str) -> Optional[bytes]:
+        """Content of `url` if it was saved and is still there"""
+        with self._lock:
+            row = self._conn.execute('SELECT root, path FROM assets WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                return None
+            root, path = row
+            root = Path(root)
+            if not root.is_file():
+                target = root / path
+                return target.read_bytes() if target.is_file() else None
+            pack = self._packs.get(str(root))
+            if pack is None:
+                pack = self._packs[str(root)] = Pack(root)
+        try:
+            return pack.read(path)
+        except KeyError:
+            return None
+
+    def close(self):
+        with self._lock:
+            for pack in self._packs.values():
+                pack.close()
+            self._conn.close()
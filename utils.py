@@ -44,6 +44,12 @@ def is_gt_zero(name, val):
         raise ValueError(f"'{name}' must be greater than 0")
 
 
+def is_ge_zero_or_none(name, val):
+    if val is None:
+        return
+    is_ge_zero(name, val)
+
+
 def is_abspath(name, val):
     if not val.startswith('/'):
         raise ValueError(f"'{name}' must start with '/'")
@@ -53,3 +59,17 @@ def is_abspath_or_none(name, val):
     if val is None:
         return
     is_abspath(name, val)
+
+
+def is_one_of(*choices):
+    def validator(name, val):
+        if val not in choices:
+            raise ValueError(f"'{name}' must be one of {list(choices)}")
+    return validator
+
+
+def is_hour_range_or_none(name, val):
+    if val is None:
+        return
+    if len(val) != 2 or not all(isinstance(h, int) and 0 <= h <= 24 for h in val):
+        raise ValueError(f"'{name}' must be a pair of hours from 0 to 24")
@@ -0,0 +1,77 @@
+import hashlib
+import mmap
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Tuple
+
+from izonemail import Pack, pack_key
+from izonemail.utils import naive_join
+from store import ManifestEntry
+
+MISSING = 'missing'
+CORRUPT = 'corrupt'
+
+
+def digest_file(path: Path) -> Tuple[int, str]:
+    """Size and SHA-256 digest of the file at `path`, read through a memory map"""
+    with path.open('rb') as f:
+        size = path.stat().st_size
+        if not size:
+            # Empty files cannot be mapped
+            return 0, hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return size, hashlib.sha256(mm).hexdigest()
+
+
+_root: Path
+_pack: Optional[Pack] = None
+_pack_map: Optional[mmap.mmap] = None
+
+
+def _init_worker(root: Path, pack: Optional[Path]):
+    global _root, _pack, _pack_map
+    _root = root
+    if pack:
+        _pack = Pack(pack)
+        if pack.is_file() and pack.stat().st_size:
+            with pack.open('rb') as f:
+                _pack_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _check_packed(entry: ManifestEntry) -> Optional[str]:
+    location = _pack.locate(pack_key(Path(entry.path)))
+    if location is None:
+        return MISSING
+    offset, size = location
+    if entry.digest is None:
+        return None
+    if size != entry.size or _pack_map is None or offset + size > len(_pack_map):
+        return CORRUPT
+    # Slicing a memory map copies, unlike slicing a view of it
+    digest = hashlib.sha256(memoryview(_pack_map)[offset:offset + size]).hexdigest()
+    return None if digest == entry.digest else CORRUPT
+
+
+def _check(entry: ManifestEntry) -> Optional[str]:
+    if _pack is not None:
+        return _check_packed(entry)
+    path = naive_join(_root, Path(entry.path))
+    if not path.is_file():
+        return MISSING
+    if entry.digest is None:
+        # Written before the manifest, so only an empty file is known to be truncated
+        return None if path.stat().st_size else CORRUPT
+    if path.stat().st_size != entry.size:
+        return CORRUPT
+    return None if digest_file(path)[1] == entry.digest else CORRUPT
+
+
+def verify_archive(root: Path, entries: Iterable[ManifestEntry], pack: Optional[Path] = None,
+                   max_workers: Optional[int] = None) -> Iterator[Tuple[ManifestEntry, Optional[str]]]:
+    """Check the artifacts of the manifest saved under `root` or in `pack`, in order and on all cores
+
+    Every entry is yielded with its problem, ``MISSING`` or ``CORRUPT``, or None if it is intact.
+    """
+    with ProcessPoolExecutor(max_workers, initializer=_init_worker, initargs=(root, pack)) as executor:
+        entries = list(entries)
+        yield from zip(entries, executor.map(_check, entries, chunksize=64))
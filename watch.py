@@ -0,0 +1,76 @@
+import json
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from typing import Any, Callable, Dict, Optional, Sequence
+from urllib.parse import urlsplit
+
+from izonemail import metrics
+
+
+class PollSchedule:
+    """Interval between two polls of the inbox
+
+    Polls are `interval` apart during `active_hours` of local time, given as [start, end) hours
+    which may wrap around midnight, and after mails have been found. Otherwise the interval
+    doubles after each poll without mails, up to `max_interval`.
+    """
+    def __init__(self, interval: float, max_interval: float, active_hours: Optional[Sequence[int]] = None):
+        self._interval = interval
+        self._max_interval = max(interval, max_interval)
+        self._active_hours = active_hours
+        self._current = interval
+
+    def is_active(self, now: datetime) -> bool:
+        if not self._active_hours:
+            return False
+        start, end = self._active_hours
+        if start <= end:
+            return start <= now.hour < end
+        return now.hour >= start or now.hour < end
+
+    def next(self, found: bool, now: Optional[datetime] = None) -> float:
+        """Seconds to wait before the next poll, given whether the last one found mails"""
+        if found or self.is_active(now or datetime.now()):
+            self._current = self._interval
+        else:
+            self._current = min(self._current * 2, self._max_interval)
+        return self._current
+
+
+class HealthRequestHandler(BaseHTTPRequestHandler):
+    """Serve the status of the watcher at /health and its metrics at /metrics
+
+    /health answers 503 while the last poll has failed.
+    """
+    status: Callable[[], Dict[str, Any]]
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/health':
+            status = self.status()
+            body = json.dumps(status, indent=2, ensure_ascii=False, default=str).encode()
+            return self._send(200 if status['healthy'] else 503, 'application/json', body)
+        if path == '/metrics':
+            return self._send(200, 'text/plain; version=0.0.4', metrics.to_prometheus().encode())
+        self.send_error(404)
+
+    def _send(self, status: int, content_type: str, data: bytes):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Requests of monitoring would bury the mails in the console
+        pass
+
+
+def serve_health(host: str, port: int, status: Callable[[], Dict[str, Any]]) -> ThreadingHTTPServer:
+    """Start serving ``HealthRequestHandler`` on a background thread, until the server is shut down"""
+    handler = type('HealthRequestHandler', (HealthRequestHandler,), {'status': staticmethod(status)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name='HealthServer', daemon=True).start()
+    return server